@@ -1,8 +1,65 @@
-from flask import Flask, render_template, request
-import itertools
-from simulador_rushapo import run_simulacion_completa, params as default_params
+from flask import Flask, Response, g, jsonify, render_template, request, send_file, stream_with_context
+import cProfile
+import io
+import marshal
+import math
+import os
+import pstats
+import re
+import tempfile
+import time
+from simulador_rushapo import (run_simulacion_completa, simular_lote, export_rushapo_excel, exportar_muestras,
+                               muestras_csv, cuotas_desde_matriz, calibrar_desde_cuotas, params as default_params, SIGMA_MAX, GRID_SENS_DEFAULT, PARAMS_SENS, GRID_MAX_CELDAS, MODOS_VR)
+from cache_resultados import clave_simulacion, crear_cache
+from trabajos import ColaLlena, ColaTrabajos
+from liga import fixture_todos_contra_todos, simular_temporada
+from tabla_marcadores import tabla_global
+from mercados import MAX_PATAS, MERCADOS_DEFAULT, combinadas as prob_combinadas, es_valido, ev, grupos_complementarios, kelly
+import metricas
+from metricas import etapa
 
 app = Flask(__name__)
+# Límites del servidor (configurables por entorno): trabajo total y tamaño de bloque
+app.config["MAX_SIMS"] = int(os.getenv("RUSHAPO_MAX_SIMS", 5_000_000))
+app.config["TAM_BLOQUE"] = int(os.getenv("RUSHAPO_TAM_BLOQUE", 250_000))
+# Partidos por llamada a /api/simular (el trabajo total partidos x n_sims sigue acotado por MAX_SIMS)
+app.config["MAX_FIXTURES"] = int(os.getenv("RUSHAPO_MAX_FIXTURES", 100))
+# Temporadas por llamada a /api/liga
+app.config["MAX_TEMPORADAS"] = int(os.getenv("RUSHAPO_MAX_TEMPORADAS", 100_000))
+# Cache de resultados: "memoria" (por worker), "archivo" (compartido entre workers) u "off"
+app.config["CACHE_BACKEND"] = os.getenv("RUSHAPO_CACHE", "memoria")
+app.config["CACHE_MAX"] = int(os.getenv("RUSHAPO_CACHE_MAX", 256))
+app.config["CACHE_TTL"] = float(os.getenv("RUSHAPO_CACHE_TTL", 600))
+app.config["CACHE_DIR"] = os.getenv("RUSHAPO_CACHE_DIR") or None
+cache = crear_cache(app.config["CACHE_BACKEND"], app.config["CACHE_MAX"], app.config["CACHE_TTL"], app.config["CACHE_DIR"])
+# Trabajos en segundo plano (/jobs): hilos, trabajos en espera, memoria por trabajo y tope de n_sims
+app.config["JOBS_WORKERS"] = int(os.getenv("RUSHAPO_JOBS_WORKERS", 1))
+app.config["JOBS_MAX_COLA"] = int(os.getenv("RUSHAPO_JOBS_MAX_COLA", 8))
+app.config["JOBS_MEMORIA_MB"] = float(os.getenv("RUSHAPO_JOBS_MEMORIA_MB", 256))
+app.config["JOBS_MAX_SIMS"] = int(os.getenv("RUSHAPO_JOBS_MAX_SIMS", 100_000_000))
+trabajos = ColaTrabajos(app.config["JOBS_WORKERS"], app.config["JOBS_MAX_COLA"],
+                        int(app.config["JOBS_MEMORIA_MB"] * 2**20))
+# Instrumentación: Server-Timing por request y /metrics (Prometheus); perfil cProfile con ?perfil=1
+app.config["METRICAS"] = os.getenv("RUSHAPO_METRICAS", "1") != "0"
+app.config["PERFIL"] = os.getenv("RUSHAPO_PERFIL", "0") == "1"
+metricas.registrar(metricas.Medidor("rushapo_cache_entradas", "Entradas en el cache de resultados",
+                                    lambda: len(cache) if cache is not None else None))
+
+
+def _precalentar():
+    """Carga perezosa anticipada (plantilla Jinja, nodos de cuadratura, rutas de pandas).
+
+    Con `gunicorn --preload` esto ocurre una vez en el master y los workers lo
+    heredan copy-on-write en lugar de pagarlo en su primer request. La tabla de
+    RUSHAPO_TABLA se abre acá (memmap): los workers comparten sus páginas.
+    """
+    app.jinja_env.get_template("index.html")
+    tabla_global()
+    run_simulacion_completa(dict(default_params, engine="exact"), mostrar_graficos=False, exportar_excel=False)
+
+
+if os.getenv("RUSHAPO_PRECALENTAR", "1") != "0":
+    _precalentar()
 
 
 def _to_float(val, default):
@@ -21,61 +78,449 @@ def _to_int(val, default):
         return int(default)
 
 
+def _sigma(val, default):
+    """Sigma del formulario o JSON acotado a [0, SIGMA_MAX]."""
+    return min(SIGMA_MAX, max(0.0, _to_float(val, default)))
+
+
+def _positivo(val, default):
+    """Float positivo y finito del formulario (HFA, xG liga); si no lo es, `default`."""
+    x = _to_float(val, default)
+    return x if math.isfinite(x) and x > 0 else float(default)
+
+
+# Reglas por eje de la grilla de sensibilidad (las mismas del formulario); None = valor descartado
+_VALORES_SENS = {
+    "HFA": lambda v: v if math.isfinite(v) and v > 0 else None,
+    "sigma": lambda v: _sigma(v, 0.0),
+    "xG_liga_equipo": lambda v: v if math.isfinite(v) and v > 0 else None,
+    "peso_xg": lambda v: min(1.0, max(0.0, v)),
+}
+
+
+def _to_float_list(val, default):
+    """Lista de floats separados por ';' (o por ',' si no hay ';')."""
+    try:
+        txt = str(val or "").strip()
+        if not txt:
+            return list(default)
+        partes = txt.split(";") if ";" in txt else txt.split(",")
+        return [float(x.strip().replace(",", ".")) for x in partes if x.strip()]
+    except Exception:
+        return list(default)
+
+
+def _grid_desde_form(form):
+    """Arma la grilla de sensibilidad (hasta 2 ejes) desde el formulario."""
+    defaults = list(GRID_SENS_DEFAULT.items())
+    grid = {}
+    for i, (param_def, vals_def) in enumerate(defaults, start=1):
+        param = form.get(f"sens_param{i}", param_def)
+        if param not in PARAMS_SENS or param in grid:
+            continue
+        vals = _to_float_list(form.get(f"sens_vals{i}"), vals_def if param == param_def else [])
+        # Valores fuera de rango: se acotan (sigma, peso_xg) o se descartan (HFA, xG liga)
+        vals = list(dict.fromkeys(v for v in map(_VALORES_SENS[param], vals) if v is not None))
+        if vals:
+            grid[param] = vals
+    n_celdas = 1
+    for vals in grid.values():
+        n_celdas *= len(vals)
+    if not grid or n_celdas > GRID_MAX_CELDAS:
+        return dict(GRID_SENS_DEFAULT)
+    return grid
+
+
+def _params_web():
+    """Parámetros por defecto de la web: el motor exacto evita muestrear (sin ruido y en < 1 ms)."""
+    return dict(default_params, engine="exact")
+
+
+def _params_desde_form(form, current, max_sims=None):
+    """Arma los parámetros de simulación desde el formulario (faltantes: `current`).
+
+    Sirve para cualquier mapeo con .get (p.ej. el JSON de /jobs); n_sims se acota a
+    max_sims (por defecto MAX_SIMS).
+    """
+    max_sims = max_sims or app.config["MAX_SIMS"]
+    p = {
+        "equipo_local": form.get("equipo_local", current["equipo_local"]),
+        "equipo_visit": form.get("equipo_visit", current["equipo_visit"]),
+        "xGF_local_prom": _to_float(form.get("xGF_local_prom"), current["xGF_local_prom"]),
+        "xGA_local_prom": _to_float(form.get("xGA_local_prom"), current["xGA_local_prom"]),
+        "xGF_visit_prom": _to_float(form.get("xGF_visit_prom"), current["xGF_visit_prom"]),
+        "xGA_visit_prom": _to_float(form.get("xGA_visit_prom"), current["xGA_visit_prom"]),
+        # Nuevos: goles últimos 10 (prom por partido)
+        "gf_local_10": _to_float(form.get("gf_local_10"), current.get("gf_local_10") or current["xGF_local_prom"]),
+        "ga_local_10": _to_float(form.get("ga_local_10"), current.get("ga_local_10") or current["xGA_local_prom"]),
+        "gf_visit_10": _to_float(form.get("gf_visit_10"), current.get("gf_visit_10") or current["xGF_visit_prom"]),
+        "ga_visit_10": _to_float(form.get("ga_visit_10"), current.get("ga_visit_10") or current["xGA_visit_prom"]),
+        # Promedio de goles totales de la liga (si se da, derivamos xG liga = goles/2)
+        "goles_liga_prom": _to_float(form.get("goles_liga_prom"), current.get("goles_liga_prom") or 2*current["xG_liga_equipo"]),
+        "xG_liga_equipo": _positivo(form.get("xG_liga_equipo"), current["xG_liga_equipo"]),
+        "HFA": _positivo(form.get("HFA"), current["HFA"]),
+        "sigma": _sigma(form.get("sigma"), current["sigma"]),
+        "peso_xg": min(1.0, max(0.0, _to_float(form.get("peso_xg"), current["peso_xg"]))),
+        "n_sims": min(max(1, _to_int(form.get("n_sims"), current["n_sims"])), max_sims),
+        "tam_bloque": app.config["TAM_BLOQUE"],
+        # Error estándar objetivo en puntos porcentuales (vacío, 0 o negativo = n_sims fijo)
+        "se_objetivo": (max(0.0, _to_float(form.get("se_objetivo"), 0)) / 100.0) or None,
+        "seed": current.get("seed", 42),
+        "engine": form.get("engine") if form.get("engine") in ("mc", "exact", "tabla") else current["engine"],
+        "reduccion_varianza": form.get("reduccion_varianza") if form.get("reduccion_varianza") in MODOS_VR else None,
+    }
+
+    # Recalcular xG liga si se proporcionó goles_liga_prom válido
+    if p.get("goles_liga_prom") and p["goles_liga_prom"] > 0:
+        p["xG_liga_equipo"] = p["goles_liga_prom"] / 2.0
+    return p
+
+
+def _mercados_extra(txt):
+    """Lee "mercado @ cuota" separados por ';' o saltos de línea (la cuota es opcional).
+
+    Devuelve ({mercado: cuota}, [nombres no reconocidos por el registro de mercados]).
+    """
+    cuotas, desconocidos = {}, []
+    for parte in re.split(r"[;\n]", txt or ""):
+        nombre, _, cuota = parte.partition("@")
+        nombre = " ".join(nombre.split())
+        if not nombre:
+            continue
+        if es_valido(nombre):
+            cuotas[nombre] = cuota.strip()
+        else:
+            desconocidos.append(nombre)
+    return cuotas, desconocidos
+
+
+def _simular_con_cache(p, grid):
+    """Ejecuta la simulación o la toma del cache. Devuelve (resultado, hit).
+
+    Al perfilar se salta el cache y se simula en un solo hilo (mismo resultado) para
+    que cProfile vea todo el trabajo.
+    """
+    perfilando = "perfil" in g
+    if perfilando:
+        p = dict(p, workers=1)
+    clave = clave_simulacion(p, grid) if cache is not None and p.get("seed") is not None else None
+    if clave and not perfilando:
+        with etapa("cache"):
+            result = cache.get(clave)
+        metricas.CACHE.inc(1, "hit" if result is not None else "miss")
+        if result is not None:
+            return result, True
+    result = run_simulacion_completa(p, mostrar_graficos=False, exportar_excel=False, grid_sens=grid)
+    if clave:
+        cache.set(clave, result)
+    return result, False
+
+
+@app.before_request
+def _iniciar_medicion():
+    if not app.config["METRICAS"]:
+        return
+    g.t0 = time.perf_counter()
+    g.token_etapas = metricas.iniciar_request()
+    if app.config["PERFIL"] and request.args.get("perfil"):
+        g.perfil = cProfile.Profile()
+        g.perfil.enable()
+
+
+def _respuesta_perfil(perfil, modo):
+    """Reporte cProfile del request: texto (por tiempo acumulado) o .prof binario (modo "prof")."""
+    perfil.create_stats()
+    if modo == "prof":
+        # Mismo formato que pstats.dump_stats: se abre con pstats, snakeviz, etc.
+        return send_file(io.BytesIO(marshal.dumps(perfil.stats)), mimetype="application/octet-stream",
+                         as_attachment=True, download_name="rushapo_request.prof")
+    salida = io.StringIO()
+    pstats.Stats(perfil, stream=salida).sort_stats("cumulative").print_stats(60)
+    return Response(salida.getvalue(), mimetype="text/plain")
+
+
+@app.after_request
+def _terminar_medicion(resp):
+    token = g.pop("token_etapas", None)
+    if token is None:
+        return resp
+    perfil = g.pop("perfil", None)
+    if perfil is not None:
+        perfil.disable()
+    total = time.perf_counter() - g.t0
+    etapas = metricas.terminar_request(token)
+    ruta = request.url_rule.rule if request.url_rule else "otra"
+    metricas.REQUESTS.observar(total, ruta, request.method, resp.status_code)
+    if perfil is not None:
+        resp = _respuesta_perfil(perfil, request.args.get("perfil"))
+    resp.headers["Server-Timing"] = metricas.server_timing(etapas, total)
+    return resp
+
+
+@app.teardown_request
+def _limpiar_medicion(_exc):
+    # Si el request falló antes de after_request
+    token = g.pop("token_etapas", None)
+    if token is not None:
+        metricas.terminar_request(token)
+    perfil = g.pop("perfil", None)
+    if perfil is not None:
+        perfil.disable()
+
+
+@app.route("/metrics", methods=["GET"])
+def metrics():
+    """Métricas del proceso en formato Prometheus (latencias, etapas, simulaciones/s, cache, memoria)."""
+    if not app.config["METRICAS"]:
+        return "Métricas desactivadas (RUSHAPO_METRICAS=0)", 404
+    return Response(metricas.exposicion(), mimetype="text/plain; version=0.0.4")
+
+
+@app.route("/descargar", methods=["POST"])
+def descargar():
+    """Descarga el reporte Excel o las muestras crudas (CSV/Parquet) sin escribir en el directorio de trabajo."""
+    p = _params_desde_form(request.form, _params_web())
+    formato = request.form.get("formato", "xlsx")
+    if formato == "csv":
+        # Streaming por partes: la memoria no depende de n_sims
+        return Response(stream_with_context(muestras_csv(p)), mimetype="text/csv",
+                        headers={"Content-Disposition": 'attachment; filename="Rushapo_Muestras.csv"'})
+    if formato == "parquet":
+        buf = tempfile.SpooledTemporaryFile(max_size=32 * 2**20)
+        try:
+            exportar_muestras(p, buf, "parquet")
+        except ImportError as e:
+            buf.close()
+            return str(e), 501
+        buf.seek(0)
+        return send_file(buf, mimetype="application/vnd.apache.parquet", as_attachment=True,
+                         download_name="Rushapo_Muestras.parquet")
+    if formato != "xlsx":
+        return "formato debe ser 'xlsx', 'csv' o 'parquet'", 400
+    result, _ = _simular_con_cache(p, _grid_desde_form(request.form))
+    buf = io.BytesIO()
+    export_rushapo_excel(p, result["resumen"], result["top_scores"], result["sens_df"], result["cuotas_base"], None,
+                         buf, matriz=result["matriz"])
+    buf.seek(0)
+    return send_file(buf, mimetype="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+                     as_attachment=True, download_name="Rushapo_Simulacion_Completa.xlsx")
+
+
+@app.route("/jobs", methods=["POST"])
+def jobs_enviar():
+    """Encola una simulación larga; acepta los campos del formulario como JSON o form.
+
+    Sin "engine" el trabajo usa Monte Carlo (la cola existe para corridas largas).
+    """
+    datos = request.get_json(silent=True)
+    if not isinstance(datos, dict):
+        datos = request.form
+    p = _params_desde_form(datos, dict(_params_web(), engine="mc"), app.config["JOBS_MAX_SIMS"])
+    try:
+        trabajo = trabajos.enviar(p, _grid_desde_form(datos))
+    except ColaLlena as e:
+        return jsonify({"error": str(e)}), 503, {"Retry-After": "5"}
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    return jsonify(trabajo.a_dict()), 202, {"Location": f"/jobs/{trabajo.id}"}
+
+
+@app.route("/jobs/<id_trabajo>", methods=["GET"])
+def jobs_estado(id_trabajo):
+    """Estado, progreso (bloques y simulaciones hechas) y estimaciones actuales."""
+    trabajo = trabajos.obtener(id_trabajo)
+    if trabajo is None:
+        return jsonify({"error": "Trabajo inexistente"}), 404
+    return jsonify(trabajo.a_dict())
+
+
+@app.route("/jobs/<id_trabajo>", methods=["DELETE"])
+def jobs_cancelar(id_trabajo):
+    trabajo = trabajos.cancelar(id_trabajo)
+    if trabajo is None:
+        return jsonify({"error": "Trabajo inexistente"}), 404
+    return jsonify(trabajo.a_dict()), 202
+
+
+@app.route("/jobs/<id_trabajo>/resultado", methods=["GET"])
+def jobs_resultado(id_trabajo):
+    trabajo = trabajos.obtener(id_trabajo)
+    if trabajo is None:
+        return jsonify({"error": "Trabajo inexistente"}), 404
+    if trabajo.estado != "terminado":
+        return jsonify({"error": f"El trabajo está {trabajo.estado}", "estado": trabajo.estado}), 409
+    return jsonify(trabajo.resultado_json())
+
+
+# Claves de un partido en /api/simular: xG -> goles recientes que por defecto toman ese xG
+_CLAVES_XG_API = {
+    "xGF_local_prom": "gf_local_10", "xGA_local_prom": "ga_local_10",
+    "xGF_visit_prom": "gf_visit_10", "xGA_visit_prom": "ga_visit_10",
+}
+
+
+def _fixture_desde_json(d):
+    """Normaliza un partido del JSON con las mismas reglas que el formulario.
+
+    ValueError si HFA o xG liga no son positivos o si algún xG o goles recientes es
+    negativo o no finito (en la API se rechaza en lugar de usar el valor por defecto).
+    """
+    if not isinstance(d, dict):
+        raise ValueError("Cada partido debe ser un objeto JSON")
+    f = {
+        "equipo_local": str(d.get("equipo_local", default_params["equipo_local"])),
+        "equipo_visit": str(d.get("equipo_visit", default_params["equipo_visit"])),
+    }
+    for xg, goles in _CLAVES_XG_API.items():
+        f[xg] = _to_float(d.get(xg), default_params[xg])
+        f[goles] = _to_float(d.get(goles), default_params.get(goles) or f[xg])
+    for k in ("xG_liga_equipo", "HFA", "sigma", "peso_xg"):
+        f[k] = _to_float(d.get(k), default_params[k])
+    f["peso_xg"] = min(1.0, max(0.0, f["peso_xg"]))
+    f["sigma"] = _sigma(f["sigma"], default_params["sigma"])
+    # Si se da goles_liga_prom, xG liga = goles/2 (como en el formulario)
+    goles_liga = _to_float(d.get("goles_liga_prom"), 0)
+    if goles_liga > 0:
+        f["goles_liga_prom"] = goles_liga
+        f["xG_liga_equipo"] = goles_liga / 2.0
+    for k in ("HFA", "xG_liga_equipo"):
+        if not (math.isfinite(f[k]) and f[k] > 0):
+            raise ValueError(f"{k} debe ser positivo (recibido {f[k]})")
+    for k in (*_CLAVES_XG_API, *_CLAVES_XG_API.values()):
+        if not (math.isfinite(f[k]) and f[k] >= 0):
+            raise ValueError(f"{k} debe ser un número finito >= 0 (recibido {f[k]})")
+    return f
+
+
+@app.route("/api/simular", methods=["POST"])
+def api_simular():
+    """Simula una jornada: JSON {"fixtures": [...], "n_sims", "seed", "engine", "mercados"} o una lista de partidos."""
+    datos = request.get_json(silent=True)
+    if isinstance(datos, list):
+        datos = {"fixtures": datos}
+    if not isinstance(datos, dict) or not isinstance(datos.get("fixtures"), list) or not datos["fixtures"]:
+        return jsonify({"error": "Se espera JSON con una lista no vacía 'fixtures'"}), 400
+    n_partidos = len(datos["fixtures"])
+    if n_partidos > app.config["MAX_FIXTURES"]:
+        return jsonify({"error": f"Máximo {app.config['MAX_FIXTURES']} partidos por llamada"}), 400
+    engine = datos.get("engine", default_params["engine"])
+    if engine not in ("mc", "exact"):
+        return jsonify({"error": "engine debe ser 'mc' o 'exact'"}), 400
+    fixtures = []
+    for i, d in enumerate(datos["fixtures"]):
+        try:
+            fixtures.append(_fixture_desde_json(d))
+        except ValueError as e:
+            return jsonify({"error": f"fixtures[{i}]: {e}", "fixture": i}), 400
+    # El presupuesto MAX_SIMS se reparte entre los partidos del lote
+    n_max = max(1, app.config["MAX_SIMS"] // n_partidos)
+    n_sims = min(max(1, _to_int(datos.get("n_sims"), default_params["n_sims"])), n_max)
+    seed = _to_int(datos.get("seed"), default_params["seed"])
+    nombres = datos.get("mercados") or list(MERCADOS_DEFAULT)
+    if not isinstance(nombres, list):
+        return jsonify({"error": "'mercados' debe ser una lista de nombres"}), 400
+    desconocidos = [m for m in nombres if not isinstance(m, str) or not es_valido(m)]
+    if desconocidos:
+        return jsonify({"error": f"Mercados desconocidos: {desconocidos}"}), 400
+    result = simular_lote(fixtures, n_sims=n_sims, seed=seed, engine=engine, tam_bloque=app.config["TAM_BLOQUE"],
+                          nombres_mercados=tuple(nombres))
+    return jsonify(result)
+
+
+@app.route("/api/liga", methods=["POST"])
+def api_liga():
+    """Simula el resto de una liga (outrights).
+
+    JSON: {"equipos": {nombre: {"xGF", "xGA"} o por condición}, "fixtures": [[local, visitante], ...]
+    (por defecto ida y vuelta completa), "tabla_actual": {nombre: {"pts", "gf", "gc"}},
+    "n_temporadas", "seed", "zonas": {nombre: [desde, hasta]}, "HFA", "sigma", "xG_liga_equipo"}.
+    """
+    datos = request.get_json(silent=True)
+    if not isinstance(datos, dict) or not isinstance(datos.get("equipos"), dict) or len(datos["equipos"]) < 2:
+        return jsonify({"error": "Se espera JSON con 'equipos' {nombre: {xGF, xGA}} (al menos dos)"}), 400
+    equipos = datos["equipos"]
+    fixtures = datos.get("fixtures")
+    if fixtures is None:
+        fixtures = fixture_todos_contra_todos(equipos)
+    if not isinstance(fixtures, list):
+        return jsonify({"error": "'fixtures' debe ser una lista de [local, visitante]"}), 400
+    n = min(max(1, _to_int(datos.get("n_temporadas"), 10_000)), app.config["MAX_TEMPORADAS"])
+    p = {k: _to_float(datos.get(k), default_params[k]) for k in ("HFA", "xG_liga_equipo")}
+    p["sigma"] = _sigma(datos.get("sigma"), default_params["sigma"])
+    try:
+        r = simular_temporada(equipos, fixtures, n, seed=_to_int(datos.get("seed"), default_params["seed"]),
+                              tabla_actual=datos.get("tabla_actual"), p=p, zonas=datos.get("zonas"))
+    except (ValueError, TypeError, KeyError, AttributeError, ArithmeticError) as e:
+        return jsonify({"error": str(e)}), 400
+    return jsonify({
+        "resumen": r["resumen"].to_dict(orient="records"),
+        "posiciones": {e: fila.tolist() for e, fila in r["posiciones"].iterrows()},
+        "n_temporadas": r["n_temporadas"],
+        "segundos": r["segundos"],
+        "temporadas_por_segundo": r["temporadas_por_segundo"],
+    })
+
+
+@app.route("/api/calibrar", methods=["POST"])
+def api_calibrar():
+    """Calibra un partido a las cuotas del mercado.
+
+    JSON: {"cuotas": {mercado: cuota}, claves de params del partido, "metodo",
+    "ajustar_sigma", "ajustar_hfa"}. Ver `calibrar_desde_cuotas`.
+    """
+    datos = request.get_json(silent=True)
+    if not isinstance(datos, dict) or not isinstance(datos.get("cuotas"), dict):
+        return jsonify({"error": "Se espera JSON con un objeto 'cuotas' {mercado: cuota}"}), 400
+    try:
+        p = dict(default_params, **_fixture_desde_json(datos))
+        cuotas = {m: _to_float(c, 0) for m, c in datos["cuotas"].items()}
+        cal = calibrar_desde_cuotas(cuotas, p, ajustar_sigma=bool(datos.get("ajustar_sigma")),
+                                    ajustar_hfa=bool(datos.get("ajustar_hfa", True)),
+                                    metodo=datos.get("metodo", "potencia"))
+    except (ValueError, ArithmeticError) as e:
+        return jsonify({"error": str(e)}), 400
+    return jsonify(dict(cal, comparacion=cal["comparacion"].to_dict(orient="records"),
+                        mercados=cal["mercados"].to_dict(orient="records")))
+
+
 @app.route("/", methods=["GET"])
 @app.route("/simular", methods=["GET", "POST"])
 def simular():
     resumen = None
     top_scores = []
-    current = default_params.copy()
-    odds_current = {
-        "Local": request.form.get("odds_Local", ""),
-        "Empate": request.form.get("odds_Empate", ""),
-        "Visitante": request.form.get("odds_Visitante", ""),
-        "Over 2.5": request.form.get("odds_Over 2.5", ""),
-        "Under 2.5": request.form.get("odds_Under 2.5", ""),
-        "Over 3.5": request.form.get("odds_Over 3.5", ""),
-        "Under 3.5": request.form.get("odds_Under 3.5", ""),
-        "BTTS": request.form.get("odds_BTTS", ""),
-        "BTTS No": request.form.get("odds_BTTS No", ""),
-    }
+    sens_rows = []
+    precision = None
+    interpolacion = None
+    cache_hit = None
+    current = _params_web()
+    sens_grid = dict(GRID_SENS_DEFAULT)
+    # Mercados del registro: los de siempre con su campo y otros como "mercado @ cuota"
+    odds_current = {m: request.form.get(f"odds_{m}", "") for m in MERCADOS_DEFAULT}
+    mercados_extra = request.form.get("mercados_extra", "")
+    odds_extra, mercados_desconocidos = _mercados_extra(mercados_extra)
+    odds_current.update(odds_extra)
 
     if request.method == "POST":
         form = request.form
-        p = {
-            "equipo_local": form.get("equipo_local", current["equipo_local"]),
-            "equipo_visit": form.get("equipo_visit", current["equipo_visit"]),
-            "xGF_local_prom": _to_float(form.get("xGF_local_prom"), current["xGF_local_prom"]),
-            "xGA_local_prom": _to_float(form.get("xGA_local_prom"), current["xGA_local_prom"]),
-            "xGF_visit_prom": _to_float(form.get("xGF_visit_prom"), current["xGF_visit_prom"]),
-            "xGA_visit_prom": _to_float(form.get("xGA_visit_prom"), current["xGA_visit_prom"]),
-            # Nuevos: goles últimos 10 (prom por partido)
-            "gf_local_10": _to_float(form.get("gf_local_10"), current.get("gf_local_10") or current["xGF_local_prom"]),
-            "ga_local_10": _to_float(form.get("ga_local_10"), current.get("ga_local_10") or current["xGA_local_prom"]),
-            "gf_visit_10": _to_float(form.get("gf_visit_10"), current.get("gf_visit_10") or current["xGF_visit_prom"]),
-            "ga_visit_10": _to_float(form.get("ga_visit_10"), current.get("ga_visit_10") or current["xGA_visit_prom"]),
-            # Promedio de goles totales de la liga (si se da, derivamos xG liga = goles/2)
-            "goles_liga_prom": _to_float(form.get("goles_liga_prom"), current.get("goles_liga_prom") or 2*current["xG_liga_equipo"]),
-            "xG_liga_equipo": _to_float(form.get("xG_liga_equipo"), current["xG_liga_equipo"]),
-            "HFA": _to_float(form.get("HFA"), current["HFA"]),
-            "sigma": _to_float(form.get("sigma"), current["sigma"]),
-            "n_sims": _to_int(form.get("n_sims"), current["n_sims"]),
-            "seed": current.get("seed", 42),
-        }
-
-        # Recalcular xG liga si se proporcionó goles_liga_prom válido
-        if p.get("goles_liga_prom") and p["goles_liga_prom"] > 0:
-            p["xG_liga_equipo"] = p["goles_liga_prom"] / 2.0
-        result = run_simulacion_completa(p, mostrar_graficos=False, exportar_excel=False)
+        p = _params_desde_form(form, current)
+        sens_grid = _grid_desde_form(form)
+        # Cambiar solo cuotas no re-simula: EV/Kelly/combinadas salen de las probabilidades cacheadas
+        result, cache_hit = _simular_con_cache(p, sens_grid)
         resumen = result["resumen"].to_dict()
+        sens_rows = result["sens_df"].to_dict(orient="records")
+        precision = result["precision"]
+        interpolacion = result.get("interpolacion")
         top_scores = result["top_scores"].to_dict(orient="records")
 
-        # Calcular cuotas justas y EV con odds ingresadas (si están)
-        cuotas_base = result["cuotas_base"]
-        # Convertimos a dict para fácil lookup
-        prob_map = {row["Mercado"]: row["Prob"] for _, row in cuotas_base.iterrows()}
+        # Calcular cuotas justas y EV con odds ingresadas (si están); todos los mercados
+        # salen de la matriz de marcadores cacheada (O(celdas) por mercado)
+        matriz = result["matriz"]
+        cuotas_base = cuotas_desde_matriz(matriz, list(odds_current), precision)
 
         rows = []
-        for mercado, prob in prob_map.items():
+        for fila in cuotas_base.to_dict(orient="records"):
+            mercado, prob = fila["Mercado"], fila["Prob"]
+            dev = fila.get("Devolución", 0.0)
             cuota_book_str = odds_current.get(mercado, "").strip()
             try:
                 cuota_book = float(cuota_book_str.replace(",", ".")) if cuota_book_str else None
@@ -84,72 +529,76 @@ def simular():
             row = {
                 "Mercado": mercado,
                 "Prob (sim)": prob,
+                "Error est.": fila.get("Error est."),
+                "Devolución": dev,
                 "Cuota justa": (1.0 / prob) if prob > 0 else None,
                 "Cuota book": cuota_book,
                 "Prob implícita": (1.0 / cuota_book) if cuota_book and cuota_book > 0 else None,
-                "EV": (prob * cuota_book - 1.0) if cuota_book and cuota_book > 0 else None,
+                # Con devolución (push) de asiáticos y DNB: EV = W*cuota + D - 1
+                "EV": ev(matriz, mercado, cuota_book) if cuota_book and cuota_book > 0 else None,
             }
             rows.append(row)
         cuotas_view = rows
 
+        # Calibración inversa: xG y HFA implícitos en las cuotas 1X2 (y Over/Under) ingresadas
+        calibrar_sigma = bool(form.get("calibrar_sigma"))
+        cuotas_book = {r["Mercado"]: r["Cuota book"] for r in rows if r["Cuota book"] and r["Cuota book"] > 1}
+        # sigma solo si hay algún grupo además del 1X2 (si no, queda fija)
+        ajustar_sigma = calibrar_sigma and len(grupos_complementarios(list(cuotas_book))[0]) > 1
+        try:
+            with etapa("calibracion"):
+                cal = calibrar_desde_cuotas(cuotas_book, p, ajustar_sigma=ajustar_sigma)
+            calibracion = dict(cal, comparacion=cal["comparacion"].to_dict(orient="records"))
+        except (ValueError, ArithmeticError):
+            calibracion = None
+
         # --- Sugerencias de apuestas ---
         # Criterios:
         # 1. Singles con EV>0 y prob >= 0.30 (por defecto)
-        # 2. Combinadas (2 y 3 selecciones) generadas a partir de los singles elegibles
+        # 2. Combinadas (2 a MAX_PATAS selecciones) con probabilidad conjunta, a partir de los singles elegibles
         # 3. Stake sugerido usando Kelly fraccional (25% Kelly); si EV<=0 o sin cuota -> no stake
 
         singles_elegibles = [r for r in rows if r["EV"] is not None and r["EV"] > 0 and r["Prob (sim)"] >= 0.30]
         # Ordenar por EV descendente
         singles_elegibles.sort(key=lambda x: x["EV"], reverse=True)
 
-        def kelly_fraction(p, o):
-            # Kelly = (p*o - 1)/(o - 1); usamos 25% Kelly => *0.25
-            try:
-                if p <= 0 or o <= 1:
-                    return 0.0
-                k = (p * o - 1.0) / (o - 1.0)
-                k = max(0.0, k)
-                return round(k * 0.25, 4)
-            except Exception:
-                return 0.0
-
         for r in singles_elegibles:
             if r["Cuota book"]:
-                r["Stake sugerido"] = kelly_fraction(r["Prob (sim)"], r["Cuota book"])
+                # Kelly sobre los resultados de cada celda (incluye push y medias apuestas)
+                r["Stake sugerido"] = round(0.25 * kelly(matriz, r["Mercado"], r["Cuota book"]), 4)
             else:
                 r["Stake sugerido"] = None
 
         # Limitar número mostrado de singles (p.ej. top 8)
         singles_view = singles_elegibles[:8]
 
-        # Combinadas: usar primeras 5 singles para evitar explosión
-        base_for_parlays = singles_elegibles[:5]
+        # Combinadas de 2..MAX_PATAS selecciones entre todos los singles elegibles: la
+        # probabilidad es la conjunta de la matriz de marcadores (patas correlacionadas)
+        por_mercado = {c["Mercado"]: c for c in singles_elegibles}
         combinadas = []
-        for r in range(2, 4):  # tamaños 2 y 3
-            for combo in itertools.combinations(base_for_parlays, r):
-                mercados = [c["Mercado"] for c in combo]
-                probs = [c["Prob (sim)"] for c in combo]
-                cuotas = [c["Cuota book"] for c in combo if c["Cuota book"]]
-                prob_comb = 1.0
-                for p_leg in probs:
-                    prob_comb *= p_leg
-                cuota_justa_comb = (1.0 / prob_comb) if prob_comb > 0 else None
-                cuota_book_comb = None
-                if len(cuotas) == r:  # todas tienen cuota
-                    cuota_book_comb = 1.0
-                    for o in cuotas:
-                        cuota_book_comb *= o
-                ev_comb = (prob_comb * cuota_book_comb - 1.0) if cuota_book_comb else None
-                stake_comb = kelly_fraction(prob_comb, cuota_book_comb) if cuota_book_comb and ev_comb and ev_comb > 0 else None
-                combinadas.append({
-                    "Mercados": " + ".join(mercados),
-                    "N": r,
-                    "Prob": prob_comb,
-                    "Cuota justa": cuota_justa_comb,
-                    "Cuota book": cuota_book_comb,
-                    "EV": ev_comb,
-                    "Stake sugerido": stake_comb,
-                })
+        with etapa("combinadas"):
+            lista_combinadas = prob_combinadas(result["matriz"], list(por_mercado), MAX_PATAS)
+        for mercados, prob_comb in lista_combinadas:
+            cuotas = [por_mercado[m]["Cuota book"] for m in mercados]
+            prob_indep = 1.0
+            for m in mercados:
+                prob_indep *= por_mercado[m]["Prob (sim)"]
+            cuota_book_comb = 1.0
+            for o in cuotas:
+                cuota_book_comb *= o
+            ev_comb = prob_comb * cuota_book_comb - 1.0
+            nombre_comb = " + ".join(mercados)
+            combinadas.append({
+                "Mercados": nombre_comb,
+                "N": len(mercados),
+                "Prob": prob_comb,
+                "Prob indep.": prob_indep,
+                "Cuota justa": 1.0 / prob_comb,
+                "Cuota book": cuota_book_comb,
+                "EV": ev_comb,
+                # 25% Kelly sobre la matriz (la combinada se liquida como un mercado binario)
+                "Stake sugerido": round(0.25 * kelly(matriz, nombre_comb, cuota_book_comb), 4) if ev_comb > 0 else None,
+            })
 
         # Filtrar combinadas con EV positivo
         combinadas = [c for c in combinadas if c["EV"] is not None and c["EV"] > 0]
@@ -164,16 +613,32 @@ def simular():
     else:
         cuotas_view = []
         sugerencias = {"singles": [], "combinadas": []}
+        calibracion, calibrar_sigma = None, False
 
-    return render_template(
-        "index.html",
-        resumen=resumen,
-        top_scores=top_scores,
-        current=current,
-        odds_current=odds_current,
-        cuotas=cuotas_view,
-        sugerencias=sugerencias,
-    )
+    headers = {} if cache_hit is None else {"X-Rushapo-Cache": "HIT" if cache_hit else "MISS"}
+    with etapa("render"):
+        html = render_template(
+            "index.html",
+            resumen=resumen,
+            top_scores=top_scores,
+            current=current,
+            odds_current=odds_current,
+            mercados_form=MERCADOS_DEFAULT,
+            mercados_extra=mercados_extra,
+            mercados_desconocidos=mercados_desconocidos,
+            cuotas=cuotas_view,
+            calibracion=calibracion,
+            calibrar_sigma=calibrar_sigma,
+            sugerencias=sugerencias,
+            sens=sens_rows,
+            precision=precision,
+            interpolacion=interpolacion,
+            cache_hit=cache_hit,
+            sens_grid=sens_grid,
+            params_sens=PARAMS_SENS,
+            sigma_max=SIGMA_MAX,
+        )
+    return html, headers
 
 
 if __name__ == "__main__":
@@ -0,0 +1,289 @@
+"""
+Benchmarks del simulador y del camino web (no son tests: miden tiempo y memoria).
+
+Uso:
+    python benchmark_rushapo.py correr [--tamanos 1e3,1e4,1e5,1e6,1e7] [--casos simular_mc,...]
+                                       [--salida bench.json] [--repeticiones 3] [--workers 1]
+    python benchmark_rushapo.py comparar base.json actual.json [--umbral 0.15] [--umbral-memoria 0.15]
+
+Cada caso se prepara fuera de la medición (p.ej. el DataFrame de `resumen_estadistico`)
+y corre primero una vez de calentamiento bajo tracemalloc: de ahí sale el pico de
+memoria asignada por el caso (numpy y pandas informan sus buffers a tracemalloc). Las
+repeticiones siguientes, sin tracemalloc, dan el tiempo (mediana y mínimo). Semilla y
+workers fijos: con los mismos parámetros el trabajo es idéntico entre corridas.
+
+Por encima de MAX_MUESTRAS no se guardan muestras crudas: `sim_partido_xg` y
+`resumen_estadistico` se miden por el camino streaming (`iterar_muestras` y
+`resumen_desde_matriz` sobre el histograma) y el resultado lo indica en "camino".
+La hoja "Simulaciones" de Excel no pasa de ese tope, así que ese caso se omite.
+
+`comparar` marca regresión cuando la mediana (o el pico de memoria) supera la de la
+base en más del umbral relativo y además en más de un mínimo absoluto (ruido), y
+termina con código 1 si hay alguna.
+"""
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime, timezone
+
+import numpy as np
+import pandas as pd
+
+import simulador_rushapo as sr
+
+TAMANOS_DEFAULT = (1_000, 10_000, 100_000, 1_000_000, 10_000_000)
+REPETICIONES = 3
+# Tras el calentamiento no se repite más allá de este tiempo acumulado (segundos)
+TIEMPO_MAX_CASO = 20.0
+UMBRAL = 0.15
+UMBRAL_MEMORIA = 0.15
+# Diferencias menores que esto se consideran ruido (segundos / MB)
+MIN_SEGUNDOS = 0.005
+MIN_MB = 1.0
+
+
+def _params(n, workers):
+    return dict(sr.params, n_sims=int(n), workers=workers, engine="mc")
+
+
+# ---------- CASOS ----------
+# preparar(n, workers) -> callable sin argumentos; lo que hace preparar no se mide
+
+def _caso_simular_mc(n, workers):
+    p = _params(n, workers)
+    return lambda: sr.simular_mc(p)
+
+
+def _caso_sim_partido_xg(n, workers):
+    p = _params(n, workers)
+    return lambda: sr.sim_partido_xg(p)
+
+
+def _caso_resumen_estadistico(n, workers):
+    df = sr.sim_partido_xg(_params(n, workers))
+    return lambda: sr.resumen_estadistico(df)
+
+
+# Camino streaming (más allá de MAX_MUESTRAS): los mismos sorteos bloque a bloque
+
+def _caso_sim_partido_xg_streaming(n, workers):
+    p = _params(n, workers)
+
+    def sim():
+        for g_loc, g_vis in sr.iterar_muestras(p):
+            sr.muestras_a_dataframe(g_loc, g_vis)
+    return sim
+
+
+def _caso_resumen_estadistico_streaming(n, workers):
+    matriz = sr.simular_mc(_params(n, workers))["matriz"]
+    return lambda: sr.resumen_desde_matriz(matriz)
+
+
+def _caso_run_simulacion_completa(n, workers):
+    p = _params(n, workers)
+    return lambda: sr.run_simulacion_completa(p, mostrar_graficos=False, exportar_excel=False)
+
+
+def _exportar(r, p, con_muestras):
+    fd, ruta = tempfile.mkstemp(prefix="rushapo-bench-", suffix=".xlsx")
+    os.close(fd)
+    try:
+        sr.export_rushapo_excel(p, r["resumen"], r["top_scores"], r["sens_df"], r["cuotas_base"],
+                                r["df"] if con_muestras else None, file_name=ruta, matriz=r["matriz"])
+    finally:
+        os.remove(ruta)
+
+
+def _caso_export_excel(n, workers, con_muestras=False):
+    p = _params(n, workers)
+    r = sr.run_simulacion_completa(p, mostrar_graficos=False, exportar_excel=False, devolver_muestras=con_muestras)
+    return lambda: _exportar(r, p, con_muestras)
+
+
+def _caso_export_excel_muestras(n, workers):
+    return _caso_export_excel(n, workers, con_muestras=True)
+
+
+def _caso_web_simular(n, workers):
+    # Sin cache (cada POST simula) y sin tope de n_sims del servidor
+    os.environ["RUSHAPO_CACHE"] = "off"
+    from app import app
+    app.config["MAX_SIMS"] = max(app.config["MAX_SIMS"], int(n))
+    cliente = app.test_client()
+    form = {"engine": "mc", "n_sims": str(int(n)), "odds_Local": "2.10", "odds_Over 2.5": "1.90"}
+
+    def post():
+        r = cliente.post("/simular", data=form)
+        if r.status_code != 200:
+            raise RuntimeError(f"/simular respondió {r.status_code}")
+    return post
+
+
+# nombre -> (preparar, n máximo, preparar por encima del máximo); sin el último el caso se omite
+CASOS = {
+    "simular_mc": (_caso_simular_mc, None, None),
+    "sim_partido_xg": (_caso_sim_partido_xg, sr.MAX_MUESTRAS, _caso_sim_partido_xg_streaming),
+    "resumen_estadistico": (_caso_resumen_estadistico, sr.MAX_MUESTRAS, _caso_resumen_estadistico_streaming),
+    "run_simulacion_completa": (_caso_run_simulacion_completa, None, None),
+    "export_excel": (_caso_export_excel, None, None),
+    "export_excel_muestras": (_caso_export_excel_muestras, sr.MAX_MUESTRAS, None),
+    "web_simular": (_caso_web_simular, None, None),
+}
+
+
+def medir(fn, repeticiones=REPETICIONES, tiempo_max=TIEMPO_MAX_CASO):
+    """Calentamiento con tracemalloc (pico de memoria) y luego repeticiones cronometradas."""
+    tracemalloc.start()
+    t0 = time.perf_counter()
+    fn()
+    t_calentamiento = time.perf_counter() - t0
+    _, pico = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    tiempos = []
+    for _ in range(max(1, repeticiones)):
+        t0 = time.perf_counter()
+        fn()
+        tiempos.append(time.perf_counter() - t0)
+        if sum(tiempos) > tiempo_max:
+            break
+    return {
+        "segundos": statistics.median(tiempos),
+        "min": min(tiempos),
+        "repeticiones": len(tiempos),
+        "calentamiento": t_calentamiento,
+        "pico_mb": pico / 2**20,
+    }
+
+
+def _meta(workers):
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        commit = None
+    return {
+        "fecha": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "commit": commit,
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "pandas": pd.__version__,
+        "plataforma": platform.platform(),
+        "cpus": os.cpu_count(),
+        "workers": workers,
+    }
+
+
+def correr(casos=None, tamanos=TAMANOS_DEFAULT, repeticiones=REPETICIONES, workers=1, salida=None):
+    """Corre los casos en cada tamaño y devuelve (y opcionalmente guarda) el JSON de resultados."""
+    casos = casos or list(CASOS)
+    desconocidos = [c for c in casos if c not in CASOS]
+    if desconocidos:
+        raise ValueError(f"Casos desconocidos: {desconocidos} (disponibles: {list(CASOS)})")
+    resultados = []
+    for caso in casos:
+        preparar, n_max, preparar_streaming = CASOS[caso]
+        for n in tamanos:
+            camino = "muestras" if n_max is not None else None
+            if n_max is not None and n > n_max:
+                if preparar_streaming is None:
+                    print(f"{caso:<26} n={n:>10,}  omitido (máximo {n_max:,})", flush=True)
+                    continue
+                camino = "streaming"
+            m = medir((preparar_streaming if camino == "streaming" else preparar)(n, workers), repeticiones)
+            m.update(caso=caso, n=int(n), camino=camino,
+                     sims_por_segundo=n / m["segundos"] if m["segundos"] > 0 else None)
+            resultados.append(m)
+            print(f"{caso:<26} n={n:>10,}  {m['segundos']:9.4f} s  (min {m['min']:.4f})  "
+                  f"pico {m['pico_mb']:8.1f} MB{'  [streaming]' if camino == 'streaming' else ''}", flush=True)
+    datos = {"meta": _meta(workers), "resultados": resultados}
+    if salida:
+        with open(salida, "w", encoding="utf-8") as f:
+            json.dump(datos, f, indent=2)
+        print("Resultados en", salida)
+    return datos
+
+
+def comparar(base, actual, umbral=UMBRAL, umbral_memoria=UMBRAL_MEMORIA, min_segundos=MIN_SEGUNDOS, min_mb=MIN_MB):
+    """Compara dos corridas (dicts de `correr`) caso a caso.
+
+    Devuelve un DataFrame con los cocientes actual/base y la columna "Estado"
+    ("regresión", "mejora" u "ok"); los casos de una sola corrida se omiten.
+    """
+    indice = {(r["caso"], r["n"]): r for r in base["resultados"]}
+    filas = []
+    for r in actual["resultados"]:
+        b = indice.get((r["caso"], r["n"]))
+        # Muestras en memoria y streaming no son comparables entre sí
+        if b is None or b.get("camino", r.get("camino")) != r.get("camino"):
+            continue
+        dt, dm = r["segundos"] - b["segundos"], r["pico_mb"] - b["pico_mb"]
+        lento = dt > umbral * b["segundos"] and dt > min_segundos
+        pesado = dm > umbral_memoria * b["pico_mb"] and dm > min_mb
+        rapido = -dt > umbral * b["segundos"] and -dt > min_segundos
+        filas.append({
+            "Caso": r["caso"],
+            "n": r["n"],
+            "Base s": b["segundos"],
+            "Actual s": r["segundos"],
+            "x tiempo": r["segundos"] / b["segundos"] if b["segundos"] > 0 else None,
+            "Base MB": b["pico_mb"],
+            "Actual MB": r["pico_mb"],
+            "x memoria": r["pico_mb"] / b["pico_mb"] if b["pico_mb"] > 0 else None,
+            "Estado": "regresión" if lento or pesado else ("mejora" if rapido else "ok"),
+        })
+    return pd.DataFrame(filas)
+
+
+def _tamanos(txt):
+    return tuple(int(float(t)) for t in txt.split(",") if t.strip())
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmarks de simulador_rushapo y de la app web")
+    sub = parser.add_subparsers(dest="comando", required=True)
+    pc = sub.add_parser("correr", help="corre los benchmarks y guarda un JSON")
+    pc.add_argument("--casos", type=lambda t: [c.strip() for c in t.split(",") if c.strip()],
+                    help=f"separados por coma (por defecto todos: {','.join(CASOS)})")
+    pc.add_argument("--tamanos", type=_tamanos, default=TAMANOS_DEFAULT, help="n_sims separados por coma (1e3,1e5...)")
+    pc.add_argument("--repeticiones", type=int, default=REPETICIONES)
+    pc.add_argument("--workers", type=int, default=1, help="hilos del motor Monte Carlo")
+    pc.add_argument("--salida", default="benchmark_rushapo.json")
+    pm = sub.add_parser("comparar", help="compara contra una base y marca regresiones")
+    pm.add_argument("base")
+    pm.add_argument("actual")
+    pm.add_argument("--umbral", type=float, default=UMBRAL, help="aumento relativo de tiempo tolerado")
+    pm.add_argument("--umbral-memoria", type=float, default=UMBRAL_MEMORIA, help="aumento relativo de memoria tolerado")
+    pm.add_argument("--min-segundos", type=float, default=MIN_SEGUNDOS)
+    pm.add_argument("--min-mb", type=float, default=MIN_MB)
+    args = parser.parse_args(argv)
+
+    if args.comando == "correr":
+        desconocidos = [c for c in args.casos or () if c not in CASOS]
+        if desconocidos:
+            parser.error(f"casos desconocidos: {', '.join(desconocidos)} (disponibles: {', '.join(CASOS)})")
+        correr(args.casos, args.tamanos, args.repeticiones, args.workers, args.salida)
+        return 0
+    with open(args.base, encoding="utf-8") as f:
+        base = json.load(f)
+    with open(args.actual, encoding="utf-8") as f:
+        actual = json.load(f)
+    tabla = comparar(base, actual, args.umbral, args.umbral_memoria, args.min_segundos, args.min_mb)
+    if tabla.empty:
+        print("Sin casos en común")
+        return 0
+    print(tabla.to_string(index=False, float_format=lambda x: f"{x:.4g}"))
+    regresiones = int((tabla["Estado"] == "regresión").sum())
+    print(f"\n{regresiones} regresión(es) sobre {len(tabla)} casos")
+    return 1 if regresiones else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
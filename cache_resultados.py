@@ -0,0 +1,172 @@
+"""
+Cache de resultados de simulación para la app web.
+
+La simulación solo depende de los parámetros del modelo (xG, HFA, sigma, n_sims,
+semilla, motor, grilla de sensibilidad...), no de las cuotas del bookmaker. Si el
+usuario solo cambia cuotas, EV, Kelly y combinadas se recalculan a partir de las
+probabilidades guardadas sin volver a simular.
+
+Backends:
+- CacheLRU: en memoria del proceso (LRU acotado por tamaño y TTL).
+- CacheArchivo: un archivo por entrada en un directorio local; compartido entre
+  workers de gunicorn de la misma máquina. En /dev/shm vive en memoria compartida.
+  Las entradas son pickles: el directorio tiene que ser del usuario del proceso y
+  no accesible para otros (0o700), si no, se rechaza.
+"""
+import hashlib
+import json
+import os
+import pickle
+import stat
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+
+# Claves de `p` que no afectan la simulación (no entran en la clave de cache)
+_CLAVES_IGNORADAS = {"equipo_local", "equipo_visit", "workers"}
+
+
+def _canonico(valor, decimales):
+    """Normaliza valores para la clave: floats redondeados, dicts ordenados, listas."""
+    if isinstance(valor, bool) or valor is None or isinstance(valor, str):
+        return valor
+    if isinstance(valor, (int, float)):
+        return round(float(valor), decimales)
+    if isinstance(valor, dict):
+        return {str(k): _canonico(v, decimales) for k, v in sorted(valor.items())}
+    if isinstance(valor, (list, tuple)):
+        return [_canonico(v, decimales) for v in valor]
+    return str(valor)
+
+
+def clave_simulacion(p, grid_sens=None, decimales=6):
+    """Hash estable de los parámetros de simulación canonizados y redondeados."""
+    datos = {k: v for k, v in p.items() if k not in _CLAVES_IGNORADAS}
+    datos["grid_sens"] = grid_sens
+    txt = json.dumps(_canonico(datos, decimales), sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(txt.encode("utf-8")).hexdigest()
+
+
+class CacheLRU:
+    """LRU en memoria con tamaño máximo y TTL (segundos); seguro entre hilos."""
+
+    def __init__(self, max_items=256, ttl=600):
+        self.max_items = int(max_items)
+        self.ttl = float(ttl)
+        self._datos = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, clave):
+        with self._lock:
+            item = self._datos.get(clave)
+            if item is None:
+                return None
+            t, valor = item
+            if time.time() - t > self.ttl:
+                del self._datos[clave]
+                return None
+            self._datos.move_to_end(clave)
+            return valor
+
+    def set(self, clave, valor):
+        with self._lock:
+            self._datos[clave] = (time.time(), valor)
+            self._datos.move_to_end(clave)
+            while len(self._datos) > self.max_items:
+                self._datos.popitem(last=False)
+
+    def __len__(self):
+        return len(self._datos)
+
+
+def _verificar_directorio(directorio):
+    """PermissionError si el directorio es un symlink, de otro usuario o accesible por otros.
+
+    Cualquiera que pueda escribir ahí podría dejar un pickle que el worker cargaría.
+    """
+    st = os.lstat(directorio)
+    if not stat.S_ISDIR(st.st_mode):
+        raise PermissionError(f"Directorio de cache inseguro: {directorio} no es un directorio (¿symlink?)")
+    if hasattr(os, "getuid") and st.st_uid != os.getuid():
+        raise PermissionError(f"Directorio de cache inseguro: {directorio} es de otro usuario (uid {st.st_uid})")
+    if stat.S_IMODE(st.st_mode) & 0o077:
+        raise PermissionError(f"Directorio de cache inseguro: {directorio} tiene permisos "
+                              f"{oct(stat.S_IMODE(st.st_mode))} (se requiere 0o700)")
+
+
+class CacheArchivo:
+    """Cache en disco (un pickle por clave) compartido entre procesos de la misma máquina.
+
+    La antigüedad se toma del mtime del archivo; un `get` exitoso lo renueva (LRU).
+    Las escrituras son atómicas (archivo temporal + os.replace). Por defecto el
+    directorio es por usuario (rushapo-cache-<uid>) y se verifica con `_verificar_directorio`.
+    """
+
+    def __init__(self, directorio=None, max_items=256, ttl=600):
+        if directorio is None:
+            base = "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir()
+            sufijo = f"-{os.getuid()}" if hasattr(os, "getuid") else ""
+            directorio = os.path.join(base, "rushapo-cache" + sufijo)
+        os.makedirs(directorio, mode=0o700, exist_ok=True)
+        _verificar_directorio(directorio)
+        self.directorio = directorio
+        self.max_items = int(max_items)
+        self.ttl = float(ttl)
+
+    def _ruta(self, clave):
+        return os.path.join(self.directorio, f"{clave}.pkl")
+
+    def get(self, clave):
+        ruta = self._ruta(clave)
+        try:
+            if time.time() - os.path.getmtime(ruta) > self.ttl:
+                os.remove(ruta)
+                return None
+            with open(ruta, "rb") as f:
+                valor = pickle.load(f)
+            os.utime(ruta)
+            return valor
+        except (OSError, EOFError, pickle.UnpicklingError):
+            return None
+
+    def set(self, clave, valor):
+        fd, tmp = tempfile.mkstemp(dir=self.directorio, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                pickle.dump(valor, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp, self._ruta(clave))
+        except OSError:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            return
+        self._podar()
+
+    def _podar(self):
+        """Elimina las entradas más viejas si se supera max_items."""
+        try:
+            archivos = [e for e in os.scandir(self.directorio) if e.name.endswith(".pkl")]
+        except OSError:
+            return
+        if len(archivos) <= self.max_items:
+            return
+        archivos.sort(key=lambda e: e.stat().st_mtime)
+        for e in archivos[:len(archivos) - self.max_items]:
+            try:
+                os.remove(e.path)
+            except OSError:
+                pass
+
+    def __len__(self):
+        return sum(1 for e in os.scandir(self.directorio) if e.name.endswith(".pkl"))
+
+
+def crear_cache(backend="memoria", max_items=256, ttl=600, directorio=None):
+    """Crea el cache según backend: "memoria", "archivo" o "off" (None)."""
+    if backend == "off":
+        return None
+    if backend == "archivo":
+        return CacheArchivo(directorio, max_items=max_items, ttl=ttl)
+    if backend == "memoria":
+        return CacheLRU(max_items=max_items, ttl=ttl)
+    raise ValueError(f"Backend de cache desconocido: {backend!r} (usar 'memoria', 'archivo' u 'off')")
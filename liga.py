@@ -0,0 +1,217 @@
+"""
+Simulación de temporada completa (outrights: campeón, top 4, descenso...).
+
+Cada partido pendiente se sortea con el mismo modelo que `sim_partido_xg`
+(choques lognormales sobre xG y goles Poisson), todos a la vez. En vez de sortear
+choques y luego Poisson, los goles de cada equipo se sortean por inversión de su
+pmf exacta (`pmf_goles_exacta`, la Poisson-lognormal integrada por cuadratura):
+misma distribución, con una uniforme por equipo y partido. Por bloque se sortean
+uniformes (partidos, temporadas) contra la CDF de cada partido. Puntos, goles a favor y en contra
+se acumulan por equipo con matrices de incidencia equipo x partido (goles y
+puntos por partido en int16, totales por equipo en int32), y cada temporada se ordena por puntos, diferencia de gol,
+goles a favor y sorteo. De cada bloque solo se guardan los conteos de
+posición (equipos x posiciones), así que la memoria depende del tamaño de
+bloque y no del número de temporadas.
+
+Ratings por equipo: {"xGF": .., "xGA": ..} (los mismos para local y visita) o
+por condición con las claves de `params` ("xGF_local_prom", "xGA_local_prom",
+"xGF_visit_prom", "xGA_visit_prom"). HFA, sigma, xG_liga_equipo y peso_xg
+son comunes a la liga (por defecto los de `params`).
+"""
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from simulador_rushapo import (MAX_TAM_BLOQUE, _bloques, _goles_max_auto, _map_en_ventana, lambdas_base, params,
+                               pmf_goles_exacta)
+from metricas import etapa
+
+# Partidos sorteados por bloque (partidos x temporadas): acota la memoria (~40 bytes por sorteo)
+TAM_BLOQUE_LIGA = 2_000_000
+# Masa de cola por encima de la que se corta la CDF (las uniformes no la alcanzan en la práctica)
+COLA_CDF = 1e-12
+# Criterios de desempate admitidos (en orden); el último recurso siempre es un sorteo
+DESEMPATES = ("pts", "dg", "gf")
+# Tope de |pts|, |gf| y |gc| de tabla_actual (los totales por equipo son int32)
+MAX_TABLA_ACTUAL = 1_000_000
+
+
+def _rating(equipos, equipo, clave, condicion):
+    r = equipos[equipo]
+    valor = r.get(f"{clave}_{condicion}_prom", r.get(clave))
+    if valor is None:
+        raise ValueError(f"Falta {clave} (o {clave}_{condicion}_prom) en el rating de {equipo!r}")
+    return float(valor)
+
+
+def _partido(p, equipos, local, visit):
+    """Parámetros de un partido de la liga (mismas claves que `params`)."""
+    return dict(p, equipo_local=local, equipo_visit=visit,
+                xGF_local_prom=_rating(equipos, local, "xGF", "local"),
+                xGA_local_prom=_rating(equipos, local, "xGA", "local"),
+                xGF_visit_prom=_rating(equipos, visit, "xGF", "visit"),
+                xGA_visit_prom=_rating(equipos, visit, "xGA", "visit"),
+                gf_local_10=None, ga_local_10=None, gf_visit_10=None, ga_visit_10=None)
+
+
+def _cdf_goles(lams, sigma, nodos=32):
+    """CDF (F, K) de goles de cada lambda, cortada donde la cola de todas es < COLA_CDF."""
+    K = max(_goles_max_auto(lam, sigma) for lam in lams)
+    cdf = np.cumsum([pmf_goles_exacta(lam, sigma, K, nodos) for lam in lams], axis=1)
+    K = int(np.argmax(cdf.min(axis=0) >= 1.0 - COLA_CDF)) or K
+    cdf = cdf[:, :K + 1]
+    cdf[:, -1] = 1.0
+    return cdf
+
+
+def _goles_inversa(cdf, U):
+    """Goles (F, m) int16: cuántos escalones de la CDF de cada partido quedan por debajo de U."""
+    g = np.zeros(U.shape, dtype=np.int16)
+    for k in range(cdf.shape[1] - 1):
+        g += U > cdf[:, k:k + 1]
+    return g
+
+
+def _zonas_default(T):
+    zonas = {"Campeón": (1, 1)}
+    if T >= 8:
+        zonas["Top 4"] = (1, 4)
+    if T >= 10:
+        zonas["Descenso"] = (T - 2, T)
+    return zonas
+
+
+def _simular_bloque_liga(cdf_loc, cdf_vis, incidencia, base, desempate, semilla, m):
+    """Un bloque de m temporadas: conteos de posición (T, T) y sumas de puntos y DG por equipo.
+
+    incidencia: (T, 2F) float32, 1 donde el equipo es local (columnas 0..F-1) o
+    visitante (F..2F-1) del partido; las sumas por equipo salen de un producto
+    matricial (exacto en float32 mientras los totales no pasen de 2**24).
+    """
+    rng = np.random.Generator(np.random.PCG64(semilla))
+    T, F = base.shape[0], incidencia.shape[1] // 2
+    g_loc = _goles_inversa(cdf_loc, rng.random((F, m)))
+    g_vis = _goles_inversa(cdf_vis, rng.random((F, m)))
+    pts_loc = np.where(g_loc > g_vis, 3, np.where(g_loc == g_vis, 1, 0)).astype(np.int16)
+    pts_vis = np.where(g_vis > g_loc, 3, np.where(g_loc == g_vis, 1, 0)).astype(np.int16)
+    # Acumulado por equipo (T, m): lo de cada partido va a la fila de su local y de su visitante
+    tabla = {}
+    for j, (clave, de_local, de_visit) in enumerate((("pts", pts_loc, pts_vis), ("gf", g_loc, g_vis),
+                                                     ("gc", g_vis, g_loc))):
+        acc = incidencia @ np.concatenate([de_local, de_visit]).astype(np.float32)
+        tabla[clave] = acc.astype(np.int32) + base[:, j:j + 1]
+    del g_loc, g_vis, pts_loc, pts_vis
+    tabla["dg"] = tabla["gf"] - tabla["gc"]
+    # Orden de cada temporada: lexsort usa la última clave como principal (descendente con -)
+    claves = [rng.random((m, T))] + [-tabla[k].T for k in reversed(desempate)]
+    orden = np.lexsort(claves, axis=-1)
+    posicion = np.empty_like(orden)
+    np.put_along_axis(posicion, orden, np.arange(T)[None, :], axis=1)
+    conteos = np.bincount((np.arange(T)[None, :] * T + posicion).ravel(), minlength=T * T).reshape(T, T)
+    return conteos, tabla["pts"].sum(axis=1, dtype=np.int64), tabla["dg"].sum(axis=1, dtype=np.int64)
+
+
+def simular_temporada(equipos, fixtures, n_temporadas=10_000, seed=None, tabla_actual=None, p=None,
+                      desempate=DESEMPATES, zonas=None, tam_bloque=TAM_BLOQUE_LIGA, workers=None):
+    """Simula lo que queda de una liga n_temporadas veces y devuelve las probabilidades de posición.
+
+    equipos: dict nombre -> rating (ver docstring del módulo).
+    fixtures: partidos pendientes como (local, visitante) o dicts {"local", "visitante"}.
+    tabla_actual: dict nombre -> {"pts", "gf", "gc"} ya conseguidos (por defecto 0).
+    p: parámetros comunes de la liga (HFA, sigma, xG_liga_equipo, peso_xg; por defecto `params`).
+    desempate: criterios tras los puntos, entre "dg" y "gf"; empates restantes por sorteo.
+    zonas: dict nombre -> (posición desde, hasta), 1-indexadas; por defecto campeón,
+    top 4 y descenso (tres últimos) según el tamaño de la liga.
+    Los bloques (tam_bloque sorteos = partidos x temporadas) usan Generators derivados
+    de SeedSequence(seed): el resultado es el mismo con cualquier número de workers.
+    Devuelve un dict con "posiciones" (DataFrame equipos x posiciones con probabilidades),
+    "resumen" (puntos y DG esperados, posición media y probabilidad de cada zona),
+    "n_temporadas", "segundos" y "temporadas_por_segundo".
+    """
+    t0 = time.perf_counter()
+    p = dict(params, **(p or {}))
+    nombres = list(equipos)
+    T = len(nombres)
+    if T < 2:
+        raise ValueError("La liga necesita al menos dos equipos")
+    indice = {e: i for i, e in enumerate(nombres)}
+    pares = [(f["local"], f["visitante"]) if isinstance(f, dict) else tuple(f) for f in fixtures]
+    desconocidos = sorted({e for par in pares for e in par if e not in indice})
+    if desconocidos:
+        raise ValueError(f"Equipos sin rating en el fixture: {desconocidos}")
+    desempate = ("pts",) + tuple(d for d in desempate if d != "pts")
+    if any(d not in DESEMPATES for d in desempate):
+        raise ValueError(f"Desempates admitidos: {DESEMPATES}")
+    tabla_actual = tabla_actual or {}
+    filas = [[int(tabla_actual.get(e, {}).get(k, 0)) for k in ("pts", "gf", "gc")] for e in nombres]
+    if any(abs(v) > MAX_TABLA_ACTUAL for fila in filas for v in fila):
+        raise ValueError(f"tabla_actual fuera de rango: |pts|, |gf| y |gc| deben ser <= {MAX_TABLA_ACTUAL}")
+    base = np.array(filas, dtype=np.int32)
+    n = int(n_temporadas)
+    if n < 1:
+        raise ValueError(f"n_temporadas debe ser >= 1 (recibido {n})")
+    zonas = zonas or _zonas_default(T)
+    for zona, (desde, hasta) in zonas.items():
+        if not 1 <= int(desde) <= int(hasta) <= T:
+            raise ValueError(f"Zona {zona!r} fuera de las posiciones 1..{T}: ({desde}, {hasta})")
+
+    F = len(pares)
+    local = np.array([indice[a] for a, _ in pares], dtype=np.intp)
+    visit = np.array([indice[b] for _, b in pares], dtype=np.intp)
+    sigma = float(p.get("sigma", 0.3))
+    lams = np.array([lambdas_base(_partido(p, equipos, a, b)) for a, b in pares]).reshape(F, 2)
+    cdf_loc, cdf_vis = (_cdf_goles(lams[:, j], sigma) if F else np.ones((0, 1)) for j in (0, 1))
+    tamanos = _bloques(n, max(1, min(int(tam_bloque), MAX_TAM_BLOQUE) // max(F, 1)))
+    semillas = np.random.SeedSequence(p.get("seed") if seed is None else seed).spawn(len(tamanos))
+    incidencia = np.zeros((T, 2 * F), dtype=np.float32)
+    incidencia[local, np.arange(F)] = 1.0
+    incidencia[visit, F + np.arange(F)] = 1.0
+    args = [(cdf_loc, cdf_vis, incidencia, base, desempate, s, m) for s, m in zip(semillas, tamanos)]
+    workers = max(1, min(int(workers or p.get("workers") or os.cpu_count() or 1), len(args)))
+
+    conteos = np.zeros((T, T), dtype=np.int64)
+    suma_pts = np.zeros(T, dtype=np.int64)
+    suma_dg = np.zeros(T, dtype=np.int64)
+    with etapa("liga", n * F):
+        if workers == 1:
+            resultados = (_simular_bloque_liga(*a) for a in args)
+            for cnt, pts, dg in resultados:
+                conteos += cnt; suma_pts += pts; suma_dg += dg
+        else:
+            with ThreadPoolExecutor(max_workers=workers) as pool:
+                for cnt, pts, dg in _map_en_ventana(pool, _simular_bloque_liga, args, 2 * workers):
+                    conteos += cnt; suma_pts += pts; suma_dg += dg
+
+    prob = conteos / n
+    posiciones = pd.DataFrame(prob, index=pd.Index(nombres, name="Equipo"), columns=np.arange(1, T + 1))
+    resumen = pd.DataFrame({
+        "Equipo": nombres,
+        "Pts actuales": base[:, 0].astype(int),
+        "Pts esperados": suma_pts / n,
+        "DG esperada": suma_dg / n,
+        "Posición media": prob @ np.arange(1, T + 1),
+    })
+    for zona, (desde, hasta) in zonas.items():
+        resumen[f"P({zona})"] = prob[:, int(desde) - 1:int(hasta)].sum(axis=1)
+    resumen = resumen.sort_values("Posición media", kind="stable").reset_index(drop=True)
+    dt = time.perf_counter() - t0
+    return {
+        "posiciones": posiciones,
+        "resumen": resumen,
+        "n_temporadas": n,
+        "segundos": dt,
+        "temporadas_por_segundo": n / dt if dt > 0 else None,
+    }
+
+
+def fixture_todos_contra_todos(equipos, vueltas=2):
+    """Fixture completo de ida y vuelta (o `vueltas` ruedas) entre todos los equipos."""
+    equipos = list(equipos)
+    ida = [(a, b) for i, a in enumerate(equipos) for b in equipos[i + 1:]]
+    partidos = []
+    for v in range(vueltas):
+        partidos += ida if v % 2 == 0 else [(b, a) for a, b in ida]
+    return partidos
@@ -0,0 +1,314 @@
+"""
+Registro de mercados sobre la matriz de marcadores y combinadas con probabilidad conjunta.
+
+Cada mercado se liquida celda a celda: para cada marcador (g_loc, g_vis) da la
+fracción del stake que gana y la que se devuelve (push). Con eso, cualquier precio
+sale de una sola matriz de probabilidades en O(celdas):
+
+    W = sum(P * gana), D = sum(P * devuelve)
+    EV(cuota) = W * cuota + D - 1, cuota justa = (1 - D) / W
+
+"Prob" es la probabilidad efectiva W / (1 - D) (sin contar las devoluciones), así
+que la cuota justa es 1/Prob como en los mercados binarios.
+
+Nombres admitidos (líneas en múltiplos de 0.25; las de cuarto se parten en dos
+medias apuestas, con medio acierto / media devolución):
+    Local, Empate, Visitante, 1X, X2, 12, DNB Local, DNB Visitante,
+    Over 2.5, Under 2.75, Local Over 1.5, Visitante Under 0.5,
+    AH Local -0.75, AH Visitante +0.25, Local por 2, Visitante por 3+,
+    BTTS, BTTS No, Marcador 2-1
+Se agregan otros con `registrar(patron, liquidar)`.
+
+Todas las patas de una combinada son del mismo partido, así que no son
+independientes ("Local + Over 2.5", "BTTS + Over 2.5"...): la probabilidad de la
+combinada es la masa de la matriz en la intersección de sus máscaras, no el
+producto de las probabilidades de cada pata. Una combinada de patas binarias
+también se liquida por nombre ("Local + Over 2.5"), así que `ev` y `kelly` sirven
+igual para singles y combinadas.
+"""
+import math
+import re
+from functools import lru_cache
+from itertools import combinations
+
+import numpy as np
+
+# Mercados por defecto (cuotas base y formulario web)
+MERCADOS_DEFAULT = ("Local", "Empate", "Visitante", "Over 2.5", "Under 2.5", "Over 3.5", "Under 3.5",
+                    "BTTS", "BTTS No")
+
+MAX_PATAS = 3
+# Combinaciones evaluadas por tanda (acota la memoria de las intersecciones)
+TAM_TANDA_COMBINADAS = 4096
+
+_NUM = r"([+-]?\d+(?:\.\d+)?)"
+
+
+def _linea(txt):
+    linea = float(txt)
+    if abs(linea * 4 - round(linea * 4)) > 1e-9:
+        raise ValueError(f"Línea {txt} no es múltiplo de 0.25")
+    return linea
+
+
+def _binario(condicion):
+    condicion = np.asarray(condicion, dtype=float)
+    return condicion, np.zeros_like(condicion)
+
+
+def _asiatico(valor, linea):
+    """(gana, devuelve) de una apuesta asiática que acierta si valor + linea > 0.
+
+    Línea entera: push si valor + linea == 0. Línea de cuarto (x.25 / x.75): mitad
+    del stake a cada línea vecina (linea ± 0.25).
+    """
+    if abs(linea * 2 - round(linea * 2)) > 1e-9:
+        g1, d1 = _asiatico(valor, linea - 0.25)
+        g2, d2 = _asiatico(valor, linea + 0.25)
+        return 0.5 * (g1 + g2), 0.5 * (d1 + d2)
+    x = valor + linea
+    return (x > 0).astype(float), (x == 0).astype(float)
+
+
+def _equipo(nombre, gl, gv):
+    """(goles a favor, goles en contra) del equipo "Local" o "Visitante"."""
+    return (gl, gv) if nombre == "Local" else (gv, gl)
+
+
+# (patrón, liquidar(match, gl, gv) -> (gana, devuelve)); el primero que calza gana
+_REGISTRO = []
+
+
+def registrar(patron, liquidar):
+    """Agrega un mercado: `patron` (regex completa del nombre) y `liquidar(m, gl, gv)`,
+    que devuelve (gana, devuelve) por celda a partir del match y los goles."""
+    _REGISTRO.append((re.compile(patron), liquidar))
+    liquidacion.cache_clear()
+
+
+@lru_cache(maxsize=512)
+def liquidacion(nombre, G):
+    """(gana, devuelve) del mercado `nombre` sobre la matriz GxG aplanada (solo lectura).
+
+    Lanza ValueError si el nombre no corresponde a ningún mercado registrado. Con
+    patas separadas por " + " es la combinada (AND) de mercados binarios.
+    """
+    patas = nombre.split(" + ")
+    if len(patas) > 1:
+        if not all(es_binario(p) for p in patas):
+            raise ValueError(f"Combinada con patas no binarias: {nombre!r}")
+        gana = np.logical_and.reduce([liquidacion(p, G)[0] > 0.5 for p in patas]).astype(float)
+        devuelve = np.zeros_like(gana)
+        gana.setflags(write=False); devuelve.setflags(write=False)
+        return gana, devuelve
+    gl, gv = np.divmod(np.arange(G * G), G)
+    for patron, liquidar in _REGISTRO:
+        m = patron.fullmatch(nombre.strip())
+        if m:
+            gana, devuelve = (np.asarray(a, dtype=float) for a in liquidar(m, gl, gv))
+            gana.setflags(write=False); devuelve.setflags(write=False)
+            return gana, devuelve
+    raise ValueError(f"Mercado desconocido: {nombre!r}")
+
+
+def es_binario(nombre):
+    """True si el mercado se gana o se pierde entero (sin devolución ni medias)."""
+    gana, devuelve = liquidacion(nombre, 12)
+    return not devuelve.any() and bool(np.all((gana == 0) | (gana == 1)))
+
+
+def es_valido(nombre):
+    try:
+        liquidacion(nombre, 2)
+        return True
+    except ValueError:
+        return False
+
+
+registrar(r"(Local|Empate|Visitante)",
+          lambda m, gl, gv: _binario({"Local": gl > gv, "Empate": gl == gv, "Visitante": gl < gv}[m[1]]))
+registrar(r"(1X|X2|12)",
+          lambda m, gl, gv: _binario({"1X": gl >= gv, "X2": gl <= gv, "12": gl != gv}[m[1]]))
+registrar(r"DNB (Local|Visitante)",
+          lambda m, gl, gv: _asiatico(np.subtract(*_equipo(m[1], gl, gv)), 0.0))
+registrar(r"(Over|Under) " + _NUM,
+          lambda m, gl, gv: _asiatico(gl + gv, -_linea(m[2])) if m[1] == "Over"
+          else _asiatico(-(gl + gv), _linea(m[2])))
+registrar(r"(Local|Visitante) (Over|Under) " + _NUM,
+          lambda m, gl, gv: _asiatico(_equipo(m[1], gl, gv)[0], -_linea(m[3])) if m[2] == "Over"
+          else _asiatico(-_equipo(m[1], gl, gv)[0], _linea(m[3])))
+registrar(r"AH (Local|Visitante) " + _NUM,
+          lambda m, gl, gv: _asiatico(np.subtract(*_equipo(m[1], gl, gv)), _linea(m[2])))
+registrar(r"(Local|Visitante) por (\d+)(\+?)",
+          lambda m, gl, gv: _binario(np.subtract(*_equipo(m[1], gl, gv)) >= int(m[2]) if m[3]
+                                     else np.subtract(*_equipo(m[1], gl, gv)) == int(m[2])))
+registrar(r"BTTS( No)?",
+          lambda m, gl, gv: _binario(((gl > 0) & (gv > 0)) != bool(m[1])))
+registrar(r"Marcador (\d+)-(\d+)",
+          lambda m, gl, gv: _binario((gl == int(m[1])) & (gv == int(m[2]))))
+
+
+def _probabilidades(matriz):
+    P = np.asarray(matriz, dtype=float).ravel()
+    return P / P.sum()
+
+
+def evaluar(matriz, nombres=MERCADOS_DEFAULT, n=None):
+    """Precio de cada mercado desde la matriz de marcadores (conteos o probabilidades).
+
+    Devuelve {nombre: {"Prob", "Devolución", "Cuota justa", "W", "Error est."}}; el
+    error estándar (binomial, por simulación del pago) solo si se da n (simulaciones).
+    """
+    P = _probabilidades(matriz)
+    G = int(math.isqrt(P.size))
+    salida = {}
+    for nombre in nombres:
+        gana, devuelve = liquidacion(nombre, G)
+        W, D = float(gana @ P), float(devuelve @ P)
+        prob = W / (1.0 - D) if D < 1.0 else 0.0
+        fila = {"Prob": prob, "Devolución": D, "Cuota justa": (1.0 - D) / W if W > 0 else None, "W": W,
+                "Error est.": None}
+        if n:
+            var = max(float((gana**2) @ P) - W**2, 0.0)
+            fila["Error est."] = math.sqrt(var / n) / (1.0 - D) if D < 1.0 else 0.0
+        salida[nombre] = fila
+    return salida
+
+
+def prob_mercados(matriz, nombres=MERCADOS_DEFAULT):
+    """Probabilidad efectiva (ver `evaluar`) de cada mercado."""
+    return {k: v["Prob"] for k, v in evaluar(matriz, nombres).items()}
+
+
+def ev(matriz, nombre, cuota):
+    """Valor esperado por unidad apostada: W * cuota + D - 1."""
+    P = _probabilidades(matriz)
+    gana, devuelve = liquidacion(nombre, int(math.isqrt(P.size)))
+    return float(gana @ P) * cuota + float(devuelve @ P) - 1.0
+
+
+def kelly(matriz, nombre, cuota, iteraciones=60):
+    """Fracción de Kelly completa: maximiza E[log(1 + f * r)] con r = gana*cuota + devuelve - 1
+    por celda. Con mercados binarios coincide con (p*o - 1)/(o - 1); con push y medias
+    apuestas (asiáticos) tiene en cuenta cada resultado posible."""
+    P = _probabilidades(matriz)
+    gana, devuelve = liquidacion(nombre, int(math.isqrt(P.size)))
+    r = gana * cuota + devuelve - 1.0
+    valores, inv = np.unique(np.round(r, 12), return_inverse=True)
+    w = np.bincount(inv, weights=P, minlength=len(valores))
+    valores, w = valores[w > 0], w[w > 0]
+    if valores.size == 0 or w @ valores <= 0:
+        return 0.0
+    if valores.min() >= 0:
+        return 1.0
+    lo, hi = 0.0, (1.0 / -valores.min()) * (1 - 1e-9)
+    for _ in range(iteraciones):
+        f = 0.5 * (lo + hi)
+        if w @ (valores / (1.0 + f * valores)) > 0:
+            lo = f
+        else:
+            hi = f
+    return min(lo, 1.0)
+
+
+def _biseccion(f, lo, hi, iteraciones=100):
+    """Raíz de f creciente en [lo, hi]."""
+    for _ in range(iteraciones):
+        m = 0.5 * (lo + hi)
+        if f(m) > 0:
+            hi = m
+        else:
+            lo = m
+    return 0.5 * (lo + hi)
+
+
+def quitar_margen(cuotas, metodo="potencia"):
+    """Probabilidades justas de un grupo de resultados excluyentes (1X2, Over/Under de una línea...).
+
+    cuotas: lista de cuotas decimales del book que cubren todos los resultados.
+    metodo: "proporcional" (1/cuota normalizada), "potencia" (p_i = (1/cuota_i)^k con
+    suma 1; saca más margen de los no favoritos) o "shin" (modelo de Shin con
+    apostadores informados). Devuelve (probabilidades, margen), margen = sum(1/cuota) - 1.
+    """
+    pi = 1.0 / np.asarray(cuotas, dtype=float)
+    if pi.size < 2 or not np.all(np.isfinite(pi)) or np.any(pi <= 0) or np.any(pi >= 1):
+        raise ValueError(f"Cuotas inválidas para quitar el margen: {list(cuotas)}")
+    margen = float(pi.sum() - 1.0)
+    if metodo == "proporcional" or margen <= 0:
+        return pi / pi.sum(), margen
+    if metodo == "potencia":
+        k = _biseccion(lambda k: -(pi**k).sum() + 1.0, 1.0, 50.0)
+        return pi**k / (pi**k).sum(), margen
+    if metodo == "shin":
+        total = pi.sum()
+
+        def prob(z):
+            return (np.sqrt(z**2 + 4.0 * (1.0 - z) * pi**2 / total) - z) / (2.0 * (1.0 - z))
+        z = _biseccion(lambda z: -prob(z).sum() + 1.0, 0.0, 0.999)
+        p = prob(z)
+        return p / p.sum(), margen
+    raise ValueError(f"Método desconocido: {metodo!r} (usar 'proporcional', 'potencia' o 'shin')")
+
+
+def grupos_complementarios(nombres):
+    """Agrupa los mercados que cubren todos los resultados: 1X2, "Over N"/"Under N" y BTTS/BTTS No.
+
+    Devuelve (lista de grupos, nombres que no completan ningún grupo).
+    """
+    nombres = [" ".join(n.split()) for n in nombres]
+    grupos = []
+    if all(m in nombres for m in ("Local", "Empate", "Visitante")):
+        grupos.append(["Local", "Empate", "Visitante"])
+    for n in nombres:
+        m = re.fullmatch(r"Over " + _NUM, n)
+        if m and f"Under {m[1]}" in nombres:
+            grupos.append([n, f"Under {m[1]}"])
+    if "BTTS" in nombres and "BTTS No" in nombres:
+        grupos.append(["BTTS", "BTTS No"])
+    usados = {n for g in grupos for n in g}
+    return grupos, [n for n in nombres if n not in usados]
+
+
+def mascaras(nombres, G):
+    """Máscaras booleanas (len(nombres), G*G) de mercados binarios."""
+    return _mascaras(tuple(nombres), G)
+
+
+@lru_cache(maxsize=64)
+def _mascaras(nombres, G):
+    M = np.stack([liquidacion(n, G)[0] > 0.5 for n in nombres])
+    M.setflags(write=False)
+    return M
+
+
+def combinadas(matriz, patas, max_patas=MAX_PATAS, tam_tanda=TAM_TANDA_COMBINADAS):
+    """Probabilidad conjunta de todas las combinaciones de 2..max_patas patas.
+
+    patas: nombres de mercados; solo entran los binarios (los que tienen push o medias
+    apuestas, como asiáticos o DNB, se omiten). Cada tamaño k se evalúa vectorizado:
+    las máscaras de las combinaciones (n, k, celdas) se reducen con AND y se ponderan
+    con la matriz. Se descartan las combinaciones imposibles (probabilidad 0) y las
+    redundantes (una pata implicada por las demás, p.ej. "Over 2.5 + Over 3.5"), que
+    el book no aceptaría. Devuelve una lista de (tupla de patas, probabilidad conjunta).
+    """
+    patas = tuple(p for p in dict.fromkeys(patas) if es_binario(p))
+    if len(patas) < 2:
+        return []
+    P = _probabilidades(matriz)
+    M = mascaras(patas, int(math.isqrt(P.size)))
+    # Probabilidad por subconjunto (índices ordenados); los de tamaño 1 son las marginales
+    prob = {(i,): float(q) for i, q in enumerate(M @ P)}
+    salida = []
+    for k in range(2, min(max_patas, len(patas)) + 1):
+        idx = np.array(list(combinations(range(len(patas)), k)), dtype=np.intp)
+        probs = np.concatenate([np.logical_and.reduce(M[idx[i:i + tam_tanda]], axis=1) @ P
+                                for i in range(0, len(idx), tam_tanda)])
+        for combo, q in zip(map(tuple, idx.tolist()), probs.tolist()):
+            prob[combo] = q
+            if q <= 0:
+                continue
+            # Redundante si quitar alguna pata no cambia la probabilidad
+            if any(abs(prob[sub] - q) <= 1e-12 for sub in combinations(combo, k - 1)):
+                continue
+            salida.append((tuple(patas[i] for i in combo), q))
+    return salida
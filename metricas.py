@@ -0,0 +1,232 @@
+"""
+Instrumentación liviana: duración por etapa, histogramas y exposición Prometheus.
+
+- `etapa(nombre, n)`: context manager que mide una etapa del camino caliente
+  (simulación base, sensibilidad, combinadas, render...). Cada medición va al
+  histograma `rushapo_etapa_segundos{etapa=...}` y, si hay un request en curso
+  (`iniciar_request`), a su lista de etapas para el header `Server-Timing`.
+  Las etapas con n (simulaciones) alimentan además simulaciones/segundo.
+- `Histograma`, `Contador`: métricas en memoria del proceso, seguras entre hilos.
+- `exposicion()`: texto en formato Prometheus (para GET /metrics).
+
+Sin dependencias externas (no usa prometheus_client). Las métricas son por
+proceso: con varios workers de gunicorn cada uno expone las suyas.
+"""
+import contextvars
+import math
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+BUCKETS_SEGUNDOS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+BUCKETS_SIMS_SEG = (1e4, 3e4, 1e5, 3e5, 1e6, 3e6, 1e7, 3e7, 1e8)
+
+# Descripción de cada etapa en Server-Timing
+DESCRIPCIONES = {
+    "sim": "Simulación base",
+    "sens": "Sensibilidad",
+    "resumen": "Resumen",
+    "top": "Top marcadores",
+    "cuotas": "Cuotas",
+    "excel": "Excel",
+    "lote": "Lote de partidos",
+    "liga": "Temporada",
+    "cache": "Cache",
+    "combinadas": "Combinadas",
+    "calibracion": "Calibración",
+    "render": "Render HTML",
+}
+
+# Etapas del request en curso (None fuera de un request instrumentado)
+_etapas_request = contextvars.ContextVar("rushapo_etapas", default=None)
+
+
+def _escapar(valor):
+    return str(valor).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _etiquetas(nombres, valores):
+    if not nombres:
+        return ""
+    pares = ",".join(f'{k}="{_escapar(v)}"' for k, v in zip(nombres, valores))
+    return "{" + pares + "}"
+
+
+class Contador:
+    """Contador monótono con etiquetas opcionales."""
+
+    tipo = "counter"
+
+    def __init__(self, nombre, ayuda, etiquetas=()):
+        self.nombre, self.ayuda, self.etiquetas = nombre, ayuda, tuple(etiquetas)
+        self._valores = {}
+        self._lock = threading.Lock()
+
+    def inc(self, valor=1.0, *etiquetas):
+        with self._lock:
+            self._valores[etiquetas] = self._valores.get(etiquetas, 0.0) + valor
+
+    def muestras(self):
+        with self._lock:
+            return [(self.nombre + _etiquetas(self.etiquetas, k), v) for k, v in sorted(self._valores.items())]
+
+
+class Histograma:
+    """Histograma acumulado (buckets fijos, suma y cantidad) con etiquetas opcionales."""
+
+    tipo = "histogram"
+
+    def __init__(self, nombre, ayuda, buckets=BUCKETS_SEGUNDOS, etiquetas=()):
+        self.nombre, self.ayuda, self.etiquetas = nombre, ayuda, tuple(etiquetas)
+        self.buckets = tuple(sorted(buckets))
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observar(self, valor, *etiquetas):
+        with self._lock:
+            serie = self._series.get(etiquetas)
+            if serie is None:
+                serie = self._series[etiquetas] = [[0] * len(self.buckets), 0.0, 0]
+            for i, limite in enumerate(self.buckets):
+                if valor <= limite:
+                    serie[0][i] += 1
+            serie[1] += valor
+            serie[2] += 1
+
+    def muestras(self):
+        salida = []
+        with self._lock:
+            for k, (cuentas, suma, total) in sorted(self._series.items()):
+                for limite, c in zip(self.buckets, cuentas):
+                    salida.append((self.nombre + "_bucket" + _etiquetas(self.etiquetas + ("le",), k + (repr(limite),)), c))
+                salida.append((self.nombre + "_bucket" + _etiquetas(self.etiquetas + ("le",), k + ("+Inf",)), total))
+                salida.append((self.nombre + "_sum" + _etiquetas(self.etiquetas, k), suma))
+                salida.append((self.nombre + "_count" + _etiquetas(self.etiquetas, k), total))
+        return salida
+
+
+class Medidor:
+    """Valor instantáneo calculado al exponer (p.ej. memoria o entradas del cache)."""
+
+    tipo = "gauge"
+
+    def __init__(self, nombre, ayuda, funcion):
+        self.nombre, self.ayuda, self.funcion = nombre, ayuda, funcion
+
+    def muestras(self):
+        valor = self.funcion()
+        return [] if valor is None else [(self.nombre, valor)]
+
+
+_REGISTRO = []
+
+
+def registrar(metrica):
+    _REGISTRO.append(metrica)
+    return metrica
+
+
+ETAPAS = registrar(Histograma("rushapo_etapa_segundos", "Duración de cada etapa", etiquetas=("etapa",)))
+REQUESTS = registrar(Histograma("rushapo_request_segundos", "Latencia de los requests",
+                                etiquetas=("ruta", "metodo", "estado")))
+SIMS_POR_SEGUNDO = registrar(Histograma("rushapo_sims_por_segundo", "Simulaciones por segundo de cada corrida",
+                                        BUCKETS_SIMS_SEG, etiquetas=("etapa",)))
+SIMULACIONES = registrar(Contador("rushapo_simulaciones_total", "Simulaciones (o partidos x simulaciones) corridas",
+                                  etiquetas=("etapa",)))
+CACHE = registrar(Contador("rushapo_cache_total", "Consultas al cache de resultados", etiquetas=("resultado",)))
+TABLA = registrar(Contador("rushapo_tabla_total", "Matrices del motor tabla por fuente (tabla o exacto en vivo)",
+                           etiquetas=("fuente",)))
+
+
+def memoria_rss():
+    """Memoria residente actual del proceso en bytes (None si no se puede leer)."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError):
+        return None
+
+
+def memoria_pico():
+    """Memoria residente máxima del proceso en bytes."""
+    try:
+        import resource
+    except ImportError:
+        return None
+    pico = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux informa KB; macOS, bytes
+    return pico if os.uname().sysname == "Darwin" else pico * 1024
+
+
+registrar(Medidor("rushapo_memoria_rss_bytes", "Memoria residente del proceso", memoria_rss))
+registrar(Medidor("rushapo_memoria_pico_bytes", "Memoria residente máxima del proceso", memoria_pico))
+
+
+def registrar_etapa(nombre, segundos, n=None):
+    """Anota una etapa medida: histograma global y, si hay request en curso, Server-Timing."""
+    ETAPAS.observar(segundos, nombre)
+    if n:
+        SIMULACIONES.inc(n, nombre)
+        if segundos > 0:
+            SIMS_POR_SEGUNDO.observar(n / segundos, nombre)
+    etapas = _etapas_request.get()
+    if etapas is not None:
+        etapas.append((nombre, segundos, n))
+
+
+@contextmanager
+def etapa(nombre, n=None):
+    """Mide el bloque como la etapa `nombre`; `info["n"]` puede fijarse dentro del bloque."""
+    info = {"n": n}
+    t0 = time.perf_counter()
+    try:
+        yield info
+    finally:
+        registrar_etapa(nombre, time.perf_counter() - t0, info["n"])
+
+
+def iniciar_request():
+    """Empieza a juntar las etapas del request actual; devuelve el token para `terminar_request`."""
+    return _etapas_request.set([])
+
+
+def terminar_request(token):
+    """Deja de juntar etapas y devuelve la lista [(nombre, segundos, n)] del request."""
+    etapas = _etapas_request.get() or []
+    _etapas_request.reset(token)
+    return etapas
+
+
+def server_timing(etapas, total=None):
+    """Valor del header Server-Timing; etapas repetidas (p.ej. dos simulaciones) se suman."""
+    agregadas = {}
+    for nombre, segundos, n in etapas:
+        s, m = agregadas.get(nombre, (0.0, 0))
+        agregadas[nombre] = (s + segundos, m + (n or 0))
+    partes = []
+    for nombre, (segundos, n) in agregadas.items():
+        desc = DESCRIPCIONES.get(nombre, nombre) + (f" (n={n})" if n else "")
+        partes.append(f'{nombre};desc="{desc}";dur={segundos * 1000:.2f}')
+    if total is not None:
+        partes.append(f'total;dur={total * 1000:.2f}')
+    return ", ".join(partes)
+
+
+def _numero(v):
+    if isinstance(v, float) and math.isinf(v):
+        return "+Inf" if v > 0 else "-Inf"
+    return repr(float(v)) if isinstance(v, float) else str(v)
+
+
+def exposicion():
+    """Todas las métricas registradas en formato de texto Prometheus 0.0.4."""
+    lineas = []
+    for m in _REGISTRO:
+        muestras = m.muestras()
+        if not muestras and m.tipo == "gauge":
+            continue
+        lineas.append(f"# HELP {m.nombre} {m.ayuda}")
+        lineas.append(f"# TYPE {m.nombre} {m.tipo}")
+        lineas.extend(f"{k} {_numero(v)}" for k, v in muestras)
+    return "\n".join(lineas) + "\n"
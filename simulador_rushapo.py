@@ -11,15 +11,28 @@ Mejoras realizadas:
 """
 import numpy as np
 import pandas as pd
-import matplotlib.pyplot as plt
-import seaborn as sns
+import math
+import os
+import time
+from collections import deque
+from contextlib import nullcontext
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from datetime import datetime
+from functools import lru_cache
 from itertools import product
 
-try:
-    from google.colab import files
-except:
-    files = None
+import mercados
+from metricas import TABLA, etapa
+
+# matplotlib/seaborn, xlsxwriter y google.colab se importan solo al usarse
+# (gráficos, Excel, descarga en Colab): la app web no los carga.
+def _colab_files():
+    """Módulo google.colab.files si se ejecuta en Colab, o None."""
+    try:
+        from google.colab import files
+        return files
+    except Exception:
+        return None
 
 # ---------- PARÁMETROS DE ENTRADA (ejemplo por defecto) ----------
 params = {
@@ -40,241 +53,1422 @@ params = {
     "HFA": 1.09,
     "sigma": 0.3,
     "n_sims": 10000,
-    "seed": 42
+    "seed": 42,
+    # Peso del xG al mezclar con goles recientes (el resto va a gf/ga_10)
+    "peso_xg": 0.7,
+    # Hilos para el motor Monte Carlo por bloques (None = núcleos disponibles)
+    "workers": None,
+    # Parada adaptativa (opcional): error estándar objetivo por mercado; n_sims = presupuesto
+    "se_objetivo": None,
+    # Reducción de varianza (Monte Carlo): None, "antitetico", "qmc" o "control"
+    "reduccion_varianza": None,
+    # Motor: "mc" (Monte Carlo) o "exact" (cuadratura, sin ruido de muestreo)
+    "engine": "mc"
 }
+# Tope de sigma aceptado desde la web y la API (más allá la cola de goles deja de ser realista)
+SIGMA_MAX = 1.5
 
 # ---------- FUNCIONES ----------
-def shock_lognormal(size, sigma):
+def shock_lognormal(size, sigma, rng=None):
     """Devuelve choques multiplicativos lognormales con media 1.
 
     mean(log) = -0.5*sigma^2 asegura E[shock]=1.
+    rng: np.random.Generator a usar (uno nuevo sin semilla si es None).
     """
+    rng = rng if rng is not None else np.random.default_rng()
     mu = -0.5 * sigma**2
-    return np.random.lognormal(mean=mu, sigma=sigma, size=size)
+    return rng.lognormal(mean=mu, sigma=sigma, size=size)
 
-def sim_partido_xg(p):
-    """Simula marcadores g_loc y g_vis a partir de parámetros tipo xG.
+def _blend(xg, goles, peso=0.7):
+    """Mezcla xG con goles recientes (prom últimos 10) si están disponibles."""
+    try:
+        return peso * float(xg) + (1.0 - peso) * float(goles)
+    except (TypeError, ValueError):
+        return float(xg)
 
-    p: dict con claves esperadas
-       - xGF_local_prom, xGA_local_prom, xGF_visit_prom, xGA_visit_prom
-       - xG_liga_equipo, HFA, sigma, n_sims, seed
+def xg_ajustados(p):
+    """Devuelve (xGF_local, xGA_local, xGF_visit, xGA_visit) mezclados con goles recientes.
+
+    El peso del xG en la mezcla es p["peso_xg"] (0.7 por defecto).
     """
-    if p.get("seed") is not None:
-        np.random.seed(p["seed"])
-    n = int(p.get("n_sims", 10000))
-    sigma = float(p.get("sigma", 0.3))
-    HFA = float(p.get("HFA", 1.0))
-    xG_liga = float(p.get("xG_liga_equipo", 1.0)) or 1.0
+    peso = p.get("peso_xg")
+    peso = 0.7 if peso is None else float(peso)
+    return (
+        _blend(p.get("xGF_local_prom"), p.get("gf_local_10"), peso),
+        _blend(p.get("xGA_local_prom"), p.get("ga_local_10"), peso),
+        _blend(p.get("xGF_visit_prom"), p.get("gf_visit_10"), peso),
+        _blend(p.get("xGA_visit_prom"), p.get("ga_visit_10"), peso),
+    )
 
-    # Mezcla xG con goles recientes (prom últimos 10) si están disponibles
-    def _blend(xg, goles):
-        try:
-            return 0.7 * float(xg) + 0.3 * float(goles)
-        except (TypeError, ValueError):
-            return float(xg)
+def _constantes_lambdas(p):
+    """(sigma, HFA, xG_liga, xGF_local, xGA_local, xGF_visit, xGA_visit) ajustados del partido p."""
+    return (float(p.get("sigma", 0.3)), float(p.get("HFA", 1.0)),
+            float(p.get("xG_liga_equipo", 1.0)) or 1.0, *xg_ajustados(p))
 
-    xGF_local_adj = _blend(p.get("xGF_local_prom"), p.get("gf_local_10"))
-    xGA_local_adj = _blend(p.get("xGA_local_prom"), p.get("ga_local_10"))
-    xGF_visit_adj = _blend(p.get("xGF_visit_prom"), p.get("gf_visit_10"))
-    xGA_visit_adj = _blend(p.get("xGA_visit_prom"), p.get("ga_visit_10"))
+def _lambdas_choques(c, Z):
+    """Tasas de gol a partir de constantes `c` (ver `_constantes_lambdas`) y normales Z.
+
+    Las constantes pueden ser escalares o arrays que hacen broadcast con Z[0]
+    (p.ej. (F, 1) contra Z de forma (4, F, n) para un lote de F partidos).
+    """
+    sigma, HFA, xG_liga, xGF_local_adj, xGA_local_adj, xGF_visit_adj, xGA_visit_adj = c
 
-    # Ajuste con choques lognormales
-    xGF_loc_draw = xGF_local_adj * shock_lognormal(n, sigma)
-    xGA_vis_draw = xGA_visit_adj * shock_lognormal(n, sigma)
-    xGF_vis_draw = xGF_visit_adj * shock_lognormal(n, sigma)
-    xGA_loc_draw = xGA_local_adj * shock_lognormal(n, sigma)
+    # Ajuste con choques lognormales de media 1: exp(-sigma^2/2 + sigma*Z)
+    shocks = np.exp(-0.5 * sigma**2 + sigma * Z)
+    xGF_loc_draw = xGF_local_adj * shocks[0]
+    xGA_vis_draw = xGA_visit_adj * shocks[1]
+    xGF_vis_draw = xGF_visit_adj * shocks[2]
+    xGA_loc_draw = xGA_local_adj * shocks[3]
+    del shocks
 
     lam_loc = np.clip(HFA * (xGF_loc_draw * xGA_vis_draw) / xG_liga, 1e-6, None)
     lam_vis = np.clip((1.0/HFA) * (xGF_vis_draw * xGA_loc_draw) / xG_liga, 1e-6, None)
+    return lam_loc, lam_vis
+
+def lambdas_desde_normales(p, Z):
+    """Tasas de gol (lam_loc, lam_vis) a partir de normales estándar Z (4, n).
+
+    Filas de Z: choques de xGF local, xGA visit, xGF visit, xGA local.
+    """
+    return _lambdas_choques(_constantes_lambdas(p), Z)
+
+# ---------- REDUCCIÓN DE VARIANZA ----------
+# Mercados cuyo error se sigue (precisión, ESS); el resto son complementos
+MERCADOS_PRECISION = ("% Local", "% Empate", "% Visitante", "% Over 2.5", "% Over 3.5", "% BTTS")
+_MERCADO_A_PRECISION = {"Local": "% Local", "Empate": "% Empate", "Visitante": "% Visitante",
+                        "Over 2.5": "% Over 2.5", "Under 2.5": "% Over 2.5", "Over 3.5": "% Over 3.5",
+                        "Under 3.5": "% Over 3.5", "BTTS": "% BTTS", "BTTS No": "% BTTS"}
+MODOS_VR = (None, "antitetico", "qmc", "control")
+# Réplicas mínimas de QMC aleatorizado (cada bloque es una réplica independiente)
+RQMC_REPLICAS = 8
+# Sobol: (s, a, m_1..m_s) de Joe–Kuo (new-joe-kuo-6.21201) para las dimensiones 2..6
+_SOBOL_JOE_KUO = ((1, 0, (1,)), (2, 1, (1, 3)), (3, 1, (1, 3, 1)), (3, 2, (1, 1, 1)), (4, 1, (1, 1, 3, 3)))
+
+@lru_cache(maxsize=1)
+def _direcciones_sobol(bits=32):
+    """Números de dirección (6, bits) uint32 de la secuencia de Sobol."""
+    V = [[1 << (bits - 1 - i) for i in range(bits)]]
+    for s, a, m in _SOBOL_JOE_KUO:
+        v = [0] * (bits + 1)
+        for i in range(1, s + 1):
+            v[i] = m[i - 1] << (bits - i)
+        for i in range(s + 1, bits + 1):
+            v[i] = v[i - s] ^ (v[i - s] >> s)
+            for k in range(1, s):
+                v[i] ^= ((a >> (s - 1 - k)) & 1) * v[i - k]
+        V.append(v[1:])
+    return np.array(V, dtype=np.uint32)
+
+def sobol_desplazado(m, rng, dims=6):
+    """m puntos de Sobol en (0, 1)^dims con desplazamiento digital aleatorio (RQMC)."""
+    V = _direcciones_sobol()[:dims]
+    idx = np.arange(m, dtype=np.uint32)
+    X = np.zeros((dims, m), dtype=np.uint32)
+    for j in range(max(int(m - 1).bit_length(), 1)):
+        X ^= V[:, j:j + 1] * ((idx >> np.uint32(j)) & np.uint32(1))
+    X ^= rng.integers(0, 2**32, size=(dims, 1), dtype=np.uint32)
+    return (X + 0.5) / 2.0**32
+
+def _normal_inversa(u):
+    """Inversa de la CDF normal estándar (algoritmo de Acklam, error relativo < 1.2e-9)."""
+    a = (-3.969683028665376e+01, 2.209460984245205e+02, -2.759285104469687e+02,
+         1.383577518672690e+02, -3.066479806614716e+01, 2.506628277459239e+00)
+    b = (-5.447609879822406e+01, 1.615858368580409e+02, -1.556989798598866e+02,
+         6.680131188771972e+01, -1.328068155288572e+01)
+    c = (-7.784894002430293e-03, -3.223964580411365e-01, -2.400758277161838e+00,
+         -2.549732539343734e+00, 4.374664141464968e+00, 2.938163982698783e+00)
+    d = (7.784695709041462e-03, 3.224671290700398e-01, 2.445134137142996e+00, 3.754408661907416e+00)
+    u = np.asarray(u, dtype=float)
+    x = np.empty_like(u)
+    bajo = u < 0.02425
+    alto = u > 1 - 0.02425
+    medio = ~(bajo | alto)
+    q = u[medio] - 0.5; r = q * q
+    x[medio] = ((((((a[0]*r + a[1])*r + a[2])*r + a[3])*r + a[4])*r + a[5]) * q /
+                (((((b[0]*r + b[1])*r + b[2])*r + b[3])*r + b[4])*r + 1))
+    for mask, signo, uu in ((bajo, 1.0, u[bajo]), (alto, -1.0, 1 - u[alto])):
+        q = np.sqrt(-2 * np.log(uu))
+        x[mask] = signo * ((((((c[0]*q + c[1])*q + c[2])*q + c[3])*q + c[4])*q + c[5]) /
+                           ((((d[0]*q + d[1])*q + d[2])*q + d[3])*q + 1))
+    return x
+
+def _poisson_inversa(lam, U, goles_max=None):
+    """Goles Poisson(lam) por inversión de la CDF con uniformes U (mantiene la estructura QMC).
+
+    Los sorteos por encima de goles_max (por defecto GOLES_MAX_MC) quedan en goles_max.
+    """
+    goles_max = GOLES_MAX_MC if goles_max is None else goles_max
+    g = np.zeros(lam.shape, dtype=np.int16)
+    pmf = np.exp(-lam)
+    cdf = pmf.copy()
+    idx = np.flatnonzero(cdf < U)
+    pmf, cdf, lam_a, U_a = pmf[idx], cdf[idx], lam[idx], U[idx]
+    k = 0
+    while idx.size and k < goles_max:
+        k += 1
+        pmf *= lam_a / k
+        cdf += pmf
+        g[idx] = k
+        sigue = cdf < U_a
+        idx, pmf, cdf, lam_a, U_a = idx[sigue], pmf[sigue], cdf[sigue], lam_a[sigue], U_a[sigue]
+    return g
+
+@lru_cache(maxsize=8)
+def _mascaras_mercados(G):
+    """Máscaras (len(MERCADOS_PRECISION), G*G) de cada mercado sobre las celdas de marcador."""
+    gl, gv = np.divmod(np.arange(G * G), G)
+    tot = gl + gv
+    return np.array([gl > gv, gl == gv, gl < gv, tot > 2, tot > 3, (gl > 0) & (gv > 0)], dtype=float)
+
+def _indicadores_mercados(g_loc, g_vis):
+    """Indicadores por muestra (len(MERCADOS_PRECISION), n) en el orden de MERCADOS_PRECISION."""
+    tot = g_loc + g_vis
+    return np.array([g_loc > g_vis, g_loc == g_vis, g_loc < g_vis, tot > 2, tot > 3,
+                     (g_loc > 0) & (g_vis > 0)], dtype=float)
+
+# ---------- MOTOR MONTE CARLO POR BLOQUES ----------
+TAM_BLOQUE = 250_000
+# Tope de goles por equipo (el mismo de `_goles_max_auto`): los sorteos mayores caen en
+# la celda de desborde goles = GOLES_MAX_MC, así el histograma es a lo sumo G_MAX_MC x G_MAX_MC
+GOLES_MAX_MC = 200
+G_MAX_MC = GOLES_MAX_MC + 1
+# Tope duro por bloque: acota la memoria pico (~100 bytes por simulación en vuelo)
+MAX_TAM_BLOQUE = 2_000_000
+# Máximo de muestras crudas que se guardan (límite de filas de una hoja de Excel)
+MAX_MUESTRAS = 1_048_575
+BINS_CHOQUES = 256
+_RANGO_CHOQUES = 6.0
+
+# Pico de memoria medido por simulación de un bloque (tracemalloc), según el modo
+BYTES_POR_SIM = {None: 96, "antitetico": 125, "qmc": 214, "control": 148}
+# Y por celda del histograma (histograma, acumulados, máscaras de mercados y, en modo
+# "control", las sumas por celda), medido con G = G_MAX_MC y redondeado hacia arriba
+BYTES_POR_CELDA = {None: 64, "antitetico": 64, "qmc": 96, "control": 256}
+TAM_BLOQUE_MIN = 1_000
+
+def memoria_bloque(p, tam_bloque):
+    """Pico estimado en bytes de un bloque de tam_bloque simulaciones en el peor caso
+    de goles (histograma de G_MAX_MC x G_MAX_MC)."""
+    modo = p.get("reduccion_varianza")
+    por_sim = BYTES_POR_SIM.get(modo, max(BYTES_POR_SIM.values()))
+    por_celda = BYTES_POR_CELDA.get(modo, max(BYTES_POR_CELDA.values()))
+    return int(tam_bloque) * por_sim + G_MAX_MC**2 * por_celda
+
+def tam_bloque_para_memoria(p, memoria_max, workers=None):
+    """Mayor tamaño de bloque (<= el de p) cuyo pico estimado (`memoria_bloque`), con
+    `workers` bloques en paralelo, no supera `memoria_max` bytes. Sin muestras crudas
+    la memoria del motor depende solo del bloque y del tope de goles, así que esto
+    acota la memoria de toda la corrida."""
+    workers = max(1, int(workers or p.get("workers") or 1))
+    por_sim = memoria_bloque(p, 1) - memoria_bloque(p, 0)
+    tam = min(int(p.get("tam_bloque") or TAM_BLOQUE),
+              int((memoria_max // workers - memoria_bloque(p, 0)) // por_sim))
+    if tam < TAM_BLOQUE_MIN:
+        raise ValueError(f"Memoria insuficiente: {memoria_max} bytes no alcanzan para un bloque de {TAM_BLOQUE_MIN}")
+    return tam
+
+def _acumular_choques(Z):
+    """Acumula conteo y suma de las normales combinadas de cada lambda en bins fijos.
+
+    Cada lambda lleva dos choques; su producto depende de (Z_a + Z_b)/sqrt(2) ~ N(0, 1).
+    Devuelve un array (2, 2, BINS_CHOQUES): [local/visita][conteo/suma][bin], sumable entre bloques.
+    """
+    acc = np.zeros((2, 2, BINS_CHOQUES))
+    for i, W in enumerate(((Z[0] + Z[1]) / np.sqrt(2.0), (Z[2] + Z[3]) / np.sqrt(2.0))):
+        idx = ((W + _RANGO_CHOQUES) * (BINS_CHOQUES / (2 * _RANGO_CHOQUES))).astype(np.intp)
+        np.clip(idx, 0, BINS_CHOQUES - 1, out=idx)
+        acc[i, 0] = np.bincount(idx, minlength=BINS_CHOQUES)
+        acc[i, 1] = np.bincount(idx, weights=W, minlength=BINS_CHOQUES)
+    return acc
+
+def _goles_con_tope(g):
+    """Goles int16 recortados a GOLES_MAX_MC (celda de desborde; evita que int16 dé la vuelta)."""
+    return np.minimum(g, GOLES_MAX_MC).astype(np.int16)
+
+def _sumar_matrices(a, b):
+    """Suma dos matrices de marcadores de distinto tamaño (rellena con ceros)."""
+    G = max(a.shape[0], b.shape[0])
+    out = np.zeros((G, G), dtype=np.result_type(a, b))
+    out[:a.shape[0], :a.shape[1]] += a
+    out[:b.shape[0], :b.shape[1]] += b
+    return out
+
+def _simular_bloque(p, semilla, m, guardar_muestras):
+    """Simula un bloque de m partidos con su propio Generator (a partir de una SeedSequence).
+
+    Según p["reduccion_varianza"] los sorteos van en pares antitéticos, salen de una
+    secuencia de Sobol desplazada (choques y etapa Poisson) o se acumulan los momentos
+    para variables de control. Devuelve (histograma, choques, muestras, estadísticos).
+    """
+    rng = np.random.Generator(np.random.PCG64(semilla))
+    modo = p.get("reduccion_varianza")
+    if modo not in MODOS_VR:
+        raise ValueError(f"reduccion_varianza desconocida: {modo!r} (usar {MODOS_VR})")
+    if modo == "qmc":
+        U = sobol_desplazado(m, rng)
+        Z = _normal_inversa(U[:4])
+        lam_loc, lam_vis = lambdas_desde_normales(p, Z)
+        g_loc, g_vis = _poisson_inversa(lam_loc, U[4]), _poisson_inversa(lam_vis, U[5])
+        del U
+    elif modo == "antitetico":
+        # Pares completos: (Z, U) y (-Z, 1-U) en choques y etapa Poisson (inversa de la CDF)
+        h = (m + 1) // 2
+        Zh = rng.standard_normal((4, h))
+        Uh = rng.random((2, h))
+        Z = np.concatenate([Zh, -Zh], axis=1)[:, :m]
+        U = np.concatenate([Uh, 1.0 - Uh], axis=1)[:, :m]
+        del Zh, Uh
+        lam_loc, lam_vis = lambdas_desde_normales(p, Z)
+        g_loc, g_vis = _poisson_inversa(lam_loc, U[0]), _poisson_inversa(lam_vis, U[1])
+        del U
+    else:
+        Z = rng.standard_normal((4, m))
+        lam_loc, lam_vis = lambdas_desde_normales(p, Z)
+        g_loc = _goles_con_tope(rng.poisson(lam=lam_loc))
+        g_vis = _goles_con_tope(rng.poisson(lam=lam_vis))
+    choques = _acumular_choques(Z)
+    del Z
+    hist = histograma_marcadores(g_loc, g_vis)
+
+    stats = {}
+    if modo == "antitetico":
+        # Pares (i, i + ceil(m/2)): se acumulan media y cuadrado de cada par
+        h, desfase = m // 2, (m + 1) // 2
+        Y = _indicadores_mercados(g_loc, g_vis)
+        par = 0.5 * (Y[:, :h] + Y[:, desfase:desfase + h])
+        stats = {"anti_sum": par.sum(axis=1), "anti_sumsq": (par**2).sum(axis=1), "anti_n": h}
+    elif modo == "qmc":
+        est = _mascaras_mercados(hist.shape[0]) @ hist.ravel() / m
+        stats = {"rqmc_sum": est, "rqmc_sumsq": est**2, "rqmc_r": 1}
+    elif modo == "control":
+        C = _controles(p, g_loc, g_vis, lam_loc, lam_vis)
+        G = hist.shape[0]
+        idx = g_loc.astype(np.int64) * G + g_vis
+        yc = np.stack([np.bincount(idx, weights=c, minlength=G * G) for c in C], axis=-1)
+        stats = {"cv_c": C.sum(axis=1), "cv_cc": C @ C.T, "cv_yc": yc.reshape(G, G, len(C))}
+    muestras = (g_loc, g_vis) if guardar_muestras else None
+    return hist, choques, muestras, stats
+
+def _controles(p, g_loc, g_vis, lam_loc, lam_vis):
+    """Variables de control centradas en su media conocida, forma (7, n).
+
+    Con mu = E[lam] (los choques tienen media 1) y E[(S1*S2)^2] = exp(2*sigma^2):
+    E[g] = E[lam] = mu, E[g^2] = mu + mu^2*exp(2*sigma^2), E[g_loc*g_vis] = mu_loc*mu_vis.
+    """
+    mu_l, mu_v = lambdas_base(p)
+    e2 = math.exp(2 * float(p.get("sigma", 0.3))**2)
+    gl = g_loc.astype(float); gv = g_vis.astype(float)
+    return np.stack([
+        gl - mu_l, gv - mu_v,
+        gl * gl - (mu_l + mu_l**2 * e2), gv * gv - (mu_v + mu_v**2 * e2),
+        gl * gv - mu_l * mu_v,
+        lam_loc - mu_l, lam_vis - mu_v,
+    ])
+
+def _sumar_stats(a, b):
+    """Suma estadísticos de bloque (los por celda se rellenan al tamaño mayor)."""
+    out = dict(a)
+    for k, v in b.items():
+        if k not in out:
+            out[k] = v
+        elif k == "cv_yc":
+            out[k] = np.stack([_sumar_matrices(out[k][..., i], v[..., i]) for i in range(v.shape[-1])], axis=-1)
+        else:
+            out[k] = out[k] + v
+    return out
+
+def _bloques(n, tam_bloque):
+    """Tamaños de bloque: dependen solo de n y tam_bloque (no del número de workers)."""
+    tam_bloque = max(1, min(int(tam_bloque), MAX_TAM_BLOQUE))
+    return [min(tam_bloque, n - i) for i in range(0, n, tam_bloque)] or [0]
+
+def _map_en_ventana(pool, fn, args, ventana):
+    """Como pool.map pero con a lo sumo `ventana` bloques en vuelo (memoria acotada)."""
+    pendientes = deque()
+    for a in args:
+        pendientes.append(pool.submit(fn, *a))
+        if len(pendientes) >= ventana:
+            yield pendientes.popleft().result()
+    while pendientes:
+        yield pendientes.popleft().result()
+
+def simular_mc(p, guardar_muestras=False, workers=None, ejecutor="thread", progreso=None):
+    """Motor Monte Carlo por bloques con streams independientes por bloque.
+
+    Cada bloque usa un np.random.Generator derivado de SeedSequence(p["seed"]).spawn(...),
+    así que no hay estado aleatorio global compartido entre requests/hilos. Los bloques
+    se reparten en un pool (ejecutor "thread" o "process") y se combinan sumando
+    histogramas en orden: para una misma semilla y tam_bloque el resultado es idéntico
+    bit a bit con cualquier número de workers.
+
+    Modo streaming: sin guardar_muestras solo se acumulan agregados (histograma de
+    marcadores, del que salen todos los mercados, y el acumulado de choques), hay a
+    lo sumo 2*workers bloques en vuelo y los goles se recortan a GOLES_MAX_MC, así
+    que la memoria pico depende del tamaño de bloque y no de n_sims ni de sigma
+    (ver `memoria_bloque`). Guardar muestras crudas está limitado a MAX_MUESTRAS.
 
-    g_loc = np.random.poisson(lam=lam_loc)
-    g_vis = np.random.poisson(lam=lam_vis)
+    p["reduccion_varianza"] activa un modo de reducción de varianza: "antitetico"
+    (pares en choques y etapa Poisson), "qmc" (Sobol desplazado, un bloque por réplica)
+    o "control" (variables de control con la media conocida de lambdas y goles).
+
+    progreso: callback opcional progreso(n_hechas, conteos) tras cada bloque combinado
+    (conteos = histograma acumulado); si lanza una excepción la corrida se corta.
+
+    Retorna dict con "matriz" (conteos, o probabilidades ajustadas en modo "control"),
+    "conteos", "choques" (acumulado para `sensibilidad_grid`), "n", "se"/"ess" por
+    mercado, "eficiencia" (ESS mínimo / n) y, si guardar_muestras, "g_loc"/"g_vis".
+    """
+    n = int(p.get("n_sims", 10000))
+    if n < 1:
+        raise ValueError(f"n_sims debe ser >= 1 (recibido {n})")
+    if guardar_muestras and n > MAX_MUESTRAS:
+        raise ValueError(f"No se guardan más de {MAX_MUESTRAS} muestras crudas (n_sims={n})")
+    tamanos = _bloques(n, _tam_bloque_mc(p, n))
+    semillas = np.random.SeedSequence(p.get("seed")).spawn(len(tamanos))
+    sim = _ejecutar_bloques(p, semillas, tamanos, guardar_muestras, workers, ejecutor, progreso)
+    return _estimar(sim, p.get("reduccion_varianza"))
+
+def _tam_bloque_mc(p, n):
+    """Tamaño de bloque de `simular_mc` para n simulaciones."""
+    tam = p.get("tam_bloque") or TAM_BLOQUE
+    if p.get("reduccion_varianza") == "qmc":
+        # Cada bloque es una réplica RQMC: al menos RQMC_REPLICAS para estimar la varianza
+        tam = min(tam, max(1, math.ceil(n / RQMC_REPLICAS)))
+    return tam
+
+def _ejecutar_bloques(p, semillas, tamanos, guardar_muestras=False, workers=None, ejecutor="thread", progreso=None):
+    """Simula los bloques (semilla, tamaño) en un pool y combina los resultados en orden."""
+    if workers is None:
+        workers = p.get("workers")
+    workers = max(1, min(int(workers or os.cpu_count() or 1), len(tamanos)))
+    n = int(sum(tamanos))
+    args = ((p, s, m, guardar_muestras) for s, m in zip(semillas, tamanos))
+    if workers == 1:
+        resultados = (_simular_bloque(*a) for a in args)
+        return _combinar_bloques(resultados, n, guardar_muestras, progreso)
+    Pool = ProcessPoolExecutor if ejecutor == "process" else ThreadPoolExecutor
+    with Pool(max_workers=workers) as pool:
+        resultados = _map_en_ventana(pool, _simular_bloque, args, 2 * workers)
+        return _combinar_bloques(resultados, n, guardar_muestras, progreso)
+
+def _combinar_bloques(resultados, n, guardar_muestras, progreso=None):
+    """Combina (en orden) los resultados de `_simular_bloque` en acumulados crudos."""
+    conteos = np.zeros((1, 1), dtype=np.int64)
+    choques = np.zeros((2, 2, BINS_CHOQUES))
+    stats = {}
+    partes = []
+    hechas = 0
+    for hist, acc, muestras, st in resultados:
+        conteos = _sumar_matrices(conteos, hist)
+        hechas += int(hist.sum())
+        if progreso is not None:
+            progreso(hechas, conteos)
+        choques += acc
+        stats = _sumar_stats(stats, st)
+        if guardar_muestras:
+            partes.append(muestras)
+    out = {"conteos": conteos, "choques": choques, "stats": stats, "n": n}
+    if guardar_muestras:
+        out["g_loc"] = np.concatenate([m[0] for m in partes])
+        out["g_vis"] = np.concatenate([m[1] for m in partes])
+    return out
+
+def _estimar(sim, modo):
+    """Completa `sim` con la matriz estimada y el error/ESS de cada mercado según el modo.
+
+    ESS (tamaño de muestra efectivo) = p(1-p)/Var(estimador): cuántas simulaciones
+    planas darían la misma precisión. "eficiencia" = ESS mínimo / n.
+    """
+    n, st = sim["n"], sim["stats"]
+    G = sim["conteos"].shape[0]
+    P = sim["conteos"].ravel() / sim["conteos"].sum()
+    masc = _mascaras_mercados(G)
+    y = masc @ P
+    var = y * (1 - y) / n
+    if modo == "antitetico" and st.get("anti_n"):
+        k = st["anti_n"]
+        var = np.maximum(st["anti_sumsq"] / k - (st["anti_sum"] / k)**2, 0.0) / k
+    elif modo == "qmc" and st.get("rqmc_r", 0) > 1:
+        R = st["rqmc_r"]
+        media = st["rqmc_sum"] / R
+        var = np.maximum(st["rqmc_sumsq"] / R - media**2, 0.0) / (R - 1)
+    elif modo == "control" and "cv_cc" in st:
+        cbar = st["cv_c"] / n
+        S_inv = np.linalg.pinv(st["cv_cc"] / n - np.outer(cbar, cbar))
+        K = st["cv_yc"].shape[-1]
+        yc = np.zeros((G, G, K))
+        g = st["cv_yc"].shape[0]
+        yc[:g, :g] = st["cv_yc"]
+        cov = yc.reshape(-1, K) / n - P[:, None] * cbar
+        # Ajuste por celda: P_cv = P - beta·mean(C), beta = cov·S^-1 (suma 0 entre celdas)
+        P = np.clip(P - cov @ S_inv @ cbar, 0.0, None)
+        P /= P.sum()
+        cov_y = masc @ cov
+        var = np.maximum(y * (1 - y) - np.einsum("ij,jk,ik->i", cov_y, S_inv, cov_y), 0.0) / n
+        y = masc @ P
+    sim["matriz"] = P.reshape(G, G) if modo == "control" else sim["conteos"]
+    ess = np.where(var > 0, y * (1 - y) / np.where(var > 0, var, 1.0), float(n))
+    sim["se"] = dict(zip(MERCADOS_PRECISION, np.sqrt(var)))
+    sim["ess"] = dict(zip(MERCADOS_PRECISION, ess))
+    sim["eficiencia"] = float(ess.min() / n)
+    sim["modo"] = modo
+    return sim
+
+# ---------- PARADA ADAPTATIVA POR PRECISIÓN ----------
+Z_IC95 = 1.959964
+TAM_BLOQUE_ADAPTATIVO = 10_000
+
+def _tam_bloque_adaptativo(p):
+    """Granularidad de las tandas: p["tam_bloque"] acotado a TAM_BLOQUE_ADAPTATIVO."""
+    return max(1, min(int(p.get("tam_bloque") or TAM_BLOQUE_ADAPTATIVO), TAM_BLOQUE_ADAPTATIVO))
+
+def simular_mc_adaptativo(p, se_objetivo=None, ic_objetivo=None, n_max=None, workers=None, progreso=None):
+    """Simula en tandas crecientes hasta que todos los mercados alcanzan la precisión pedida.
+
+    se_objetivo: error estándar máximo por mercado (p.ej. 0.0025 = ±0.25 pp).
+    ic_objetivo: alternativa como semiancho del IC 95% (se convierte a se = ic/1.96).
+    n_max: presupuesto máximo de simulaciones (por defecto p["n_sims"]).
+    Las tandas son bloques de `_tam_bloque_adaptativo(p)` simulaciones derivados en
+    secuencia de la misma SeedSequence, así que parar en N muestras da exactamente el
+    mismo resultado que `simular_mc` con n_sims=N y ese tam_bloque.
+
+    Con reducción de varianza el error de cada tanda es el del modo elegido.
+    progreso: como en `simular_mc`, con n y conteos acumulados entre tandas.
+
+    Retorna el dict de `simular_mc` más "se_objetivo" y "convergio".
+    """
+    if se_objetivo is None and ic_objetivo is None:
+        raise ValueError("Indicar se_objetivo o ic_objetivo")
+    se_obj = float(se_objetivo) if se_objetivo is not None else float(ic_objetivo) / Z_IC95
+    if se_obj <= 0:
+        raise ValueError(f"El error objetivo debe ser > 0 (recibido {se_obj})")
+    n_max = int(n_max or p.get("n_sims", 10000))
+    if n_max < 1:
+        raise ValueError(f"n_max debe ser >= 1 (recibido {n_max})")
+    b = _tam_bloque_adaptativo(p)
+    ss = np.random.SeedSequence(p.get("seed"))
+
+    acumulado = None
+    objetivo = min(n_max, b)
+    while True:
+        hechas = acumulado["n"] if acumulado else 0
+        tamanos = _bloques(objetivo - hechas, b)
+        previo = acumulado
+        aviso = None if progreso is None else (
+            lambda n, conteos: progreso(n + hechas, conteos if previo is None else _sumar_matrices(previo["conteos"], conteos)))
+        tanda = _ejecutar_bloques(p, ss.spawn(len(tamanos)), tamanos, workers=workers, progreso=aviso)
+        acumulado = tanda if acumulado is None else {
+            "conteos": _sumar_matrices(acumulado["conteos"], tanda["conteos"]),
+            "choques": acumulado["choques"] + tanda["choques"],
+            "stats": _sumar_stats(acumulado["stats"], tanda["stats"]),
+            "n": acumulado["n"] + tanda["n"],
+        }
+        acumulado = _estimar(acumulado, p.get("reduccion_varianza"))
+        se = acumulado["se"]
+        convergio = max(se.values()) <= se_obj
+        if convergio or acumulado["n"] >= n_max:
+            break
+        # Tamaño necesario según la varianza observada del mercado más exigente (var ∝ 1/n)
+        n_req = max(se.values())**2 * acumulado["n"] / se_obj**2
+        objetivo = max(acumulado["n"] + b, min(4 * acumulado["n"], math.ceil(1.05 * n_req)))
+        # Redondeo a bloques completos: las tandas siempre empiezan en un borde de bloque
+        objetivo = int(min(n_max, math.ceil(objetivo / b) * b))
+    acumulado.update({"se_objetivo": se_obj, "convergio": convergio})
+    return acumulado
+
+def sim_goles_xg(p):
+    """Simula goles (g_loc, g_vis) como arrays enteros compactos (int16).
+
+    Mismo modelo que `sim_partido_xg`, pero sin construir el DataFrame por simulación.
+    """
+    r = simular_mc(p, guardar_muestras=True)
+    return r["g_loc"], r["g_vis"]
+
+def muestras_a_dataframe(g_loc, g_vis):
+    """Construye el DataFrame por simulación (solo cuando se piden muestras crudas)."""
     df = pd.DataFrame({"g_loc": g_loc, "g_vis": g_vis})
     df["res"] = np.select([df.g_loc>df.g_vis, df.g_loc<df.g_vis], ["Local","Visitante"], default="Empate")
     df["over25"] = (df.g_loc+df.g_vis)>2
     df["btts"] = (df.g_loc>0)&(df.g_vis>0)
     return df
 
+def histograma_marcadores(g_loc, g_vis):
+    """Reduce las muestras a una matriz de conteos [g_loc, g_vis] vía bincount.
+
+    Cada marcador se codifica como g_loc*G + g_vis, con G = máximo de goles + 1.
+    """
+    g_loc = np.asarray(g_loc); g_vis = np.asarray(g_vis)
+    if g_loc.size == 0:
+        return np.zeros((1, 1), dtype=np.int64)
+    G = int(max(g_loc.max(), g_vis.max())) + 1
+    idx = g_loc.astype(np.int64) * G + g_vis
+    return np.bincount(idx, minlength=G * G).reshape(G, G)
+
+def sim_partido_xg(p):
+    """Simula marcadores g_loc y g_vis a partir de parámetros tipo xG.
+
+    p: dict con claves esperadas
+       - xGF_local_prom, xGA_local_prom, xGF_visit_prom, xGA_visit_prom
+       - xG_liga_equipo, HFA, sigma, n_sims, seed
+    Devuelve el DataFrame con una fila por simulación (muestras crudas).
+    """
+    return muestras_a_dataframe(*sim_goles_xg(p))
+
+@lru_cache(maxsize=32)
+def _indices_matriz(G):
+    """Índices aplanados de diferencia y total de goles para una matriz GxG."""
+    gl, gv = np.divmod(np.arange(G * G), G)
+    return gl - gv + G - 1, gl + gv
+
+def resumen_desde_matriz(matriz):
+    """Genera métricas resumidas a partir de una matriz de marcadores [g_loc, g_vis].
+
+    Acepta conteos o probabilidades; se normaliza por la suma.
+    """
+    P = np.asarray(matriz, dtype=float)
+    P = P / P.sum()
+    G = P.shape[0]
+    # Probabilidad por diferencia (g_loc - g_vis + G - 1) y por total de goles
+    idx_dif, idx_tot = _indices_matriz(G)
+    dif = np.bincount(idx_dif, weights=P.ravel(), minlength=2 * G - 1)
+    tot = np.bincount(idx_tot, weights=P.ravel(), minlength=2 * G - 1)
+    goles = np.arange(G)
+    goles_loc = P.sum(axis=1) @ goles
+    goles_vis = P.sum(axis=0) @ goles
+    goles_sum = goles_loc + goles_vis
+    resumen = {
+        "% Local": dif[G:].sum(),
+        "% Empate": dif[G - 1],
+        "% Visitante": dif[:G - 1].sum(),
+        "% Over 2.5": tot[3:].sum(),
+        "% BTTS": P[1:, 1:].sum(),
+        "Goles loc": goles_loc,
+        "Goles vis": goles_vis,
+        "Goles tot": goles_sum,
+        # Over 3.5
+        "% Over 3.5": tot[4:].sum(),
+        "Efectividad local": goles_loc/goles_sum if goles_sum > 0 else 0.0,
+        "Efectividad visitante": goles_vis/goles_sum if goles_sum > 0 else 0.0,
+    }
+    return pd.Series(resumen)
+
 def resumen_estadistico(df):
     """Genera métricas resumidas a partir del dataframe de simulación."""
-    resumen = pd.Series({
-        "% Local": (df.res=="Local").mean(),
-        "% Empate": (df.res=="Empate").mean(),
-        "% Visitante": (df.res=="Visitante").mean(),
-        "% Over 2.5": df.over25.mean(),
-        "% BTTS": df.btts.mean(),
-        "Goles loc": df.g_loc.mean(),
-        "Goles vis": df.g_vis.mean(),
-        "Goles tot": (df.g_loc+df.g_vis).mean()
-    })
-    # Over 3.5
-    resumen["% Over 3.5"] = ((df.g_loc + df.g_vis) > 3).mean()
-    goles_sum = resumen["Goles loc"] + resumen["Goles vis"]
-    if goles_sum > 0:
-        resumen["Efectividad local"] = resumen["Goles loc"]/goles_sum
-        resumen["Efectividad visitante"] = resumen["Goles vis"]/goles_sum
+    return resumen_desde_matriz(histograma_marcadores(df.g_loc.to_numpy(), df.g_vis.to_numpy()))
+
+def top_marcadores(matriz, k=10):
+    """Devuelve los k marcadores más probables como DataFrame (g_loc, g_vis, Prob)."""
+    P = np.asarray(matriz, dtype=float)
+    flat = P.ravel() / P.sum()
+    orden = np.argsort(-flat, kind="stable")[:k]
+    orden = orden[flat[orden] > 0]
+    g_loc, g_vis = np.divmod(orden, P.shape[1])
+    return pd.DataFrame({"g_loc": g_loc, "g_vis": g_vis, "Prob": flat[orden]})
+
+def cuotas_desde_matriz(matriz, nombres=mercados.MERCADOS_DEFAULT, precision=None):
+    """Tabla de cuotas justas (Mercado, Prob, Cuota justa) de los mercados `nombres`.
+
+    Con `precision` (motor Monte Carlo) agrega "Error est.": el del modo de reducción
+    de varianza para los mercados seguidos y el binomial para el resto. Si algún
+    mercado tiene devolución (asiáticos, DNB) agrega la columna "Devolución".
+    """
+    n = precision["n_usado"] if precision else None
+    filas = []
+    for nombre, ev in mercados.evaluar(matriz, nombres, n).items():
+        if not ev["Prob"] > 0:
+            continue
+        fila = {"Mercado": nombre, "Prob": ev["Prob"], "Cuota justa": ev["Cuota justa"], "Devolución": ev["Devolución"]}
+        if precision:
+            clave = _MERCADO_A_PRECISION.get(nombre)
+            fila["Error est."] = precision["se"][clave] if clave else ev["Error est."]
+        filas.append(fila)
+    df = pd.DataFrame(filas)
+    if "Devolución" in df and not (df["Devolución"] > 0).any():
+        df = df.drop(columns="Devolución")
+    return df
+
+def mercados_desde_resumen(resumen):
+    """Probabilidades de los mercados base a partir del resumen."""
+    return {
+        "Local": resumen.get("% Local"),
+        "Empate": resumen.get("% Empate"),
+        "Visitante": resumen.get("% Visitante"),
+        "Over 2.5": resumen.get("% Over 2.5"),
+        "BTTS": resumen.get("% BTTS"),
+        "Under 2.5": 1 - resumen.get("% Over 2.5", 0),
+        "BTTS No": 1 - resumen.get("% BTTS", 0),
+        "Over 3.5": resumen.get("% Over 3.5"),
+        "Under 3.5": 1 - resumen.get("% Over 3.5", 0),
+    }
+
+# ---------- MOTOR EXACTO (cuadratura Gauss–Hermite) ----------
+@lru_cache(maxsize=8)
+def _nodos_gauss_hermite(n):
+    """Nodos y pesos de Gauss–Hermite normalizados para E[h(Z)], Z ~ N(0, 1)."""
+    x, w = np.polynomial.hermite.hermgauss(n)
+    return np.sqrt(2.0) * x, w / np.sqrt(np.pi)
+
+def lambdas_base(p):
+    """Tasas de gol sin choques: (lam_loc, lam_vis) = HFA^±1 * xGF * xGA / xG_liga."""
+    HFA = float(p.get("HFA", 1.0))
+    xG_liga = float(p.get("xG_liga_equipo", 1.0)) or 1.0
+    xGF_local_adj, xGA_local_adj, xGF_visit_adj, xGA_visit_adj = xg_ajustados(p)
+    lam_loc = HFA * xGF_local_adj * xGA_visit_adj / xG_liga
+    lam_vis = (1.0/HFA) * xGF_visit_adj * xGA_local_adj / xG_liga
+    return lam_loc, lam_vis
+
+def _goles_max_auto(lam, sigma):
+    """Tope de goles con masa de cola despreciable para Poisson-lognormal de media lam."""
+    # Con xG o HFA negativos lam < 0: se acota como en `_lambdas_choques`
+    lam = max(lam, 1e-6)
+    var = lam + lam**2 * math.expm1(2.0 * sigma**2)
+    return int(min(200, max(10, math.ceil(lam + 12.0 * math.sqrt(var)) + 5)))
+
+def _pmf_mezcla(lam, sigma, z, w, goles_max):
+    """P(goles = k) para Poisson(lam * exp(-sigma^2 + sigma*sqrt(2)*Z)) con Z discreta (z, w)."""
+    k = np.arange(goles_max + 1)
+    log_fact = np.concatenate(([0.0], np.cumsum(np.log(k[1:]))))
+    if sigma > 0:
+        lam_n = lam * np.exp(-sigma**2 + sigma * np.sqrt(2.0) * z)
     else:
-        resumen["Efectividad local"] = 0.0
-        resumen["Efectividad visitante"] = 0.0
-    return resumen
+        lam_n, w = np.array([lam]), np.array([1.0])
+    lam_n = np.clip(lam_n, 1e-6, None)
+    log_pmf = k[None, :] * np.log(lam_n)[:, None] - lam_n[:, None] - log_fact[None, :]
+    return w @ np.exp(log_pmf)
 
-def export_rushapo_excel(params,resumen,top_scores,sens_df,cuotas_df,df,file_name="Rushapo_Simulacion_Completa.xlsx"):
-    """Exporta un reporte a Excel.
+def pmf_goles_exacta(lam, sigma, goles_max, nodos=32):
+    """P(goles = k), k=0..goles_max, para Poisson(lam * S1 * S2) con S1, S2 lognormales de media 1.
+
+    El producto de dos choques es lognormal con log-media -sigma^2 y log-sd sigma*sqrt(2);
+    se integra la pmf de Poisson sobre ese choque por cuadratura de Gauss–Hermite.
+    """
+    z, w = _nodos_gauss_hermite(nodos)
+    return _pmf_mezcla(lam, sigma, z, w, goles_max)
+
+def matriz_exacta(p, goles_max=None, nodos=32):
+    """Matriz de probabilidades de marcador [g_loc, g_vis] sin muestreo.
 
-    Usa xlsxwriter si está disponible para formatear. Si no, exporta una versión simple.
+    Los choques del local y del visitante son independientes, así que la matriz es
+    el producto exterior de las dos marginales.
     """
+    sigma = float(p.get("sigma", 0.3))
+    lam_loc, lam_vis = lambdas_base(p)
+    if goles_max is None:
+        goles_max = max(_goles_max_auto(lam_loc, sigma), _goles_max_auto(lam_vis, sigma))
+    return np.outer(pmf_goles_exacta(lam_loc, sigma, goles_max, nodos),
+                    pmf_goles_exacta(lam_vis, sigma, goles_max, nodos))
+
+def matriz_tabla(p, tolerancia=None):
+    """Matriz interpolada de la tabla precalculada (ver `tabla_marcadores`) y cómo se obtuvo.
+
+    Sin tabla cargada, con lambdas o sigma fuera de la grilla o con cota mayor que
+    `tolerancia` (por defecto tabla_marcadores.TOLERANCIA) se calcula en vivo con
+    `matriz_exacta`. Devuelve (matriz, info) con info {"fuente": "tabla"|"exacto",
+    "cota": error máximo de cualquier probabilidad (None en vivo), "motivo",
+    "microsegundos"}.
+    """
+    from tabla_marcadores import TOLERANCIA, tabla_global
+    t0 = time.perf_counter()
+    tolerancia = TOLERANCIA if tolerancia is None else tolerancia
+    sigma = float(p.get("sigma", 0.3))
+    lam_loc, lam_vis = lambdas_base(p)
+    tabla = tabla_global()
+    # Mismo tope de goles que el motor exacto: la matriz tiene la misma forma
+    K = max(_goles_max_auto(lam_loc, sigma), _goles_max_auto(lam_vis, sigma))
+    r = tabla.matriz(lam_loc, lam_vis, sigma, K) if tabla is not None else None
+    if r is not None and r[1] <= tolerancia:
+        matriz, info = r[0], {"fuente": "tabla", "cota": r[1], "motivo": None}
+    else:
+        motivo = "sin tabla" if tabla is None else ("fuera de la grilla" if r is None else "cota > tolerancia")
+        matriz, info = matriz_exacta(p), {"fuente": "exacto", "cota": None, "motivo": motivo}
+    TABLA.inc(1, info["fuente"])
+    info["microsegundos"] = (time.perf_counter() - t0) * 1e6
+    return matriz, info
+
+def matriz_marcadores(p, engine=None):
+    """Matriz de marcadores según el motor: conteos ("mc") o probabilidades ("exact" o "tabla")."""
+    engine = engine or p.get("engine", "mc")
+    if engine == "exact":
+        return matriz_exacta(p)
+    if engine == "tabla":
+        return matriz_tabla(p)[0]
+    if engine == "mc":
+        return simular_mc(p)["matriz"]
+    raise ValueError(f"engine desconocido: {engine!r} (usar 'mc', 'exact' o 'tabla')")
+
+# ---------- CALIBRACIÓN DESDE CUOTAS (inversa del motor exacto) ----------
+SIGMA_CALIBRACION = (0.01, SIGMA_MAX)
+# Claves de xG y de goles recientes que se escalan juntas (la mezcla de xg_ajustados es lineal)
+_CLAVES_XG_GOLES = {"xGF_local_prom": "gf_local_10", "xGA_local_prom": "ga_local_10",
+                    "xGF_visit_prom": "gf_visit_10", "xGA_visit_prom": "ga_visit_10"}
+
+def _probs_exactas(lam_loc, lam_vis, sigma, nombres, nodos=32):
+    """Probabilidad de cada mercado con el motor exacto (suave y determinista en lam y sigma)."""
+    G = max(_goles_max_auto(lam_loc, sigma), _goles_max_auto(lam_vis, sigma))
+    P = np.outer(pmf_goles_exacta(lam_loc, sigma, G, nodos), pmf_goles_exacta(lam_vis, sigma, G, nodos))
+    return np.array(list(mercados.prob_mercados(P, nombres).values()))
+
+def _levenberg_marquardt(residuo, x0, lo, hi, max_iter=100, h=1e-6, tol=1e-10):
+    """Mínimos cuadrados de residuo(x) con Jacobiano por diferencias centrales y caja [lo, hi].
+
+    Devuelve (x, costo, iteraciones, convergio).
+    """
+    x = np.clip(np.asarray(x0, dtype=float), lo, hi)
+    r = residuo(x)
+    costo, mu = float(r @ r), 1e-3
+    for it in range(1, max_iter + 1):
+        J = np.empty((r.size, x.size))
+        for j in range(x.size):
+            d = np.zeros_like(x); d[j] = h
+            J[:, j] = (residuo(x + d) - residuo(x - d)) / (2 * h)
+        A, g = J.T @ J, J.T @ r
+        # Componentes en un borde de la caja que el descenso empuja hacia afuera: quedan fijas
+        libres = ~(((x <= lo) & (g > 0)) | ((x >= hi) & (g < 0)))
+        if not libres.any():
+            return x, costo, it, True
+        A, g = A[np.ix_(libres, libres)], g[libres]
+        while True:
+            paso = np.zeros_like(x)
+            paso[libres] = np.linalg.solve(A + mu * np.diag(np.diag(A) + 1e-12), -g)
+            x_nuevo = np.clip(x + paso, lo, hi)
+            r_nuevo = residuo(x_nuevo)
+            costo_nuevo = float(r_nuevo @ r_nuevo)
+            if costo_nuevo <= costo or mu > 1e12:
+                break
+            mu *= 4.0
+        if costo_nuevo > costo:
+            return x, costo, it, True
+        mover = float(np.abs(x_nuevo - x).max())
+        x, r, costo, mu = x_nuevo, r_nuevo, costo_nuevo, max(mu / 3.0, 1e-12)
+        if mover < tol or costo < 1e-24:
+            return x, costo, it, True
+    return x, costo, max_iter, False
+
+def _lambdas_positivas(p):
+    """lambdas_base(p), o ValueError si alguna no es positiva y finita (no se pueden reescalar)."""
     try:
-        import xlsxwriter  # noqa: F401
-        engine = "xlsxwriter"
-        styled = True
-    except Exception:
-        engine = None  # Deja que Pandas elija (normalmente openpyxl)
-        styled = False
-
-    if styled:
-        with pd.ExcelWriter(file_name, engine="xlsxwriter") as writer:
-            wb = writer.book
-            negro, dorado, gris = "#0B0B0C", "#D4AF37", "#F2F2F2"
-            fmt_t = wb.add_format({"bold": True, "font_size": 20, "font_color": dorado, "bg_color": negro, "align": "center"})
-            fmt_h = wb.add_format({"bold": True, "font_color": "#000000", "bg_color": gris, "border": 1, "align": "center"})
-            pct = wb.add_format({"num_format": "0.00%", "border": 1, "align": "center"})
-            num = wb.add_format({"num_format": "0.00", "border": 1, "align": "center"})
-            txt = wb.add_format({"border": 1, "align": "center"})
-
-            # --- RESUMEN ---
-            resumen_df = resumen.rename("Valor").to_frame().reset_index(); resumen_df.columns = ["Métrica", "Valor"]
-            resumen_df.to_excel(writer, sheet_name="Resumen", index=False, startrow=10, startcol=1)
-            ws = writer.sheets["Resumen"]
-            ws.merge_range(1, 1, 2, 9, f"RUSHAPO – Simulación Monte Carlo (xG)", fmt_t)
-            ws.write(4, 1, "Partido", fmt_h); ws.merge_range(4, 2, 4, 6, f'{params["equipo_local"]} vs {params["equipo_visit"]}', txt)
-            ws.write(5, 1, "Fecha", fmt_h); ws.merge_range(5, 2, 5, 6, datetime.now().strftime("%Y-%m-%d %H:%M"), txt)
-            ws.write(6, 1, "HFA", fmt_h); ws.write(6, 2, params["HFA"], num)
-            ws.write(6, 3, "σ (volatilidad)", fmt_h); ws.write(6, 4, params["sigma"], num)
-            ws.write(6, 5, "Simulaciones", fmt_h); ws.write(6, 6, params["n_sims"], num)
-            for r in range(len(resumen_df)):
-                label = resumen_df.iloc[r, 0]; val = float(resumen_df.iloc[r, 1])
-                ws.write(11 + r, 1, label, txt)
-                ws.write(11 + r, 2, val, pct if "%" in label else num)
-
-            # --- MARCADORES ---
-            top_scores.to_excel(writer, sheet_name="Marcadores", index=False, startrow=3, startcol=1)
-            ws2 = writer.sheets["Marcadores"]
-            ws2.merge_range(1, 1, 1, 5, "RUSHAPO – Marcadores más probables", fmt_t)
-            for c, h in enumerate(top_scores.columns, start=1): ws2.write(3, c, h, fmt_h)
-            ws2.set_column(1, 3, 15)
-
-            # --- SENSIBILIDAD ---
-            sens_df.to_excel(writer, sheet_name="Sensibilidad", index=False, startrow=3, startcol=1)
-            ws3 = writer.sheets["Sensibilidad"]
-            ws3.merge_range(1, 1, 1, 6, "RUSHAPO – Análisis de Sensibilidad", fmt_t)
-            for c, h in enumerate(sens_df.columns, start=1): ws3.write(3, c, h, fmt_h)
-            ws3.set_column(1, 6, 15)
-
-            # --- CUOTAS & EV ---
-            cuotas_df.to_excel(writer, sheet_name="Cuotas & EV", index=False, startrow=3, startcol=1)
-            ws4 = writer.sheets["Cuotas & EV"]
-            ws4.merge_range(1, 1, 1, 8, "RUSHAPO – Cuotas & Value Bets", fmt_t)
-            for c, h in enumerate(cuotas_df.columns, start=1): ws4.write(3, c, h, fmt_h)
-            ws4.set_column(1, 8, 15)
-
-            # --- SIMULACIONES (opcional) ---
-            df.to_excel(writer, sheet_name="Simulaciones", index=False)
+        lams = lambdas_base(p)
+    except ZeroDivisionError:
+        lams = (math.nan, math.nan)
+    if not all(math.isfinite(l) and l > 0 for l in lams):
+        raise ValueError("Las lambdas del partido deben ser positivas para calibrar (revisar xG, goles recientes y HFA)")
+    return lams
+
+def _params_con_lambdas(p, lam_loc, lam_vis, sigma, ajustar_hfa=True):
+    """Copia de p cuyos xG (y goles recientes) y HFA reproducen (lam_loc, lam_vis).
+
+    Con ajustar_hfa la parte asimétrica del cambio (local vs visitante) va al HFA y la
+    común se reparte por igual entre los cuatro xG; si no, cada lambda se corrige
+    escalando por igual el ataque y la defensa que la forman.
+    """
+    lam_loc_0, lam_vis_0 = _lambdas_positivas(p)
+    r_loc, r_vis = lam_loc / lam_loc_0, lam_vis / lam_vis_0
+    q = dict(p, sigma=float(sigma))
+    if ajustar_hfa:
+        q["HFA"] = float(p.get("HFA", 1.0)) * math.sqrt(r_loc / r_vis)
+        factores = dict.fromkeys(_CLAVES_XG_GOLES, (r_loc * r_vis) ** 0.25)
+    else:
+        f_loc, f_vis = math.sqrt(r_loc), math.sqrt(r_vis)
+        factores = {"xGF_local_prom": f_loc, "xGA_visit_prom": f_loc, "xGF_visit_prom": f_vis, "xGA_local_prom": f_vis}
+    for xg, goles in _CLAVES_XG_GOLES.items():
+        q[xg] = float(p[xg]) * factores[xg]
+        if p.get(goles) is not None:
+            q[goles] = float(p[goles]) * factores[xg]
+    return q
+
+def calibrar_desde_cuotas(cuotas, p=None, ajustar_sigma=False, ajustar_hfa=True, metodo="potencia", nodos=32):
+    """Ajusta el modelo a las cuotas del mercado (sin margen) con el motor exacto.
+
+    cuotas: dict mercado -> cuota decimal. Hacen falta las tres de 1X2; cada par
+    completo "Over N"/"Under N" (y BTTS/BTTS No) agrega información. El margen de cada
+    grupo se quita con `mercados.quitar_margen(metodo)`.
+    Se ajustan lam_loc, lam_vis (y sigma con ajustar_sigma, que requiere al menos un
+    grupo además del 1X2) por mínimos cuadrados sobre las probabilidades, con
+    Levenberg–Marquardt sobre la cuadratura de Gauss–Hermite: sin ruido de muestreo,
+    converge en pocos milisegundos. Las lambdas se traducen a xG y HFA implícitos
+    partiendo de p (ver `_params_con_lambdas`).
+    Devuelve un dict con las lambdas, sigma y HFA del mercado, "params" (p calibrado),
+    "comparacion" (parámetros del usuario vs del mercado), "mercados" (probabilidad
+    justa, del modelo calibrado y del usuario por mercado), "margen", "ignorados"
+    (cuotas sin grupo completo), "residuo_max", "iteraciones", "convergio" y "segundos".
+    """
+    t0 = time.perf_counter()
+    p = dict(p or params)
+    cuotas = {" ".join(str(k).split()): float(v) for k, v in cuotas.items() if v}
+    grupos, ignorados = mercados.grupos_complementarios(list(cuotas))
+    if not grupos or grupos[0] != ["Local", "Empate", "Visitante"]:
+        raise ValueError("Hacen falta las cuotas 1X2 (Local, Empate y Visitante) para calibrar")
+    if ajustar_sigma and len(grupos) < 2:
+        raise ValueError("Para ajustar sigma hace falta otro grupo de cuotas además del 1X2 (p.ej. Over/Under 2.5)")
+    nombres, objetivo, margen = [], [], {}
+    for grupo in grupos:
+        probs, m = mercados.quitar_margen([cuotas[n] for n in grupo], metodo)
+        nombres += grupo
+        objetivo = np.concatenate([objetivo, probs])
+        margen[" / ".join(grupo)] = m
+
+    sigma_0 = float(p.get("sigma", 0.3))
+    lam_usuario = _lambdas_positivas(p)
+    x0 = np.log(lam_usuario)
+    lo, hi = np.log([1e-3, 1e-3]), np.log([15.0, 15.0])
+    if ajustar_sigma:
+        x0 = np.append(x0, np.log(np.clip(sigma_0, *SIGMA_CALIBRACION)))
+        lo, hi = np.append(lo, np.log(SIGMA_CALIBRACION[0])), np.append(hi, np.log(SIGMA_CALIBRACION[1]))
+
+    def residuo(x):
+        sigma = math.exp(x[2]) if ajustar_sigma else sigma_0
+        return _probs_exactas(math.exp(x[0]), math.exp(x[1]), sigma, nombres, nodos) - objetivo
+
+    x, _, iteraciones, convergio = _levenberg_marquardt(residuo, x0, lo, hi)
+    lam_loc, lam_vis = math.exp(x[0]), math.exp(x[1])
+    sigma = math.exp(x[2]) if ajustar_sigma else sigma_0
+    p_mercado = _params_con_lambdas(p, lam_loc, lam_vis, sigma, ajustar_hfa)
+
+    prob_modelo = _probs_exactas(lam_loc, lam_vis, sigma, nombres, nodos)
+    prob_usuario = _probs_exactas(*lam_usuario, sigma_0, nombres, nodos)
+    tabla_mercados = pd.DataFrame({"Mercado": nombres, "Cuota": [cuotas[n] for n in nombres],
+                                   "Prob justa": objetivo, "Prob modelo": prob_modelo, "Prob usuario": prob_usuario})
+    etiquetas = [("λ local", lam_usuario[0], lam_loc), ("λ visitante", lam_usuario[1], lam_vis),
+                 ("HFA", p.get("HFA", 1.0), p_mercado["HFA"]), ("sigma", sigma_0, sigma)]
+    ajust_usuario, ajust_mercado = xg_ajustados(p), xg_ajustados(p_mercado)
+    for i, nombre in enumerate(("xGF local", "xGA local", "xGF visit", "xGA visit")):
+        etiquetas.append((f"{nombre} (ajust)", ajust_usuario[i], ajust_mercado[i]))
+    comparacion = pd.DataFrame([{"Parámetro": k, "Usuario": float(u), "Mercado": float(m),
+                                 "Diferencia": float(m) / float(u) - 1.0 if u else None}
+                                for k, u, m in etiquetas])
+    return {
+        "lam_loc": lam_loc,
+        "lam_vis": lam_vis,
+        "sigma": sigma,
+        "HFA": p_mercado["HFA"],
+        "params": p_mercado,
+        "comparacion": comparacion,
+        "mercados": tabla_mercados,
+        "margen": margen,
+        "ignorados": ignorados,
+        "residuo_max": float(np.abs(prob_modelo - objetivo).max()),
+        "iteraciones": iteraciones,
+        "convergio": convergio,
+        "segundos": time.perf_counter() - t0,
+    }
+
+# ---------- SENSIBILIDAD (grilla vectorizada) ----------
+GRID_SENS_DEFAULT = {"HFA": [1.05, 1.10, 1.15], "sigma": [0.2, 0.3, 0.4]}
+PARAMS_SENS = ("HFA", "sigma", "xG_liga_equipo", "peso_xg")
+GRID_MAX_CELDAS = 400
+_ETIQUETAS_SENS = {"sigma": "σ"}
+
+def _valor_sens_valido(param, v):
+    """HFA y xG liga > 0, 0 <= sigma <= SIGMA_MAX, 0 <= peso_xg <= 1."""
+    if not math.isfinite(v):
+        return False
+    if param == "sigma":
+        return 0.0 <= v <= SIGMA_MAX
+    if param == "peso_xg":
+        return 0.0 <= v <= 1.0
+    return v > 0
+
+def _distribucion_choques(acc):
+    """(z, w) por bin no vacío a partir de un acumulado (2, BINS_CHOQUES) de `_acumular_choques`."""
+    cnt, suma = acc
+    ok = cnt > 0
+    return suma[ok] / cnt[ok], cnt[ok] / cnt.sum()
+
+def _mercados_celda(P):
+    """1X2 y Over 2.5 de una matriz de probabilidades, sin pasar por pandas."""
+    P = P / P.sum()
+    G = P.shape[0]
+    idx_dif, idx_tot = _indices_matriz(G)
+    dif = np.bincount(idx_dif, weights=P.ravel(), minlength=2 * G - 1)
+    tot = np.bincount(idx_tot, weights=P.ravel(), minlength=2 * G - 1)
+    return {"Local": dif[G:].sum(), "Empate": dif[G - 1], "Visitante": dif[:G - 1].sum(),
+            "Over 2.5": tot[3:].sum()}
+
+def sensibilidad_grid(p, grid=None, engine=None, choques=None):
+    """Evalúa una grilla de sensibilidad en una sola pasada.
+
+    grid: dict parámetro -> lista de valores (producto cartesiano); parámetros
+    admitidos en PARAMS_SENS. Por defecto HFA x sigma 3x3. Valores fuera de rango
+    (ver `_valor_sens_valido`) dan ValueError.
+    Con engine="mc" todas las celdas comparten las mismas normales de los choques
+    (el acumulado `choques` de `simular_mc`, o uno nuevo con p["seed"]): sigma y HFA se aplican por
+    broadcast y la etapa Poisson se integra exactamente sobre la distribución
+    empírica de los choques, así que el costo por celda no depende de n_sims.
+    Con engine="exact" se usan los nodos de Gauss–Hermite; con engine="tabla", las
+    celdas dentro de la grilla de la tabla precalculada (y con cota <= TOLERANCIA)
+    salen de ella y el resto, de los nodos de Gauss–Hermite.
+    """
+    grid = dict(grid or GRID_SENS_DEFAULT)
+    desconocidos = [k for k in grid if k not in PARAMS_SENS]
+    if desconocidos:
+        raise ValueError(f"Parámetros de sensibilidad no soportados: {desconocidos} (usar {PARAMS_SENS})")
+    fuera = [f"{k}={v}" for k, vals in grid.items() for v in vals if not _valor_sens_valido(k, v)]
+    if fuera:
+        raise ValueError(f"Valores de sensibilidad fuera de rango: {fuera}")
+    n_celdas = int(np.prod([len(v) for v in grid.values()]))
+    if n_celdas > GRID_MAX_CELDAS:
+        raise ValueError(f"Grilla de {n_celdas} celdas supera el máximo ({GRID_MAX_CELDAS})")
+    engine = engine or p.get("engine", "mc")
+    tabla = None
+    if engine == "mc":
+        if choques is None:
+            choques = simular_mc(p)["choques"]
+        z_loc, w_loc = _distribucion_choques(choques[0])
+        z_vis, w_vis = _distribucion_choques(choques[1])
+    elif engine in ("exact", "tabla"):
+        z_loc, w_loc = z_vis, w_vis = _nodos_gauss_hermite(32)
+        if engine == "tabla":
+            from tabla_marcadores import TOLERANCIA, tabla_global
+            tabla = tabla_global()
     else:
+        raise ValueError(f"engine desconocido: {engine!r} (usar 'mc', 'exact' o 'tabla')")
+
+    claves = list(grid)
+    filas = []
+    for valores in product(*grid.values()):
+        p2 = dict(p); p2.update(zip(claves, valores))
+        sigma = float(p2.get("sigma", 0.3))
+        lam_loc, lam_vis = lambdas_base(p2)
+        K = max(_goles_max_auto(lam_loc, sigma), _goles_max_auto(lam_vis, sigma))
+        r = tabla.matriz(lam_loc, lam_vis, sigma, K) if tabla is not None else None
+        if r is not None and r[1] <= TOLERANCIA:
+            P = r[0]
+        else:
+            P = np.outer(_pmf_mezcla(lam_loc, sigma, z_loc, w_loc, K),
+                         _pmf_mezcla(lam_vis, sigma, z_vis, w_vis, K))
+        fila = {_ETIQUETAS_SENS.get(k, k): v for k, v in zip(claves, valores)}
+        fila.update(_mercados_celda(P))
+        filas.append(fila)
+    return pd.DataFrame(filas)
+
+# ---------- LOTE DE PARTIDOS (jornada completa) ----------
+def _pmf_mezcla_lote(lam, sigma, z, w, goles_max):
+    """Como `_pmf_mezcla` para F partidos a la vez: lam y sigma de forma (F,), devuelve (F, goles_max+1)."""
+    k = np.arange(goles_max + 1)
+    log_fact = np.concatenate(([0.0], np.cumsum(np.log(k[1:]))))
+    lam_n = lam[:, None] * np.exp(-sigma[:, None]**2 + sigma[:, None] * np.sqrt(2.0) * z[None, :])
+    lam_n = np.clip(lam_n, 1e-6, None)
+    log_pmf = k * np.log(lam_n)[..., None] - lam_n[..., None] - log_fact
+    return np.einsum("n,fnk->fk", w, np.exp(log_pmf))
+
+def _matrices_lote_exacto(partidos, nodos=32):
+    """Matrices de probabilidad (F, G, G) del lote con el motor exacto."""
+    sigma = np.array([float(p.get("sigma", 0.3)) for p in partidos])
+    lam = np.array([lambdas_base(p) for p in partidos])
+    K = max(_goles_max_auto(l, s) for l, s in zip(lam.ravel(), np.repeat(sigma, 2)))
+    z, w = _nodos_gauss_hermite(nodos)
+    pmf_loc = _pmf_mezcla_lote(lam[:, 0], sigma, z, w, K)
+    pmf_vis = _pmf_mezcla_lote(lam[:, 1], sigma, z, w, K)
+    return pmf_loc[:, :, None] * pmf_vis[:, None, :]
+
+def _matrices_lote_mc(partidos, n, seed, tam_bloque=TAM_BLOQUE):
+    """Histogramas de marcadores (F, G, G) del lote con Monte Carlo plano.
+
+    Cada bloque sortea normales (4, F, m) con un Generator propio y las constantes
+    de cada partido (F, 1) se aplican por broadcast; los bloques tienen a lo sumo
+    tam_bloque sorteos en total (F * m) y los goles se recortan a GOLES_MAX_MC, así
+    la memoria no depende de n.
+    """
+    F = len(partidos)
+    c = tuple(np.array(col, dtype=float)[:, None] for col in zip(*map(_constantes_lambdas, partidos)))
+    tamanos = _bloques(n, max(1, int(tam_bloque) // F))
+    filas = np.arange(F, dtype=np.int64)[:, None]
+    total = np.zeros((F, 1, 1), dtype=np.int64)
+    for semilla, m in zip(np.random.SeedSequence(seed).spawn(len(tamanos)), tamanos):
+        rng = np.random.Generator(np.random.PCG64(semilla))
+        lam_loc, lam_vis = _lambdas_choques(c, rng.standard_normal((4, F, m)))
+        g_loc = np.minimum(rng.poisson(lam=lam_loc), GOLES_MAX_MC)
+        g_vis = np.minimum(rng.poisson(lam=lam_vis), GOLES_MAX_MC)
+        del lam_loc, lam_vis
+        G = int(max(g_loc.max(initial=0), g_vis.max(initial=0))) + 1
+        hist = np.bincount(((filas * G + g_loc) * G + g_vis).ravel(), minlength=F * G * G).reshape(F, G, G)
+        del g_loc, g_vis
+        G = max(G, total.shape[1])
+        total = np.pad(total, ((0, 0), (0, G - total.shape[1]), (0, G - total.shape[2]))) \
+            + np.pad(hist, ((0, 0), (0, G - hist.shape[1]), (0, G - hist.shape[2])))
+    return total
+
+def simular_lote(fixtures, n_sims=None, seed=None, engine=None, tam_bloque=None, top_k=5,
+                 nombres_mercados=mercados.MERCADOS_DEFAULT):
+    """Simula una lista de partidos en una sola pasada vectorizada (partidos x simulaciones).
+
+    Cada partido es un dict con las mismas claves que `params` (las que falten se
+    toman de `params`). n_sims, seed y engine son comunes al lote; por defecto los de
+    `params`. Con engine="mc" se usa Monte Carlo plano (sin reducción de varianza ni
+    parada adaptativa); con "exact", la cuadratura de todos los partidos a la vez.
+    nombres_mercados: mercados del registro de `mercados` a cotizar.
+    Devuelve un dict con "partidos" (resumen, top marcadores, probabilidades, cuotas
+    justas y error estándar por partido), "segundos" y "fixtures_por_segundo".
+    """
+    t0 = time.perf_counter()
+    partidos = [dict(params, **f) for f in fixtures]
+    if not partidos:
+        raise ValueError("El lote no tiene partidos")
+    engine = engine or params.get("engine", "mc")
+    n = int(n_sims or params.get("n_sims", 10000))
+    if engine not in ("mc", "exact"):
+        raise ValueError(f"engine desconocido: {engine!r} (usar 'mc' o 'exact')")
+    with etapa("lote", n * len(partidos) if engine == "mc" else None):
+        if engine == "mc":
+            matrices = _matrices_lote_mc(partidos, n, params.get("seed") if seed is None else seed,
+                                         tam_bloque or TAM_BLOQUE)
+        else:
+            matrices = _matrices_lote_exacto(partidos)
+
+    salida = []
+    for p, matriz in zip(partidos, matrices):
+        resumen = resumen_desde_matriz(matriz)
+        precios = mercados.evaluar(matriz, nombres_mercados, n if engine == "mc" else None)
+        prob = {k: v["Prob"] for k, v in precios.items()}
+        salida.append({
+            "equipo_local": p.get("equipo_local"),
+            "equipo_visit": p.get("equipo_visit"),
+            "resumen": {k: float(v) for k, v in resumen.items()},
+            "top_scores": top_marcadores(matriz, top_k).to_dict(orient="records"),
+            "prob": prob,
+            "cuotas_justas": {k: v["Cuota justa"] for k, v in precios.items()},
+            # Error binomial de MC plano; None con el motor exacto
+            "se": {k: v["Error est."] for k, v in precios.items()} if engine == "mc" else None,
+        })
+    dt = time.perf_counter() - t0
+    return {
+        "partidos": salida,
+        "engine": engine,
+        "n_sims": n if engine == "mc" else None,
+        "segundos": dt,
+        "fixtures_por_segundo": len(partidos) / dt if dt > 0 else None,
+    }
+
+def verificar_motor_exacto(p=None, n_sims=200000, z_max=4.0):
+    """Compara el motor exacto con Monte Carlo en los mercados base.
+
+    Devuelve un DataFrame con la diferencia en errores estándar (z) por mercado y
+    una columna "OK" que indica |z| <= z_max.
+    """
+    p = dict(p or params); p["n_sims"] = n_sims
+    m_mc = mercados_desde_resumen(resumen_desde_matriz(matriz_marcadores(p, "mc")))
+    m_ex = mercados_desde_resumen(resumen_desde_matriz(matriz_exacta(p)))
+    filas = []
+    for mercado, p_ex in m_ex.items():
+        se = math.sqrt(max(p_ex * (1 - p_ex), 1e-12) / n_sims)
+        z = (m_mc[mercado] - p_ex) / se
+        filas.append({"Mercado": mercado, "Exacto": p_ex, "MC": m_mc[mercado], "z": z, "OK": abs(z) <= z_max})
+    return pd.DataFrame(filas)
+
+def comparar_reduccion_varianza(p=None, n_sims=200000, workers=1):
+    """Benchmark de los modos de reducción de varianza sobre el partido `p`.
+
+    Para cada modo informa tiempo, eficiencia (ESS/n) y speed-up = (ESS/segundo del
+    modo) / (ESS/segundo de MC plano), mínimo y mediana entre los mercados seguidos:
+    cuántas veces más rápido se alcanza la misma precisión.
+    """
+    p = dict(p or params, n_sims=n_sims, workers=workers)
+    filas, base = [], None
+    for modo in MODOS_VR:
+        t0 = time.perf_counter()
+        sim = simular_mc(dict(p, reduccion_varianza=modo))
+        dt = time.perf_counter() - t0
+        ess_s = np.array(list(sim["ess"].values())) / dt
+        base = ess_s if base is None else base
+        filas.append({"Modo": modo or "plano", "n": n_sims, "Tiempo (s)": dt,
+                      "Eficiencia (mín)": sim["eficiencia"],
+                      "Eficiencia (mediana)": float(np.median(ess_s * dt)) / n_sims,
+                      "Speed-up (mín)": float((ess_s / base).min()),
+                      "Speed-up (mediana)": float(np.median(ess_s / base)),
+                      "SE máx": max(sim["se"].values())})
+    return pd.DataFrame(filas)
+
+# ---------- EXPORTACIÓN ----------
+FILAS_CHUNK_MUESTRAS = 250_000
+
+def frecuencias_marcadores(matriz):
+    """Tabla de marcadores (g_loc, g_vis, Prob y Conteo si hay conteos) ordenada por probabilidad."""
+    M = np.asarray(matriz)
+    flat = M.ravel()
+    orden = np.argsort(-flat, kind="stable")
+    orden = orden[flat[orden] > 0]
+    g_loc, g_vis = np.divmod(orden, M.shape[1])
+    tabla = pd.DataFrame({"g_loc": g_loc, "g_vis": g_vis, "Prob": flat[orden] / flat.sum()})
+    if np.issubdtype(M.dtype, np.integer):
+        tabla["Conteo"] = flat[orden]
+    return tabla
+
+def _escribir_tabla(ws, fila, col, tabla, fmt_h, formatos):
+    """Escribe encabezado y filas de un DataFrame en orden (compatible con constant_memory)."""
+    for c, h in enumerate(tabla.columns):
+        ws.write(fila, col + c, h, fmt_h)
+    for r, valores in enumerate(tabla.itertuples(index=False), start=fila + 1):
+        for c, (h, v) in enumerate(zip(tabla.columns, valores)):
+            if v is None or (isinstance(v, float) and not math.isfinite(v)):
+                continue
+            ws.write(r, col + c, v.item() if isinstance(v, np.generic) else v, formatos.get(h))
+
+def export_rushapo_excel(params,resumen,top_scores,sens_df,cuotas_df,df,file_name="Rushapo_Simulacion_Completa.xlsx",
+                         matriz=None):
+    """Exporta un reporte a Excel.
+
+    Con xlsxwriter escribe en modo constant_memory (fila a fila, memoria acotada);
+    si no está instalado, exporta una versión simple con pandas. file_name puede ser
+    una ruta o un buffer binario (p.ej. io.BytesIO).
+    Con `matriz` se agrega la hoja "Frecuencias" (un renglón por marcador). La hoja
+    "Simulaciones" con las muestras crudas solo se escribe si df no es None; para
+    muchas muestras conviene `exportar_muestras` (CSV/Parquet).
+    """
+    try:
+        import xlsxwriter
+    except ImportError:
+        xlsxwriter = None
+    frecuencias = frecuencias_marcadores(matriz) if matriz is not None else None
+
+    if xlsxwriter is None:
         # Exportación simple sin estilos
         with pd.ExcelWriter(file_name) as writer:
             resumen.rename("Valor").to_frame().reset_index().to_excel(writer, sheet_name="Resumen", index=False)
             top_scores.to_excel(writer, sheet_name="Marcadores", index=False)
+            if frecuencias is not None:
+                frecuencias.to_excel(writer, sheet_name="Frecuencias", index=False)
             sens_df.to_excel(writer, sheet_name="Sensibilidad", index=False)
             cuotas_df.to_excel(writer, sheet_name="Cuotas & EV", index=False)
-            df.to_excel(writer, sheet_name="Simulaciones", index=False)
+            if df is not None:
+                df.to_excel(writer, sheet_name="Simulaciones", index=False)
+        return file_name
+
+    wb = xlsxwriter.Workbook(file_name, {"constant_memory": True})
+    negro, dorado, gris = "#0B0B0C", "#D4AF37", "#F2F2F2"
+    fmt_t = wb.add_format({"bold": True, "font_size": 20, "font_color": dorado, "bg_color": negro, "align": "center"})
+    fmt_h = wb.add_format({"bold": True, "font_color": "#000000", "bg_color": gris, "border": 1, "align": "center"})
+    pct = wb.add_format({"num_format": "0.00%", "border": 1, "align": "center"})
+    num = wb.add_format({"num_format": "0.00", "border": 1, "align": "center"})
+    txt = wb.add_format({"border": 1, "align": "center"})
+    entero = wb.add_format({"num_format": "0", "border": 1, "align": "center"})
+    formatos = {"Prob": pct, "Cuota justa": num, "Error est.": pct, "Conteo": entero,
+                "g_loc": entero, "g_vis": entero, "Local": pct, "Empate": pct, "Visitante": pct, "Over 2.5": pct}
+
+    # --- RESUMEN ---
+    ws = wb.add_worksheet("Resumen")
+    ws.merge_range(1, 1, 2, 9, f"RUSHAPO – Simulación Monte Carlo (xG)", fmt_t)
+    ws.write(4, 1, "Partido", fmt_h); ws.merge_range(4, 2, 4, 6, f'{params["equipo_local"]} vs {params["equipo_visit"]}', txt)
+    ws.write(5, 1, "Fecha", fmt_h); ws.merge_range(5, 2, 5, 6, datetime.now().strftime("%Y-%m-%d %H:%M"), txt)
+    ws.write(6, 1, "HFA", fmt_h); ws.write(6, 2, params["HFA"], num)
+    ws.write(6, 3, "σ (volatilidad)", fmt_h); ws.write(6, 4, params["sigma"], num)
+    ws.write(6, 5, "Simulaciones", fmt_h); ws.write(6, 6, params["n_sims"], num)
+    ws.write(10, 1, "Métrica", fmt_h); ws.write(10, 2, "Valor", fmt_h)
+    for r, (label, val) in enumerate(resumen.items(), start=11):
+        ws.write(r, 1, label, txt)
+        ws.write(r, 2, float(val), pct if "%" in label else num)
+
+    # --- MARCADORES ---
+    ws2 = wb.add_worksheet("Marcadores")
+    ws2.set_column(1, 3, 15)
+    ws2.merge_range(1, 1, 1, 5, "RUSHAPO – Marcadores más probables", fmt_t)
+    _escribir_tabla(ws2, 3, 1, top_scores, fmt_h, formatos)
 
+    # --- FRECUENCIAS (todos los marcadores: reemplaza a las muestras crudas) ---
+    if frecuencias is not None:
+        ws5 = wb.add_worksheet("Frecuencias")
+        ws5.set_column(1, 4, 15)
+        ws5.merge_range(1, 1, 1, 5, "RUSHAPO – Frecuencia de marcadores", fmt_t)
+        _escribir_tabla(ws5, 3, 1, frecuencias, fmt_h, formatos)
+
+    # --- SENSIBILIDAD ---
+    ws3 = wb.add_worksheet("Sensibilidad")
+    ws3.set_column(1, 6, 15)
+    ws3.merge_range(1, 1, 1, 6, "RUSHAPO – Análisis de Sensibilidad", fmt_t)
+    _escribir_tabla(ws3, 3, 1, sens_df, fmt_h, formatos)
+
+    # --- CUOTAS & EV ---
+    ws4 = wb.add_worksheet("Cuotas & EV")
+    ws4.set_column(1, 8, 15)
+    ws4.merge_range(1, 1, 1, 8, "RUSHAPO – Cuotas & Value Bets", fmt_t)
+    _escribir_tabla(ws4, 3, 1, cuotas_df, fmt_h, formatos)
+
+    # --- SIMULACIONES (opcional) ---
+    if df is not None:
+        ws6 = wb.add_worksheet("Simulaciones")
+        ws6.write_row(0, 0, list(df.columns))
+        for r, fila in enumerate(zip(*(df[c].tolist() for c in df.columns)), start=1):
+            ws6.write_row(r, 0, fila)
+    wb.close()
     return file_name
 
+def iterar_muestras(p):
+    """Genera las muestras crudas (g_loc, g_vis) bloque a bloque, sin acumularlas.
+
+    Usa los mismos bloques y semillas que `simular_mc(p)`, así que reproduce
+    exactamente esa corrida; la memoria depende del tamaño de bloque y no de n_sims.
+    """
+    n = int(p.get("n_sims", 10000))
+    if n < 1:
+        raise ValueError(f"n_sims debe ser >= 1 (recibido {n})")
+    tamanos = _bloques(n, _tam_bloque_mc(p, n))
+    for semilla, m in zip(np.random.SeedSequence(p.get("seed")).spawn(len(tamanos)), tamanos):
+        yield _simular_bloque(p, semilla, m, True)[2]
+
+def _chunks_muestras(p, filas=FILAS_CHUNK_MUESTRAS):
+    """DataFrames (g_loc, g_vis) de a lo sumo `filas` renglones, en el orden de la corrida."""
+    for g_loc, g_vis in iterar_muestras(p):
+        for i in range(0, len(g_loc), filas):
+            yield muestras_a_dataframe(g_loc[i:i + filas], g_vis[i:i + filas])
+
+def muestras_csv(p, filas=FILAS_CHUNK_MUESTRAS):
+    """Muestras crudas como texto CSV por partes (para respuestas HTTP en streaming)."""
+    for i, chunk in enumerate(_chunks_muestras(p, filas)):
+        yield chunk.to_csv(index=False, header=(i == 0))
+
+def exportar_muestras(p, destino, formato="csv", filas=FILAS_CHUNK_MUESTRAS):
+    """Escribe las muestras crudas de `simular_mc(p)` en CSV o Parquet, por partes.
+
+    destino: ruta o archivo binario abierto. No hay tope de filas (a diferencia de
+    Excel) y la memoria no depende de n_sims. Parquet requiere pyarrow (un row group
+    por parte).
+    """
+    if formato == "csv":
+        with (open(destino, "wb") if isinstance(destino, (str, os.PathLike)) else nullcontext(destino)) as f:
+            for txt in muestras_csv(p, filas):
+                f.write(txt.encode("utf-8"))
+        return destino
+    if formato == "parquet":
+        try:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+        except ImportError as e:
+            raise ImportError("La exportación a Parquet requiere pyarrow (pip install pyarrow)") from e
+        escritor = None
+        try:
+            for chunk in _chunks_muestras(p, filas):
+                tabla = pa.Table.from_pandas(chunk, preserve_index=False)
+                if escritor is None:
+                    escritor = pq.ParquetWriter(destino, tabla.schema)
+                escritor.write_table(tabla)
+        finally:
+            if escritor is not None:
+                escritor.close()
+        return destino
+    raise ValueError(f"formato desconocido: {formato!r} (usar 'csv' o 'parquet')")
 
-def run_simulacion_completa(p=None, mostrar_graficos=True, exportar_excel=True):
+def run_simulacion_completa(p=None, mostrar_graficos=True, exportar_excel=True, devolver_muestras=False, engine=None,
+                            grid_sens=None, progreso=None, mercados_cuotas=mercados.MERCADOS_DEFAULT):
     """Ejecuta la simulación completa con gráficos y exportación opcional.
 
-    Retorna un diccionario con objetos claves de la corrida.
+    Las métricas, marcadores y mercados salen de la matriz de marcadores; el
+    DataFrame por simulación solo se construye con `devolver_muestras=True` (y
+    entonces también va a la hoja "Simulaciones" del Excel). El Excel lleva por
+    defecto la hoja "Frecuencias"; para muestras crudas ver `exportar_muestras`.
+    engine: "mc" (Monte Carlo), "exact" (cuadratura, sin muestras ni ruido) o
+    "tabla" (interpolación de la tabla precalculada, ver `matriz_tabla`); por
+    defecto se toma de p["engine"].
+    grid_sens: dict parámetro -> valores para la sensibilidad (ver `sensibilidad_grid`).
+    Con p["se_objetivo"] (o p["ic_objetivo"]) el motor Monte Carlo para en cuanto todos
+    los mercados alcanzan ese error y n_sims pasa a ser el presupuesto máximo
+    (ver `simular_mc_adaptativo`).
+    progreso: callback por bloque del motor Monte Carlo (ver `simular_mc`).
+    mercados_cuotas: nombres del registro de `mercados` para la tabla de cuotas base.
+    Retorna un diccionario con objetos claves de la corrida; "precision" informa las
+    simulaciones usadas y el error estándar logrado (None con el motor exacto) e
+    "interpolacion" la fuente y la cota de error del motor "tabla".
     """
     p = p or params
-    df = sim_partido_xg(p)
-    resumen = resumen_estadistico(df)
+    engine = engine or p.get("engine", "mc")
+    df = None
+    precision = None
+    interpolacion = None
+    # Cada etapa se mide (metricas.etapa): histogramas de /metrics y Server-Timing en la web
+    if engine == "mc":
+        with etapa("sim") as medida:
+            adaptativo = bool(p.get("se_objetivo") or p.get("ic_objetivo"))
+            if adaptativo:
+                sim = simular_mc_adaptativo(p, p.get("se_objetivo"), p.get("ic_objetivo"), progreso=progreso)
+            n = int(sim["n"] if adaptativo else p.get("n_sims", 10000))
+            guardar = devolver_muestras
+            if guardar and n > MAX_MUESTRAS:
+                # Streaming: solo agregados; la hoja "Simulaciones" se omite
+                print(f"[Aviso] n_sims={n} > {MAX_MUESTRAS}: no se guardan muestras crudas")
+                guardar = False
+            if adaptativo and guardar:
+                # Misma corrida (mismos bloques y semillas) guardando las muestras
+                tamanos = _bloques(n, _tam_bloque_adaptativo(p))
+                semillas = np.random.SeedSequence(p.get("seed")).spawn(len(tamanos))
+                muestras = _ejecutar_bloques(p, semillas, tamanos, guardar_muestras=True)
+                sim["g_loc"], sim["g_vis"] = muestras["g_loc"], muestras["g_vis"]
+            elif not adaptativo:
+                sim = simular_mc(p, guardar_muestras=guardar, progreso=progreso)
+            matriz = sim["matriz"]
+            if "g_loc" in sim:
+                df = muestras_a_dataframe(sim.pop("g_loc"), sim.pop("g_vis"))
+            medida["n"] = n
+        # ---------- SENSIBILIDAD (mismas normales que la corrida base) ----------
+        with etapa("sens"):
+            sens_df = sensibilidad_grid(p, grid_sens, engine, choques=sim["choques"])
+    elif engine == "tabla":
+        with etapa("sim"):
+            matriz, interpolacion = matriz_tabla(p)
+        with etapa("sens"):
+            sens_df = sensibilidad_grid(p, grid_sens, engine)
+    else:
+        with etapa("sim"):
+            matriz = matriz_marcadores(p, engine)
+        with etapa("sens"):
+            sens_df = sensibilidad_grid(p, grid_sens, engine)
+    with etapa("resumen"):
+        resumen = resumen_desde_matriz(matriz)
+    if engine == "mc":
+        precision = {
+            "n_usado": sim["n"],
+            "se": sim["se"],
+            "se_max": max(sim["se"].values()),
+            "se_objetivo": sim.get("se_objetivo"),
+            "convergio": sim.get("convergio"),
+            "modo": sim["modo"],
+            "ess": sim["ess"],
+            "eficiencia": sim["eficiencia"],
+        }
     # Añadir al resumen los parámetros ajustados para transparencia
-    def _blend(xg, goles):
-        try:
-            return 0.7 * float(xg) + 0.3 * float(goles)
-        except (TypeError, ValueError):
-            return float(xg)
-    xGF_local_adj = _blend(p.get("xGF_local_prom"), p.get("gf_local_10"))
-    xGA_local_adj = _blend(p.get("xGA_local_prom"), p.get("ga_local_10"))
-    xGF_visit_adj = _blend(p.get("xGF_visit_prom"), p.get("gf_visit_10"))
-    xGA_visit_adj = _blend(p.get("xGA_visit_prom"), p.get("ga_visit_10"))
+    xGF_local_adj, xGA_local_adj, xGF_visit_adj, xGA_visit_adj = xg_ajustados(p)
     resumen["xGF local (ajust)"] = xGF_local_adj
     resumen["xGA local (ajust)"] = xGA_local_adj
     resumen["xGF visit (ajust)"] = xGF_visit_adj
     resumen["xGA visit (ajust)"] = xGA_visit_adj
-    score_counts = df.groupby(["g_loc", "g_vis"]).size().sort_values(ascending=False)
-    top_scores = (score_counts.head(10) / len(df)).rename("Prob").reset_index()
+    with etapa("top"):
+        top_scores = top_marcadores(matriz, 10)
 
     # ---------- CUOTAS Y VALUE BETS BASE (sin odds externas) ----------
-    # Se calculan cuotas justas a partir de las probabilidades simuladas.
-    mercados_prob = {
-        "Local": resumen.get("% Local"),
-        "Empate": resumen.get("% Empate"),
-        "Visitante": resumen.get("% Visitante"),
-        "Over 2.5": resumen.get("% Over 2.5"),
-        "BTTS": resumen.get("% BTTS"),
-        "Under 2.5": 1 - resumen.get("% Over 2.5", 0),
-        "BTTS No": 1 - resumen.get("% BTTS", 0),
-        "Over 3.5": resumen.get("% Over 3.5"),
-        "Under 3.5": 1 - resumen.get("% Over 3.5", 0),
-    }
-    cuotas_base_rows = []
-    for mercado, pmerc in mercados_prob.items():
-        if pmerc and pmerc > 0:
-            cuotas_base_rows.append({
-                "Mercado": mercado,
-                "Prob": pmerc,
-                "Cuota justa": 1 / pmerc,
-            })
-    cuotas_df = pd.DataFrame(cuotas_base_rows)
-
-    # ---------- SENSIBILIDAD ----------
-    HFA_values, sigma_values = [1.05, 1.10, 1.15], [0.2, 0.3, 0.4]
-    sensibilidad = []
-    for h, s in product(HFA_values, sigma_values):
-        p2 = p.copy(); p2["HFA"] = h; p2["sigma"] = s
-        df_temp = sim_partido_xg(p2); r = resumen_estadistico(df_temp)
-        sensibilidad.append({
-            "HFA": h, "σ": s, "Local": r["% Local"], "Empate": r["% Empate"], "Visitante": r["% Visitante"]
-        })
-    sens_df = pd.DataFrame(sensibilidad)
+    # Se calculan cuotas justas a partir de la matriz con el registro de mercados.
+    with etapa("cuotas"):
+        cuotas_df = cuotas_desde_matriz(matriz, mercados_cuotas, precision)
 
     if mostrar_graficos:
         try:
+            import matplotlib.pyplot as plt
+            import seaborn as sns
+            tot = np.add.outer(np.arange(matriz.shape[0]), np.arange(matriz.shape[1]))
+            goles_tot = np.bincount(tot.ravel(), weights=matriz.ravel())
             plt.figure(figsize=(6, 4))
-            plt.hist(df.g_loc + df.g_vis, bins=range(0, 8), rwidth=0.8)
+            plt.bar(np.arange(min(len(goles_tot), 7)), goles_tot[:7], width=0.8)
             plt.title("Distribución de Goles Totales")
             plt.xlabel("Goles"); plt.ylabel("Frecuencia"); plt.show()
 
-            res_counts = df.res.value_counts(normalize=True)
+            res_counts = resumen[["% Local", "% Empate", "% Visitante"]].rename(lambda k: k[2:])
             res_counts.plot(kind="bar", color=["#66bb6a", "#ffee58", "#ef5350"])
             plt.title("Probabilidad de Resultado"); plt.ylabel("Probabilidad"); plt.show()
 
-            sns.heatmap(
-                sens_df.pivot(index="HFA", columns="σ", values="Local"),
-                annot=True,
-                cmap="YlGnBu"
-            )
-            plt.title("Probabilidad de Victoria Local (Sensibilidad)"); plt.show()
+            ejes = [c for c in sens_df.columns if c not in ("Local", "Empate", "Visitante", "Over 2.5")]
+            if len(ejes) == 2:
+                sns.heatmap(
+                    sens_df.pivot(index=ejes[0], columns=ejes[1], values="Local"),
+                    annot=True,
+                    cmap="YlGnBu"
+                )
+                plt.title("Probabilidad de Victoria Local (Sensibilidad)"); plt.show()
         except Exception as e:
             print("[Aviso] No se pudieron mostrar gráficos:", e)
 
     excel_path = None
     if exportar_excel:
         try:
-            excel_path = export_rushapo_excel(p, resumen, top_scores, sens_df, cuotas_df, df)
+            with etapa("excel"):
+                excel_path = export_rushapo_excel(p, resumen, top_scores, sens_df, cuotas_df, df, matriz=matriz)
             print("✅ Archivo generado:", excel_path)
+            files = _colab_files()
             if files:
                 files.download(excel_path)
         except Exception as e:
@@ -282,15 +1476,29 @@ def run_simulacion_completa(p=None, mostrar_graficos=True, exportar_excel=True):
 
     return {
         "df": df,
+        "matriz": matriz,
         "resumen": resumen,
         "top_scores": top_scores,
         "cuotas_base": cuotas_df,
         "sens_df": sens_df,
         "excel": excel_path,
+        "engine": engine,
+        "precision": precision,
+        "interpolacion": interpolacion,
     }
 
 
 if __name__ == "__main__":
+    import sys
+    if "--verificar" in sys.argv:
+        # Chequeo motor exacto vs Monte Carlo (dentro del error de muestreo)
+        comp = verificar_motor_exacto(params)
+        print(comp.to_string(index=False))
+        sys.exit(0 if comp["OK"].all() else 1)
+    if "--benchmark-vr" in sys.argv:
+        # Reducción de varianza vs MC plano sobre el partido por defecto
+        print(comparar_reduccion_varianza(params).to_string(index=False))
+        sys.exit(0)
     # Ejecución directa de ejemplo
     resultados = run_simulacion_completa(params, mostrar_graficos=True, exportar_excel=True)
     print(resultados["resumen"])
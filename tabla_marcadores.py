@@ -0,0 +1,275 @@
+"""
+Tabla precalculada de distribuciones de goles para el motor "tabla".
+
+Todo el pricing de un partido pasa por (lam_loc, lam_vis, sigma): la matriz de
+marcadores del motor exacto es el producto exterior de dos marginales
+Poisson-lognormal, `pmf_goles_exacta(lam_loc, sigma)` y `pmf_goles_exacta(lam_vis, sigma)`.
+Por eso basta tabular la marginal sobre una grilla 2D (lam, sigma) para cubrir
+el espacio 3D completo: la matriz se arma con dos interpolaciones y un producto
+exterior.
+
+- Grilla: lam equiespaciado en log (LAM_MIN..LAM_MAX), sigma equiespaciado; por
+  nodo la pmf de 0..goles_max goles y la masa de cola que queda afuera.
+- Interpolación: Lagrange cúbica (4 x 4 nodos) en (log lam, sigma).
+- Cota: al construir se compara la interpolación con la pmf exacta en el centro
+  y en los puntos medios de los lados de cada celda; el peor error L1 por celda
+  (por COTA_SEGURIDAD) es la cota de cada marginal y de ahí sale la del
+  producto exterior. Acota el error de cualquier probabilidad de mercado
+  respecto de `matriz_exacta` con el mismo tope de goles (mismos nodos de
+  cuadratura); si el tope pedido supera el de la tabla se suma la cola.
+
+Formato del archivo: MAGIC, largo del encabezado (uint64 LE), encabezado JSON
+(grilla, offsets y formas de los arreglos) y los arreglos float64 alineados a
+64 bytes. Se abre con `np.memmap` de solo lectura: los workers de gunicorn
+comparten las páginas a través del page cache del sistema.
+
+Uso:
+    python tabla_marcadores.py construir [--salida rushapo_tabla.bin] [--n-lam 384] [--n-sigma 101] ...
+    python tabla_marcadores.py info rushapo_tabla.bin
+"""
+import argparse
+import json
+import math
+import os
+import struct
+import sys
+import threading
+import time
+from datetime import datetime, timezone
+
+import numpy as np
+
+from simulador_rushapo import _nodos_gauss_hermite, _pmf_mezcla_lote, pmf_goles_exacta
+
+MAGIC = b"RUSHTAB\x01"
+ALINEACION = 64
+# Grilla por defecto: cubre lambdas de 0.05 a 6 goles y sigma de 0 a 1
+LAM_MIN, LAM_MAX, N_LAM = 0.05, 6.0, 384
+SIGMA_MIN, SIGMA_MAX, N_SIGMA = 0.0, 1.0, 101
+GOLES_TABLA = 63
+NODOS = 32
+# Margen sobre el peor error medido en cada celda
+COTA_SEGURIDAD = 2.0
+# Por encima de esta cota (error máximo en una probabilidad) se calcula en vivo
+TOLERANCIA = 1e-6
+ARCHIVO_DEFAULT = "rushapo_tabla.bin"
+
+
+def _pesos_cubicos(t):
+    """Pesos de Lagrange de los nodos -1, 0, 1, 2 evaluados en t."""
+    return np.array([-t * (t - 1) * (t - 2) / 6, (t + 1) * (t - 1) * (t - 2) / 2,
+                     -(t + 1) * t * (t - 2) / 2, (t + 1) * t * (t - 1) / 6])
+
+
+def _stencil(x, n):
+    """Primer nodo del stencil de 4 (pegado al borde si hace falta) y posición relativa."""
+    i = min(max(math.floor(x), 1), n - 3)
+    return i - 1, x - i
+
+
+def _escribir(ruta, meta, arreglos):
+    """Escribe encabezado y arreglos en un temporal y lo renombra (nunca queda un archivo a medias)."""
+    offset, especs = 0, {}
+    for nombre, a in arreglos.items():
+        especs[nombre] = {"offset": offset, "shape": list(a.shape), "dtype": a.dtype.str}
+        offset += -(-a.nbytes // ALINEACION) * ALINEACION
+    meta = dict(meta, arreglos=especs)
+    encabezado = json.dumps(meta).encode("utf-8")
+    # Los datos empiezan alineados: offsets relativos al final del encabezado
+    inicio = -(-(len(MAGIC) + 8 + len(encabezado)) // ALINEACION) * ALINEACION
+    encabezado += b" " * (inicio - len(MAGIC) - 8 - len(encabezado))
+    tmp = f"{ruta}.tmp{os.getpid()}"
+    with open(tmp, "wb") as f:
+        f.write(MAGIC + struct.pack("<Q", len(encabezado)) + encabezado)
+        for nombre, a in arreglos.items():
+            f.seek(inicio + especs[nombre]["offset"])
+            f.write(np.ascontiguousarray(a).tobytes())
+        f.truncate(inicio + offset)
+    os.replace(tmp, ruta)
+    return meta
+
+
+def construir_tabla(ruta=ARCHIVO_DEFAULT, lam_min=LAM_MIN, lam_max=LAM_MAX, n_lam=N_LAM, sigma_min=SIGMA_MIN,
+                    sigma_max=SIGMA_MAX, n_sigma=N_SIGMA, goles_max=GOLES_TABLA, nodos=NODOS):
+    """Calcula la tabla sobre la grilla, mide el error de interpolación y la guarda en `ruta`.
+
+    Devuelve el encabezado escrito (grilla, error máximo y segundos de construcción).
+    """
+    if not 0 < lam_min < lam_max or not 0 <= sigma_min < sigma_max:
+        raise ValueError("Rangos de la grilla inválidos (0 < lam_min < lam_max, 0 <= sigma_min < sigma_max)")
+    if n_lam < 4 or n_sigma < 4:
+        raise ValueError("La interpolación cúbica necesita al menos 4 nodos por eje")
+    t0 = time.perf_counter()
+    u = np.linspace(np.log(lam_min), np.log(lam_max), n_lam)
+    s = np.linspace(sigma_min, sigma_max, n_sigma)
+    z, w = _nodos_gauss_hermite(nodos)
+
+    def pmfs(lams, sigma):
+        return _pmf_mezcla_lote(lams, np.full(len(lams), sigma), z, w, goles_max)
+
+    pmf = np.stack([pmfs(np.exp(u), sj) for sj in s], axis=1)
+    meta = {"version": 1, "lam_min": lam_min, "lam_max": lam_max, "n_lam": n_lam, "sigma_min": sigma_min,
+            "sigma_max": sigma_max, "n_sigma": n_sigma, "goles_max": goles_max, "nodos": nodos,
+            "cota_seguridad": COTA_SEGURIDAD}
+    tabla = TablaMarcadores(meta, pmf, np.zeros((n_lam - 1, n_sigma - 1)), np.zeros((n_lam - 1, n_sigma - 1)))
+
+    # Error L1 de la interpolación en el centro y en los puntos medios de los lados de cada celda
+    u_medio, s_medio = (u[:-1] + u[1:]) / 2, (s[:-1] + s[1:]) / 2
+    err = np.zeros((n_lam - 1, n_sigma - 1))
+    for j in range(n_sigma - 1):
+        for lams, sigma in ((np.exp(u_medio), s_medio[j]), (np.exp(u_medio), s[j]), (np.exp(u[:-1]), s_medio[j])):
+            interp = np.array([tabla._interpolar(lam, sigma)[0] for lam in lams])
+            err[:, j] = np.maximum(err[:, j], np.abs(interp - pmfs(lams, sigma)).sum(axis=1))
+    # Masa por encima de goles_max: la mayor de los cuatro nodos de cada celda
+    cola = np.clip(1.0 - pmf.sum(axis=2), 0.0, None)
+    cola = np.maximum.reduce([cola[:-1, :-1], cola[1:, :-1], cola[:-1, 1:], cola[1:, 1:]])
+    meta.update(error_max=float(err.max()), segundos=time.perf_counter() - t0,
+                fecha=datetime.now(timezone.utc).isoformat(timespec="seconds"))
+    return _escribir(ruta, meta, {"pmf": pmf, "error": COTA_SEGURIDAD * err, "cola": cola})
+
+
+class TablaMarcadores:
+    """Tabla de pmfs de goles sobre (lam, sigma) con interpolación y cota de error.
+
+    Se crea con `abrir_tabla`; los arreglos son vistas de solo lectura (memmap).
+    """
+
+    def __init__(self, meta, pmf, error, cola, ruta=None):
+        self.meta, self.ruta = meta, ruta
+        self.pmf, self.error, self.cola = pmf, error, cola
+        self._u0 = math.log(meta["lam_min"])
+        self._hu = (math.log(meta["lam_max"]) - self._u0) / (meta["n_lam"] - 1)
+        self._hs = (meta["sigma_max"] - meta["sigma_min"]) / (meta["n_sigma"] - 1)
+
+    def contiene(self, lam, sigma):
+        m = self.meta
+        return m["lam_min"] <= lam <= m["lam_max"] and m["sigma_min"] <= sigma <= m["sigma_max"]
+
+    def _interpolar(self, lam, sigma, goles=None):
+        """pmf interpolada de 0..goles-1 goles (por defecto todos), cota L1 de su error y cola de la celda."""
+        m = self.meta
+        x = (math.log(lam) - self._u0) / self._hu
+        y = (sigma - m["sigma_min"]) / self._hs
+        i, tx = _stencil(x, m["n_lam"])
+        j, ty = _stencil(y, m["n_sigma"])
+        pmf = _pesos_cubicos(tx) @ (_pesos_cubicos(ty) @ self.pmf[i:i + 4, j:j + 4, :goles])
+        # Lejos de la moda la interpolación puede dar negativos del orden de la cota
+        np.maximum(pmf, 0.0, out=pmf)
+        celda = min(max(int(x), 0), m["n_lam"] - 2), min(max(int(y), 0), m["n_sigma"] - 2)
+        return pmf, float(self.error[celda]), float(self.cola[celda])
+
+    def matriz(self, lam_loc, lam_vis, sigma, goles_max=None):
+        """(matriz [g_loc, g_vis], cota) o None si algún lambda o sigma cae fuera de la grilla.
+
+        La matriz llega hasta goles_max (por defecto el de la tabla). La cota acota
+        el error de cualquier probabilidad de mercado (suma de celdas con pesos
+        entre 0 y 1) respecto de `matriz_exacta` con ese mismo goles_max.
+        """
+        if not (self.contiene(lam_loc, sigma) and self.contiene(lam_vis, sigma)):
+            return None
+        goles_max = self.meta["goles_max"] if goles_max is None else goles_max
+        a, e_loc, cola_loc = self._interpolar(lam_loc, sigma, goles_max + 1)
+        b, e_vis, cola_vis = self._interpolar(lam_vis, sigma, goles_max + 1)
+        if goles_max > self.meta["goles_max"]:
+            # La tabla no llega al tope pedido: lo que falta es a lo sumo la cola
+            e_loc, e_vis = e_loc + cola_loc, e_vis + cola_vis
+        return a[:, None] * b[None, :], e_loc + e_vis + e_loc * e_vis
+
+
+def abrir_tabla(ruta):
+    """Abre la tabla de `ruta` como memmap de solo lectura (no copia los datos a memoria del proceso)."""
+    with open(ruta, "rb") as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f"{ruta} no es una tabla de marcadores (o es de otra versión)")
+        largo, = struct.unpack("<Q", f.read(8))
+        meta = json.loads(f.read(largo).decode("utf-8"))
+    inicio = len(MAGIC) + 8 + largo
+    # Vistas ndarray del memmap: el slicing de un ndarray es más barato que el de np.memmap
+    arreglos = {nombre: np.memmap(ruta, dtype=e["dtype"], mode="r", offset=inicio + e["offset"],
+                                  shape=tuple(e["shape"])).view(np.ndarray)
+                for nombre, e in meta.pop("arreglos").items()}
+    return TablaMarcadores(meta, arreglos["pmf"], arreglos["error"], arreglos["cola"], ruta=ruta)
+
+
+_tabla = None
+_tabla_cargada = False
+_lock = threading.Lock()
+
+
+def usar_tabla(ruta):
+    """Fija la tabla del proceso (None la desactiva) en lugar de la de RUSHAPO_TABLA."""
+    global _tabla, _tabla_cargada
+    with _lock:
+        _tabla, _tabla_cargada = (abrir_tabla(ruta) if ruta else None), True
+    return _tabla
+
+
+def tabla_global():
+    """Tabla del proceso: la de `usar_tabla` o, la primera vez, la de RUSHAPO_TABLA (None si no hay)."""
+    global _tabla, _tabla_cargada
+    if not _tabla_cargada:
+        with _lock:
+            if not _tabla_cargada:
+                ruta = os.getenv("RUSHAPO_TABLA")
+                _tabla, _tabla_cargada = (abrir_tabla(ruta) if ruta else None), True
+    return _tabla
+
+
+def _info(ruta, consultas=20_000):
+    tabla = abrir_tabla(ruta)
+    m = tabla.meta
+    print(f"{ruta}: {os.path.getsize(ruta) / 2**20:.1f} MB (construida {m.get('fecha')} en {m.get('segundos', 0):.1f} s)")
+    print(f"lam {m['lam_min']}..{m['lam_max']} ({m['n_lam']} nodos, log) · sigma {m['sigma_min']}..{m['sigma_max']} "
+          f"({m['n_sigma']} nodos) · goles 0..{m['goles_max']} · cuadratura {m['nodos']} nodos")
+    print(f"Error L1 máximo de interpolación medido: {m['error_max']:.2e}")
+    rng = np.random.default_rng(0)
+    lams = np.exp(rng.uniform(np.log(0.3), np.log(3.5), (consultas, 2)))
+    sigmas = rng.uniform(0.05, 0.6, consultas)
+    t0 = time.perf_counter()
+    cotas = [tabla.matriz(a, b, s)[1] for (a, b), s in zip(lams, sigmas)]
+    dt = time.perf_counter() - t0
+    print(f"Consulta: {dt / consultas * 1e6:.1f} µs por matriz · cota máx. {max(cotas):.2e} "
+          f"(lam 0.3..3.5, sigma 0.05..0.6)")
+    a, b, s = lams[0, 0], lams[0, 1], sigmas[0]
+    P, cota = tabla.matriz(a, b, s)
+    K = P.shape[0] - 1
+    exacta = np.outer(pmf_goles_exacta(a, s, K, m["nodos"]), pmf_goles_exacta(b, s, K, m["nodos"]))
+    print(f"Ejemplo lam=({a:.3f}, {b:.3f}) sigma={s:.3f}: error L1 real {np.abs(P - exacta).sum():.2e} "
+          f"<= cota {cota:.2e}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Tabla precalculada de distribuciones de goles (motor 'tabla')")
+    sub = parser.add_subparsers(dest="comando", required=True)
+    pc = sub.add_parser("construir", help="calcula la tabla y la guarda en un archivo binario")
+    pc.add_argument("--salida", default=ARCHIVO_DEFAULT)
+    pc.add_argument("--lam-min", type=float, default=LAM_MIN)
+    pc.add_argument("--lam-max", type=float, default=LAM_MAX)
+    pc.add_argument("--n-lam", type=int, default=N_LAM)
+    pc.add_argument("--sigma-min", type=float, default=SIGMA_MIN)
+    pc.add_argument("--sigma-max", type=float, default=SIGMA_MAX)
+    pc.add_argument("--n-sigma", type=int, default=N_SIGMA)
+    pc.add_argument("--goles-max", type=int, default=GOLES_TABLA)
+    pc.add_argument("--nodos", type=int, default=NODOS, help="nodos de Gauss–Hermite")
+    pi = sub.add_parser("info", help="muestra la grilla, el error y el tiempo de consulta de una tabla")
+    pi.add_argument("ruta")
+    args = parser.parse_args(argv)
+
+    if args.comando == "construir":
+        try:
+            meta = construir_tabla(args.salida, args.lam_min, args.lam_max, args.n_lam, args.sigma_min,
+                                   args.sigma_max, args.n_sigma, args.goles_max, args.nodos)
+        except ValueError as e:
+            parser.error(str(e))
+        print(f"Tabla en {args.salida} ({os.path.getsize(args.salida) / 2**20:.1f} MB, {meta['segundos']:.1f} s); "
+              f"error L1 máximo de interpolación {meta['error_max']:.2e}")
+        return 0
+    try:
+        _info(args.ruta)
+    except (OSError, ValueError) as e:
+        parser.error(str(e))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,16 @@
+import numpy as np
+import pytest
+
+from simulador_rushapo import MODOS_VR, params, simular_mc
+
+
+@pytest.mark.parametrize("modo", MODOS_VR)
+def test_resultado_independiente_de_workers_y_pool(modo):
+    """Misma semilla: conteos, matriz y errores idénticos bit a bit con cualquier pool."""
+    p = dict(params, n_sims=60000, tam_bloque=10000, seed=7, reduccion_varianza=modo)
+    base = simular_mc(p, workers=1)
+    for workers, ejecutor in ((4, "thread"), (3, "process")):
+        sim = simular_mc(p, workers=workers, ejecutor=ejecutor)
+        assert np.array_equal(sim["conteos"], base["conteos"]), (workers, ejecutor)
+        assert np.array_equal(sim["matriz"], base["matriz"]), (workers, ejecutor)
+        assert sim["se"] == base["se"], (workers, ejecutor)
@@ -0,0 +1,51 @@
+import numpy as np
+import pytest
+
+from mercados import ev, evaluar, kelly
+
+# Matriz [g_loc, g_vis] de 0 a 2 goles. Diferencia d = g_loc - g_vis:
+# P(d >= 2) = 0.15, P(d = 1) = 0.35, P(d = 0) = 0.35, P(d < 0) = 0.15.
+# Total t: P(t >= 3) = 0.30, P(t = 2) = 0.32.
+P = np.array([[0.10, 0.08, 0.02],
+              [0.20, 0.15, 0.05],
+              [0.15, 0.15, 0.10]])
+
+
+@pytest.mark.parametrize("nombre, W, D, cuota, ev_esperado", [
+    # -0.25 = mitad a 0 y mitad a -0.5: el empate pierde media y devuelve media
+    ("AH Local -0.25", 0.50, 0.175, 2.0, 0.175),
+    # +0.25: el empate gana media (+0.5) y devuelve media (0)
+    ("AH Local +0.25", 0.675, 0.175, 1.5, 0.1875),
+    # -0.75 = mitad a -0.5 y mitad a -1: ganar por 1 gana media y devuelve media
+    ("AH Local -0.75", 0.325, 0.175, 3.0, 0.15),
+    # Visitante +0.75: gana con d <= 0; perder por 1 pierde media y devuelve media
+    ("AH Visitante +0.75", 0.50, 0.175, 1.8, 0.075),
+    # Over 2.25 = mitad a 2.0 y mitad a 2.5: con 2 goles pierde media y devuelve media
+    ("Over 2.25", 0.30, 0.16, 2.5, -0.09),
+])
+def test_asiaticos_con_push_y_medias(nombre, W, D, cuota, ev_esperado):
+    fila = evaluar(P, [nombre])[nombre]
+    assert fila["W"] == pytest.approx(W) and fila["Devolución"] == pytest.approx(D)
+    assert fila["Prob"] == pytest.approx(W / (1 - D))
+    assert ev(P, nombre, cuota) == pytest.approx(ev_esperado)
+
+
+def test_kelly_asiatico_de_cuarto():
+    # AH Local -0.25 a 2.0: r = +1 (0.50), -0.5 (0.35), -1 (0.15).
+    # 0.5/(1+f) - 0.175/(1-f/2) - 0.15/(1-f) = 0  <=>  f^2/2 - 0.825 f + 0.175 = 0  =>  f = 0.25
+    assert kelly(P, "AH Local -0.25", 2.0) == pytest.approx(0.25)
+    # Over 2.25 a 4.0: r = +3 (0.30), -0.5 (0.32), -1 (0.38); la derivada se anula en f
+    f = kelly(P, "Over 2.25", 4.0)
+    assert 0 < f < 1
+    assert 0.30 * 3 / (1 + 3 * f) - 0.32 * 0.5 / (1 - 0.5 * f) - 0.38 / (1 - f) == pytest.approx(0, abs=1e-9)
+    assert kelly(P, "Over 2.25", 2.5) == 0.0
+
+
+def test_kelly_binario_y_combinada():
+    # Binario: (p*o - 1)/(o - 1)
+    assert kelly(P, "Local", 2.5) == pytest.approx((0.5 * 2.5 - 1) / 1.5)
+    # "Local + Over 2.5" solo acierta con 2-1: p = 0.15 (conjunta, no 0.5 * 0.3)
+    assert ev(P, "Local + Over 2.5", 8.0) == pytest.approx(0.15 * 8 - 1)
+    assert kelly(P, "Local + Over 2.5", 8.0) == pytest.approx((0.15 * 8 - 1) / 7)
+    with pytest.raises(ValueError):
+        ev(P, "Local + AH Local -0.25", 3.0)
@@ -0,0 +1,22 @@
+import numpy as np
+import pytest
+
+from simulador_rushapo import matriz_exacta, params, simular_mc, verificar_motor_exacto
+
+
+@pytest.mark.parametrize("sigma", [0.0, params["sigma"], 0.8])
+def test_motor_exacto_coincide_con_mc(sigma):
+    """El motor exacto cae dentro de 4 errores estándar de Monte Carlo (semilla fija)."""
+    tabla = verificar_motor_exacto(dict(params, sigma=sigma, seed=42, workers=1), n_sims=200000)
+    fuera = tabla.loc[tabla["z"].abs() > 4.0, ["Mercado", "Exacto", "MC", "z"]]
+    assert fuera.empty, fuera.to_string()
+
+
+@pytest.mark.parametrize("cambios", [{"HFA": -1.0}, {"xGF_local_prom": -0.5, "gf_local_10": -0.5}])
+def test_lambdas_negativas_se_acotan(cambios):
+    """xG o HFA negativos dan lambdas < 0: el motor exacto las acota a 1e-6 como Monte Carlo."""
+    p = dict(params, **cambios)
+    m = matriz_exacta(p)
+    assert np.isfinite(m).all() and m.sum() == pytest.approx(1.0)
+    mc = simular_mc(dict(p, n_sims=20000, workers=1))["matriz"]
+    assert mc.sum() == 20000
@@ -0,0 +1,196 @@
+"""
+Cola de trabajos en segundo plano para simulaciones largas (sin broker externo).
+
+Los trabajos corren en un pool de hilos dentro del mismo proceso: el request que
+los envía responde al instante y el worker de gunicorn queda libre para el
+formulario interactivo. NumPy libera el GIL en los cálculos pesados, así que los
+trabajos avanzan en paralelo con los requests.
+
+- Profundidad acotada: con `max_cola` trabajos esperando, `enviar` lanza ColaLlena.
+- Memoria por trabajo: el tamaño de bloque se reduce para que el pico estimado
+  (`tam_bloque_para_memoria`, que incluye el histograma de marcadores en el peor caso
+  de goles) no supere `memoria_max`; no se guardan muestras crudas.
+- Progreso y cancelación: el motor avisa cada bloque terminado (simulaciones hechas e
+  histograma parcial); cancelar hace que el siguiente aviso corte la corrida.
+
+El estado vive en el proceso: con gunicorn conviene un solo worker con hilos
+(`--workers 1 --threads N`) para que el sondeo llegue al proceso del trabajo.
+"""
+import math
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+import mercados
+from simulador_rushapo import run_simulacion_completa, tam_bloque_para_memoria
+
+ESTADOS_FINALES = ("terminado", "cancelado", "error")
+
+
+class ColaLlena(Exception):
+    """La cola de trabajos alcanzó su profundidad máxima."""
+
+
+class TrabajoCancelado(Exception):
+    """Se pidió cancelar el trabajo en curso."""
+
+
+def _a_json(valor):
+    """Convierte escalares numpy, NaN y contenedores a tipos serializables en JSON."""
+    if isinstance(valor, dict):
+        return {str(k): _a_json(v) for k, v in valor.items()}
+    if isinstance(valor, (list, tuple)):
+        return [_a_json(v) for v in valor]
+    if isinstance(valor, np.generic):
+        valor = valor.item()
+    if isinstance(valor, float) and not math.isfinite(valor):
+        return None
+    return valor
+
+
+class Trabajo:
+    """Un trabajo: parámetros, progreso, estimaciones parciales y resultado."""
+
+    def __init__(self, p, grid=None):
+        self.id = uuid.uuid4().hex
+        self.p = p
+        self.grid = grid
+        self.estado = "en_cola"
+        self.creado = time.time()
+        self.iniciado = None
+        self.terminado = None
+        self.bloques = 0
+        self.n_hechas = 0
+        self.conteos = None
+        self.resultado = None
+        self.error = None
+        self._cancelar = threading.Event()
+
+    def _progreso(self, n, conteos):
+        """Callback del motor tras cada bloque; corta la corrida si se canceló."""
+        if self._cancelar.is_set():
+            raise TrabajoCancelado()
+        self.bloques += 1
+        self.n_hechas, self.conteos = n, conteos
+
+    def estimaciones(self):
+        """Probabilidad y error estándar por mercado: finales o a partir del histograma parcial."""
+        if self.resultado is not None:
+            cuotas = self.resultado["cuotas_base"]
+            se = cuotas["Error est."] if "Error est." in cuotas else [None] * len(cuotas)
+            return {m: {"prob": p, "se": e} for m, p, e in zip(cuotas["Mercado"], cuotas["Prob"], se)}
+        conteos, n = self.conteos, self.n_hechas
+        if conteos is None or n <= 0:
+            return None
+        precios = mercados.evaluar(conteos, mercados.MERCADOS_DEFAULT, n)
+        return {m: {"prob": v["Prob"], "se": v["Error est."]} for m, v in precios.items()}
+
+    def a_dict(self):
+        """Estado para GET /jobs/<id>."""
+        n_total = int(self.p.get("n_sims", 0)) if self.p.get("engine") == "mc" else None
+        if self.estado == "terminado":
+            fraccion = 1.0
+        else:
+            fraccion = min(1.0, self.n_hechas / n_total) if n_total else 0.0
+        return _a_json({
+            "id": self.id,
+            "estado": self.estado,
+            "creado": self.creado,
+            "iniciado": self.iniciado,
+            "terminado": self.terminado,
+            "progreso": {"bloques": self.bloques, "n_hechas": self.n_hechas, "n_total": n_total, "fraccion": fraccion},
+            "estimaciones": self.estimaciones(),
+            "error": self.error,
+        })
+
+    def resultado_json(self):
+        """Resultado completo (sin muestras crudas) listo para JSON."""
+        r = self.resultado
+        return _a_json({
+            "id": self.id,
+            "engine": r["engine"],
+            "resumen": r["resumen"].to_dict(),
+            "top_scores": r["top_scores"].to_dict(orient="records"),
+            "cuotas_base": r["cuotas_base"].to_dict(orient="records"),
+            "sens": r["sens_df"].to_dict(orient="records"),
+            "precision": r["precision"],
+        })
+
+
+class ColaTrabajos:
+    """Pool de hilos con cola acotada, límite de memoria por trabajo y registro de trabajos.
+
+    El pool no crea hilos hasta el primer `enviar` (seguro con gunicorn --preload).
+    Se conservan a lo sumo `max_guardados` trabajos terminados (los más viejos se descartan).
+    """
+
+    def __init__(self, workers=1, max_cola=8, memoria_max=256 * 2**20, max_guardados=64):
+        self.max_cola = int(max_cola)
+        self.memoria_max = int(memoria_max)
+        self.max_guardados = int(max_guardados)
+        self._pool = ThreadPoolExecutor(max_workers=max(1, int(workers)), thread_name_prefix="rushapo-trabajo")
+        self._trabajos = OrderedDict()
+        self._lock = threading.Lock()
+
+    def enviar(self, p, grid=None):
+        """Encola una simulación. Lanza ColaLlena o ValueError (memoria insuficiente)."""
+        # La concurrencia la da el pool de trabajos: cada trabajo simula en un solo hilo
+        p = dict(p, workers=1)
+        if p.get("engine", "mc") == "mc":
+            p["tam_bloque"] = tam_bloque_para_memoria(p, self.memoria_max, workers=1)
+        with self._lock:
+            en_cola = sum(1 for t in self._trabajos.values() if t.estado == "en_cola")
+            if en_cola >= self.max_cola:
+                raise ColaLlena(f"Hay {en_cola} trabajos en cola (máximo {self.max_cola})")
+            trabajo = Trabajo(p, grid)
+            self._trabajos[trabajo.id] = trabajo
+            self._podar()
+        self._pool.submit(self._correr, trabajo)
+        return trabajo
+
+    def _correr(self, trabajo):
+        with self._lock:
+            if trabajo.estado != "en_cola":
+                return
+            trabajo.estado = "corriendo"
+            trabajo.iniciado = time.time()
+        try:
+            trabajo.resultado = run_simulacion_completa(trabajo.p, mostrar_graficos=False, exportar_excel=False,
+                                                        grid_sens=trabajo.grid, progreso=trabajo._progreso)
+            trabajo.n_hechas = int(trabajo.resultado["precision"]["n_usado"]) if trabajo.resultado["precision"] else 0
+            trabajo.estado = "terminado"
+        except TrabajoCancelado:
+            trabajo.estado = "cancelado"
+        except Exception as e:
+            trabajo.error = str(e)
+            trabajo.estado = "error"
+        finally:
+            trabajo.terminado = time.time()
+
+    def obtener(self, id_trabajo):
+        return self._trabajos.get(id_trabajo)
+
+    def cancelar(self, id_trabajo):
+        """Cancela un trabajo en cola (de inmediato) o en curso (en el siguiente bloque)."""
+        trabajo = self._trabajos.get(id_trabajo)
+        if trabajo is None:
+            return None
+        trabajo._cancelar.set()
+        with self._lock:
+            if trabajo.estado == "en_cola":
+                trabajo.estado = "cancelado"
+                trabajo.terminado = time.time()
+        return trabajo
+
+    def _podar(self):
+        """Descarta los trabajos terminados más viejos por encima de max_guardados."""
+        finales = [k for k, t in self._trabajos.items() if t.estado in ESTADOS_FINALES]
+        for k in finales[:max(0, len(finales) - self.max_guardados)]:
+            del self._trabajos[k]
+
+    def __len__(self):
+        return len(self._trabajos)